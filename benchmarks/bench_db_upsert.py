@@ -0,0 +1,148 @@
+"""
+Latency of indexing one uploaded file (upsert of its chain of 3 nodes: "/", folder and file)
+in File table of different sizes, before and after path index and upserts were introduced
+
+- before: no index on path, for every node of the chain parent is looked up
+  by path, then the node itself (get_or_create), then it is inserted or updated,
+  one transaction per upload
+- after: unique path index, one INSERT ... ON CONFLICT statement per node,
+  parent id is looked up by the index inside of it
+
+$ python benchmarks/bench_db_upsert.py --rows 10000,1000000,10000000
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+SCHEMA = """
+CREATE TABLE file (
+    id INTEGER NOT NULL PRIMARY KEY,
+    path VARCHAR(255) NOT NULL,
+    bytes INTEGER NOT NULL,
+    is_dir INTEGER NOT NULL,
+    modified DATETIME NOT NULL,
+    size VARCHAR(255) NOT NULL,
+    content_hash VARCHAR(255),
+    parent_id INTEGER,
+    parent_path VARCHAR(255),
+    depth INTEGER NOT NULL DEFAULT 0,
+    tree_bytes INTEGER NOT NULL DEFAULT 0,
+    tree_files INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX file_parent_id ON file (parent_id);
+"""
+
+INDEXES = """
+CREATE UNIQUE INDEX file_path ON file (path);
+CREATE INDEX file_parent_path ON file (parent_path);
+"""
+
+# the same statement as db._UPSERT (db can't be imported here: it connects to the configured db)
+UPSERT = """
+INSERT INTO "{0}" (path, bytes, is_dir, modified, size, content_hash, parent_path, depth, tree_bytes, tree_files,
+                   parent_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT id FROM "{0}" WHERE path = ?))
+ON CONFLICT (path) DO UPDATE SET
+    bytes = excluded.bytes,
+    is_dir = excluded.is_dir,
+    modified = excluded.modified,
+    size = excluded.size,
+    content_hash = CASE WHEN excluded.bytes = bytes AND excluded.modified = modified
+                        THEN coalesce(excluded.content_hash, content_hash) ELSE excluded.content_hash END,
+    parent_path = excluded.parent_path,
+    depth = excluded.depth,
+    tree_bytes = CASE WHEN excluded.is_dir THEN tree_bytes ELSE excluded.tree_bytes END,
+    tree_files = CASE WHEN excluded.is_dir THEN tree_files ELSE excluded.tree_files END,
+    parent_id = excluded.parent_id
+""".format("file")
+
+FILES_PER_FOLDER = 1000
+MODIFIED = "2016-06-29 10:37:12"
+
+
+def populate(connection, rows):
+    """Tree of folders with FILES_PER_FOLDER files in each"""
+    folders = max(1, rows // FILES_PER_FOLDER)
+
+    def nodes():
+        yield "/", 4096, 1, None, 0
+        for i in range(folders):
+            folder = "/d{:07d}".format(i)
+            yield folder, 4096, 1, "/", 1
+            for j in range(FILES_PER_FOLDER - 1):
+                yield "{}/f{:04d}".format(folder, j), 100, 0, folder, 2
+
+    with connection:
+        connection.executemany(
+            "INSERT INTO file (path, bytes, is_dir, modified, size, parent_path, depth) "
+            "VALUES (?, ?, ?, '{}', '100.0B', ?, ?)".format(MODIFIED), nodes())
+    return folders
+
+
+def chain(folders, n):
+    folder = "/d{:07d}".format(n * 7919 % folders)
+    return [("/", 4096, 1, None, 0),
+            (folder, 4096, 1, "/", 1),
+            ("{}/new{:05d}".format(folder, n), 100, 0, folder, 2)]
+
+
+def before(connection, nodes):
+    with connection:
+        for path, size, is_dir, parent_path, depth in nodes:
+            parent = connection.execute("SELECT id FROM file WHERE path = ?", (parent_path,)).fetchone()
+            parent_id = parent[0] if parent else None
+            node = connection.execute("SELECT id FROM file WHERE path = ? LIMIT 1", (path,)).fetchone()
+            if node is None:
+                connection.execute(
+                    "INSERT INTO file (path, bytes, is_dir, modified, size, parent_id) VALUES (?, ?, ?, ?, '', ?)",
+                    (path, size, is_dir, MODIFIED, parent_id))
+            else:
+                connection.execute("UPDATE file SET modified = ?, parent_id = ? WHERE id = ?",
+                                   (MODIFIED, parent_id, node[0]))
+
+
+def after(connection, nodes):
+    with connection:
+        connection.executemany(UPSERT, [
+            (path, size, is_dir, MODIFIED, "", None, parent_path, depth,
+             0 if is_dir else size, 0 if is_dir else 1, parent_path)
+            for path, size, is_dir, parent_path, depth in nodes])
+
+
+def measure(connection, func, folders, repeat):
+    latencies = []
+    for n in range(repeat):
+        nodes = chain(folders, n)
+        start = time.perf_counter()
+        func(connection, nodes)
+        latencies.append(time.perf_counter() - start)
+    return 1000 * statistics.median(latencies), 1000 * max(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10000,1000000,10000000",
+                        help="comma separated sizes of File table")
+    parser.add_argument("--repeat", type=int, default=200, help="uploads to index with upserts")
+    parser.add_argument("--repeat-before", type=int, default=5, help="uploads to index with table scans")
+    args = parser.parse_args()
+
+    print("{:>10}  {:>22}  {:>22}".format("rows", "before: median/max ms", "after: median/max ms"))
+    for rows in (int(rows) for rows in args.rows.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            connection = sqlite3.connect(os.path.join(tmp, "filesystem.db"))
+            connection.execute("PRAGMA journal_mode = wal")
+            connection.executescript(SCHEMA)
+            folders = populate(connection, rows)
+            slow = measure(connection, before, folders, args.repeat_before)
+            connection.executescript(INDEXES)
+            fast = measure(connection, after, folders, args.repeat)
+            connection.close()
+        print("{:>10}  {:>10.2f} / {:>9.2f}  {:>10.3f} / {:>9.3f}".format(rows, *slow, *fast))
+
+
+if __name__ == "__main__":
+    main()
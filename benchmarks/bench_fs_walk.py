@@ -0,0 +1,134 @@
+"""
+Compare syscalls and time of folder tree walk before and after switching fs.Worker to os.scandir
+
+$ python benchmarks/bench_fs_walk.py --dirs 100 --files 100
+"""
+import argparse
+import datetime as d
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "main"))
+
+from tornado.options import define, options
+
+define("storage-path", "/tmp/hosting_app")
+
+import fs
+import utils
+
+calls = Counter()
+
+
+class CountingEntry:
+    def __init__(self, entry):
+        self._entry = entry
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, *a, **kw):
+        calls['stat'] += 1
+        return self._entry.stat(*a, **kw)
+
+    def is_dir(self, *a, **kw):
+        # answered from d_type returned by getdents, no syscall
+        return self._entry.is_dir(*a, **kw)
+
+
+class CountingScandir:
+    def __init__(self, path):
+        calls['scandir'] += 1
+        self._it = _scandir(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._it.close()
+
+    def __iter__(self):
+        return (CountingEntry(entry) for entry in self._it)
+
+
+def counting(name, func):
+    def wrapper(*a, **kw):
+        calls[name] += 1
+        return func(*a, **kw)
+    return wrapper
+
+
+_stat, _listdir, _scandir = os.stat, os.listdir, os.scandir
+
+
+def patch_os(count):
+    os.stat = counting('stat', _stat) if count else _stat
+    os.listdir = counting('listdir', _listdir) if count else _listdir
+    os.scandir = CountingScandir if count else _scandir
+
+
+def listdir_walk(worker):
+    """Tree walk as it was done before: os.listdir + os.stat of every child"""
+    import stat
+
+    def from_root_to_leafs(file_path):
+        current = OrderedDict()
+        stat_info = os.stat(file_path)
+        current['path'] = file_path[len(worker.path.base_dir):] or "/"
+        current['bytes'] = stat_info.st_size
+        current['size'] = utils.sizeof_fmt(stat_info.st_size)
+        current['modified'] = d.datetime.fromtimestamp(stat_info.st_mtime).strftime(worker.MODIFIED_DATETIME_FORMAT)
+        if stat.S_ISDIR(stat_info.st_mode):
+            current['is_dir'] = True
+            current['children'] = [from_root_to_leafs(os.path.join(file_path, x)) for x in os.listdir(file_path)]
+        else:
+            current['is_dir'] = False
+        return current
+
+    return from_root_to_leafs(worker.path.abspath)
+
+
+def make_tree(root, dirs, files):
+    for i in range(dirs):
+        folder = os.path.join(root, "dir{:05d}".format(i))
+        os.makedirs(folder)
+        for j in range(files):
+            open(os.path.join(folder, "file{:05d}".format(j)), "w").close()
+
+
+def measure(name, func, repeat):
+    patch_os(count=True)
+    calls.clear()
+    func()
+    counted = dict(calls)
+    patch_os(count=False)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    took = (time.perf_counter() - start) / repeat
+    print("{:<40} {:>8.1f} ms  {}".format(name, took * 1000, ", ".join(
+        "{}={}".format(k, v) for k, v in sorted(counted.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dirs", type=int, default=100)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        options.storage_path = tmp
+        make_tree(tmp, args.dirs, args.files)
+        print("tree of {} folders x {} files".format(args.dirs, args.files))
+        measure("before: listdir + stat", lambda: listdir_walk(fs.Worker("/")), args.repeat)
+        measure("after: scandir", lambda: fs.Worker("/").get_tree(), args.repeat)
+        measure("after: scandir, fields=path,is_dir",
+                lambda: fs.Worker("/").get_tree(fields=('path', 'is_dir')), args.repeat)
+        measure("after: scandir, depth=1", lambda: fs.Worker("/").get_tree(depth=1), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
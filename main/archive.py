@@ -0,0 +1,176 @@
+"""
+Folder downloaded as one archive (`GET /folder/?archive=tar|zip`), generated while the tree
+is walked: files are read and (optionally) compressed by blocks on a thread and every block
+is sent before the next one is read, so nothing is written to disk and memory doesn't depend
+on the size of the tree or of its files (zip keeps a small record of every entry for its
+central directory)
+"""
+import concurrent.futures
+import datetime
+import logging
+import os
+import tarfile
+import zipfile
+import zlib
+
+from tornado.options import options
+
+import fs
+
+log = logging.getLogger("tornado.general")
+
+# format -> (content type, content type when compressed, file name extension, extension when compressed)
+FORMATS = {
+    'tar': ("application/x-tar", "application/gzip", ".tar", ".tar.gz"),
+    'zip': ("application/zip", "application/zip", ".zip", ".zip"),
+}
+
+_executor = None
+
+
+def executor():
+    """Threads generating archives, see `chunks`"""
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(options.download_archive_threads,
+                                                          thread_name_prefix="archive")
+    return _executor
+
+
+class Sink:
+    """Unseekable file object collecting what is written to it until it is drained"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class TarWriter:
+    """Tar stream (pax format, so long names and big files fit), gzip-ed as a whole if compressed"""
+
+    def __init__(self, compress):
+        self.sink = Sink()
+        self._compressor = zlib.compressobj(wbits=31) if compress else None
+        self._written = 0
+
+    def add_folder(self, name, modified):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = int(modified.timestamp())
+        self._write(info.tobuf(tarfile.PAX_FORMAT))
+
+    def add_file(self, name, modified, f, size, block_size):
+        """Write header and contents of opened file, yield after every block"""
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = int(modified.timestamp())
+        self._write(info.tobuf(tarfile.PAX_FORMAT))
+        written = 0
+        while written < size:
+            block = f.read(min(block_size, size - written))
+            if not block:
+                # file was truncated meanwhile, the size in its header is kept
+                block = bytes(min(block_size, size - written))
+            self._write(block)
+            written += len(block)
+            yield
+        self._write(bytes(-size % tarfile.BLOCKSIZE))
+
+    def close(self):
+        # two empty blocks mark the end, the archive is padded to whole records as tar does
+        self._write(bytes(2 * tarfile.BLOCKSIZE))
+        self._write(bytes(-self._written % tarfile.RECORDSIZE))
+        if self._compressor is not None:
+            self.sink.write(self._compressor.flush())
+
+    def _write(self, data):
+        self._written += len(data)
+        self.sink.write(self._compressor.compress(data) if self._compressor is not None else data)
+
+
+class ZipWriter:
+    """Zip stream with data descriptors after contents of entries, deflated if compressed"""
+
+    def __init__(self, compress):
+        self.sink = Sink()
+        self._compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self._zip = zipfile.ZipFile(self.sink, 'w', self._compress_type)
+
+    def add_folder(self, name, modified):
+        info = self._info(name + "/", modified)
+        info.external_attr = (0o40755 << 16) | 0x10  # MS-DOS directory flag
+        self._zip.writestr(info, b"")
+
+    def add_file(self, name, modified, f, size, block_size):
+        """Write contents of opened file, yield after every block"""
+        info = self._info(name, modified)
+        info.external_attr = 0o644 << 16
+        info.compress_type = self._compress_type
+        # zip64 extra field is chosen by it before the size is known from the descriptor
+        info.file_size = size
+        with self._zip.open(info, 'w') as entry:
+            written = 0
+            while written < size:
+                block = f.read(min(block_size, size - written))
+                if not block:
+                    break  # file was truncated meanwhile
+                entry.write(block)
+                written += len(block)
+                yield
+
+    def close(self):
+        self._zip.close()
+
+    @staticmethod
+    def _info(name, modified):
+        # zip can't store times before 1980
+        return zipfile.ZipInfo(name, max(modified, datetime.datetime(1980, 1, 1)).timetuple()[:6])
+
+
+def chunks(worker, archive_format, compress=False, chunk_size=1024 * 1024):
+    """
+    Walk the folder of `worker` (see `fs.Worker.walk`) and yield its archive by chunks of about
+    `chunk_size` bytes. Run it on `executor` threads: files are read and compressed by the generator.
+    Entries are named by paths inside of the folder, prefixed by its name
+    :param archive_format(str): key of `FORMATS`
+    :param compress(bool): gzip tar stream or deflate zip entries
+    """
+    archive = (TarWriter if archive_format == 'tar' else ZipWriter)(compress)
+    root = worker.path.db_path.rstrip("/")
+    prefix = os.path.basename(root)
+    for _, node, _ in worker.walk(fields=('path', 'bytes', 'modified', 'is_dir')):
+        name = (prefix + node['path'][len(root):]).lstrip("/")
+        modified = datetime.datetime.strptime(node['modified'], fs.Worker.MODIFIED_DATETIME_FORMAT)
+        if node['is_dir']:
+            if name:
+                archive.add_folder(name, modified)
+        else:
+            try:
+                f = open(worker.path.base_dir + node['path'], 'rb')
+            except (FileNotFoundError, IsADirectoryError, PermissionError) as e:
+                log.warning("Skipping %s in archive of %s: %s", node['path'], worker.path.db_path, e)
+                continue
+            with f:
+                for _ in archive.add_file(name, modified, f, node['bytes'], chunk_size):
+                    if len(archive.sink) >= chunk_size:
+                        yield archive.sink.drain()
+        if len(archive.sink) >= chunk_size:
+            yield archive.sink.drain()
+    archive.close()
+    yield archive.sink.drain()
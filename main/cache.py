@@ -0,0 +1,132 @@
+import sys
+from collections import OrderedDict, deque
+
+
+def approx_size(obj):
+    """Rough memory footprint of json-like object (dicts, lists, strings, numbers) in bytes"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sys.getsizeof(key) + approx_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            size += approx_size(value)
+    return size
+
+
+class MetadataCache:
+    """
+    Bounded LRU cache of folder listings (trees of node dicts with formatted
+    `size` and `modified`) keyed by db path of the folder and listing arguments.
+    Changing a path invalidates listings of the path, its ancestors and descendants.
+    Listing read while the path was changed is not cached, see `put`.
+    """
+
+    def __init__(self, max_memory, recent=1024):
+        """
+        :param max_memory(int): upper limit of cached listings size in bytes, 0 disables cache
+        :param recent(int): number of latest invalidated paths kept to check listings being read
+        """
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # (path, key) -> (value, size)
+        self._keys = {}  # path -> set of keys cached for this path
+        self.generation = 0  # number of invalidations
+        self._recent = deque(maxlen=recent)  # (generation, path) of the latest invalidations
+
+    def get(self, path, key=()):
+        try:
+            value, _ = self._entries[(path, key)]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((path, key))
+        self.hits += 1
+        return value
+
+    def put(self, path, key, value, generation=None):
+        """
+        :param generation(int): `generation` before the value was read, it is not cached if the path
+        was invalidated since then (its change was written while it was read)
+        """
+        if not self.max_memory:
+            return
+        if generation is not None and self.invalidated_since(path, generation):
+            return
+        size = approx_size(value)
+        if size > self.max_memory:
+            return
+        self._drop((path, key))
+        self._entries[(path, key)] = (value, size)
+        self._keys.setdefault(path, set()).add(key)
+        self.memory += size
+        while self.memory > self.max_memory:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, path):
+        """Drop listings which may include `path`: of the path itself, its ancestors and descendants"""
+        path = path.rstrip("/") or "/"
+        self.generation += 1
+        self._recent.append((self.generation, path))
+        paths = {path}
+        parent = path
+        while parent != "/":
+            parent = parent.rsplit("/", 1)[0] or "/"
+            paths.add(parent)
+        prefix = path.rstrip("/") + "/"
+        paths.update(cached for cached in self._keys if cached.startswith(prefix))
+        for cached in paths:
+            for key in list(self._keys.get(cached, ())):
+                self._drop((cached, key))
+                self.invalidations += 1
+
+    def invalidated_since(self, path, generation):
+        """Listing of `path` may include a path invalidated after `generation`"""
+        if generation == self.generation:
+            return False
+        if not self._recent or self._recent[0][0] > generation + 1:
+            # invalidations since then are not kept
+            return True
+        path = path.rstrip("/") or "/"
+        for invalidated_generation, invalidated in reversed(self._recent):
+            if invalidated_generation <= generation:
+                break
+            if path == "/" or invalidated == path or invalidated.startswith(path + "/") \
+                    or path.startswith(invalidated.rstrip("/") + "/"):
+                return True
+        return False
+
+    def clear(self):
+        self._entries.clear()
+        self._keys.clear()
+        self.memory = 0
+        self.generation += 1
+        self._recent.clear()
+
+    def stats(self):
+        return OrderedDict([
+            ("entries", len(self._entries)),
+            ("memory", self.memory),
+            ("max_memory", self.max_memory),
+            ("hits", self.hits),
+            ("misses", self.misses),
+            ("evictions", self.evictions),
+            ("invalidations", self.invalidations),
+        ])
+
+    def _drop(self, entry):
+        try:
+            _, size = self._entries.pop(entry)
+        except KeyError:
+            return
+        self.memory -= size
+        path, key = entry
+        keys = self._keys[path]
+        keys.discard(key)
+        if not keys:
+            del self._keys[path]
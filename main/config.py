@@ -13,6 +13,12 @@ def parse_config_file():
            default=int(config.get('Main', 'port', fallback=8888)),
            type=int,
            help='port on with to run http server')
+    define('processes',
+           default=int(config.get('Main', 'processes', fallback=1)),
+           type=int,
+           help='Number of worker processes accepting requests on the port, 0 for one per CPU core. '
+                'With more than one, a coordinator process keeps path locks of all workers, writes their '
+                'metadata changes by a single db writer and runs the file watcher')
     define('storage-path',
            default=config.get('Main', 'storage_path', fallback='/tmp/hosting_app'),
            help='path where to store all the folders and files')
@@ -24,15 +30,97 @@ def parse_config_file():
                 'It also hiding when doing "GET folder" requests. Imagine that you upload big file to the /a/b/c/d/huge.file'
                 'Without locking one could simply create a tiny file in /a/b and this would conflict with huge file when'
                 'upload is finished, so huge file will be simply discarded. To prevent this behavior enable locking')
+    define('locking_timeout',
+           default=float(config.get('Locking', 'timeout', fallback=0)),
+           type=float,
+           help='Seconds a request waits for conflicting requests to finish before it gets 409. '
+                'Downloads and listings share paths, writes lock their path exclusively. 0 returns 409 immediately')
     define('file-size-limit',
            default=int(config.get('Main', 'file_size_limit', fallback=4096)),
            type=int,
            help='Upper limit for files Xchange in MB. '
                 'Can be bigger then amount of RAM on your machine '
                 'because files are not buffered entirely before processing but instead processed by chunks up to 16 KB')
+    define('upload_buffer_size',
+           default=int(config.get('Upload', 'buffer_size', fallback=1024)),
+           type=int,
+           help='Uploaded chunks are coalesced into blocks of this size in KB before written to disk. '
+                'Keep it multiple of 64')
+    define('upload_max_pending_buffers',
+           default=int(config.get('Upload', 'max_pending_buffers', fallback=4)),
+           type=int,
+           help='How many blocks of one upload may wait for disk before reading of request body is paused')
+    define('upload_writer_threads',
+           default=int(config.get('Upload', 'writer_threads', fallback=4)),
+           type=int,
+           help='Size of thread pool writing uploaded blocks to disk')
+    define('upload_staging_dir',
+           default=config.get('Upload', 'staging_dir', fallback=''),
+           help='Folder for files being uploaded, must be on the same filesystem as storage path '
+                'to publish uploaded files with atomic rename. Default is ".staging" inside storage path')
+    define('upload_preallocate',
+           default=config.getboolean('Upload', 'preallocate', fallback=True),
+           type=bool,
+           help='Preallocate disk space of uploaded file by its Content-Length, '
+                'to avoid fragmentation and to reject uploads early if there is not enough space')
+    define('upload_fsync',
+           default=config.get('Upload', 'fsync', fallback='none'),
+           help='When to fsync uploaded files before reporting success: '
+                'none, file (file contents) or full (file contents and folder entry)')
+    define('upload_deduplicate',
+           default=config.getboolean('Upload', 'deduplicate', fallback=False),
+           type=bool,
+           help='Store files with the same contents once: uploaded file is published as a hard link '
+                'to a blob in content addressed store (.blobs inside storage path) keyed by its sha256')
+    define('upload_session_ttl',
+           default=int(config.get('Upload', 'session_ttl', fallback=24)),
+           type=int,
+           help='Hours to keep unfinished resumable upload since its last chunk. '
+                'Sessions survive server restart, expired ones are removed with their staged files')
+    define('download_mmap',
+           default=config.getboolean('Download', 'mmap', fallback=True),
+           type=bool,
+           help='Send downloaded files from mmap-ed memory without copying them into Python buffers')
+    define('download_chunk_size',
+           default=int(config.get('Download', 'chunk_size', fallback=1024)),
+           type=int,
+           help='Size in KB of file pieces passed to the socket at once when downloading files')
+    define('download_archive_threads',
+           default=int(config.get('Download', 'archive_threads', fallback=4)),
+           type=int,
+           help='Threads reading and compressing folders downloaded as archives (GET /folder/?archive=tar|zip)')
+    define('quota_limits',
+           default=config.get('Quota', 'limits', fallback=''),
+           help='Per folder quotas, one per line: "folder max_bytes [max_files]". '
+                'Size may have K, M, G or T suffix, "-" stands for no limit. '
+                'Uploads exceeding quota of any folder containing them are rejected with 507 before the body is read')
     define('db_file',
            default=config.get('Database', 'db_file'),
            help='Full path to sqlite3 db file')
+    define('listing_from_db',
+           default=config.getboolean('Database', 'listing_from_db', fallback=True),
+           type=bool,
+           help='Serve directory listings from the db index (File and FileClosure tables). '
+                'Disk is walked only when requested folder is not indexed yet')
+    define('db_read_threads',
+           default=int(config.get('Database', 'read_threads', fallback=2)),
+           type=int,
+           help='Threads with their own read connections serving listings (db is switched to WAL mode). '
+                'All writes are done by a single writer thread. 0 runs reads on the writer thread')
+    define('db_write_delay',
+           default=int(config.get('Database', 'write_delay', fallback=50)),
+           type=int,
+           help='Metadata changes are queued and written in one transaction every this many ms. '
+                'Listings of folders with queued changes write them first')
+    define('db_write_batch',
+           default=int(config.get('Database', 'write_batch', fallback=1000)),
+           type=int,
+           help='Write queued metadata changes as soon as this many of them are pending')
+    define('db_delete_batch',
+           default=int(config.get('Database', 'delete_batch', fallback=10000)),
+           type=int,
+           help='Descendants of deleted folder are deleted from db index in transactions of this many nodes, '
+                'before the rest of queued changes is written')
     define('sqlite_closure_table_so',
            default=config.get('Database', 'sqlite_closure_table_so'),
            help=''
@@ -42,6 +130,35 @@ def parse_config_file():
                 '$ git clone https://gist.github.com/coleifer/7f3593c5c2a645913b92 closure\n'
                 '$ cd closure/\n'
                 '$ gcc -g -fPIC -shared closure.c -o closure.so')
+    define('changes_keep',
+           default=int(config.get('Changes', 'keep', fallback=1000000)),
+           type=int,
+           help='Number of the latest changes kept in change log (GET /_changes). '
+                'Clients with older cursor have to sync the whole tree. 0 keeps all changes')
+    define('watch_enabled',
+           default=config.getboolean('Watch', 'enabled', fallback=False),
+           type=bool,
+           help='Watch storage path with inotify and bring db index, cache and quotas in sync with changes '
+                'made bypassing the app (rsync, scripts). Changes made while the server is down need reindex.py')
+    define('watch_delay',
+           default=int(config.get('Watch', 'delay', fallback=200)),
+           type=int,
+           help='Changed nodes are compared with db index this many ms after the first event of a burst, '
+                'so repeated events of the same nodes are checked once')
+    define('trash_rate',
+           default=int(config.get('Trash', 'rate', fallback=10000)),
+           type=int,
+           help='Deleted folders are moved to .trash inside storage path and removed in background, '
+                'this many files and folders per second. 0 for no limit')
+    define('copy_threads',
+           default=int(config.get('Copy', 'threads', fallback=2)),
+           type=int,
+           help='Size of thread pool copying files and folders of COPY requests, '
+                'separate from threads writing uploads')
+    define('cache_max_memory',
+           default=int(config.get('Cache', 'max_memory', fallback=64)),
+           type=int,
+           help='Upper limit in MB for in-memory cache of folder listings. 0 disables cache')
     for logging_option in options.as_dict().keys():
         if logging_option.startswith('log') and logging_option in config['Logging']:
             options.__setattr__(logging_option, config['Logging'][logging_option])
@@ -0,0 +1,257 @@
+"""
+Coordinator of multi-process serving (see `processes` option): one process owning state which
+worker processes must share. Workers connect to it over a Unix socket and exchange newline
+delimited json messages with it. Path locks of all workers are kept in its lock table (locks of
+a worker which is gone are released), metadata changes queued by workers are written by its
+single db writer, and every written change is announced to all workers, so they drop cached
+listings which include it and wake up change feed clients
+"""
+import itertools
+import json
+import logging
+import socket
+from collections import OrderedDict
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
+
+import locks
+
+log = logging.getLogger("tornado.general")
+
+
+class RemoteError(Exception):
+    """Request failed in the coordinator process with exception of class `name`"""
+
+    def __init__(self, name, message):
+        super().__init__("{}: {}".format(name, message))
+        self.name = name
+        self.message = message
+
+
+def encode(message):
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+class Coordinator(tornado.tcpserver.TCPServer):
+    """Server side, runs in the coordinator process"""
+
+    def __init__(self, lock_manager, write, stats):
+        """
+        :param lock_manager(locks.LockManager): lock table of all workers
+        :param write: callable writing queue of metadata changes (see `db.write`), returns future of changed paths
+        :param stats: callable returning counters of the coordinator process
+        """
+        super().__init__()
+        self.lock_manager = lock_manager
+        self.write = write
+        self.stats = stats
+        self.peers = set()
+        self.writes = 0
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        peer = Peer(self, stream)
+        self.peers.add(peer)
+        log.info("Worker connected, %d workers are connected", len(self.peers))
+        try:
+            while True:
+                line = yield stream.read_until(b"\n")
+                peer.received(json.loads(line.decode()))
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.peers.discard(peer)
+            peer.closed()
+            log.info("Worker disconnected, %d workers are connected", len(self.peers))
+
+    def changed(self, paths, sender=None):
+        """Tell workers (but the one which made the change) that `paths` (db paths) were changed"""
+        message = encode({"op": "changed", "paths": paths})
+        for peer in self.peers:
+            if peer is not sender:
+                peer.send(message)
+
+    def invalidate(self, path):
+        """Stands for cache of listings in the coordinator process (e.g. for `watcher.Watcher`): workers cache them"""
+        self.changed([path])
+
+
+class Peer:
+    """Connection of one worker process"""
+
+    def __init__(self, coordinator, stream):
+        self.coordinator = coordinator
+        self.stream = stream
+        self.locks = {}  # request id -> locks.Lock acquired or waiting for this worker
+
+    def received(self, message):
+        getattr(self, "on_" + message["op"])(message)
+
+    def send(self, message):
+        if not self.stream.closed():
+            self.stream.write(message if isinstance(message, bytes) else encode(message))
+
+    def on_lock(self, message):
+        lock = self.coordinator.lock_manager.lock(message["path"], message["mode"])
+        self.locks[message["id"]] = lock
+        tornado.ioloop.IOLoop.current().add_future(
+            lock.acquire(message["timeout"]), lambda future: self.acquired(message["id"], future))
+
+    def acquired(self, id, future):
+        if future.exception() is None:
+            self.send({"id": id, "ok": True})
+            return
+        self.locks.pop(id, None)
+        self.send({"id": id, "conflict": future.exception().path})
+
+    def on_release(self, message):
+        lock = self.locks.pop(message["id"], None)
+        if lock is not None:
+            lock.release()
+
+    @tornado.gen.coroutine
+    def on_write(self, message):
+        try:
+            paths = yield self.coordinator.write(message["queue"])
+        except Exception as e:
+            self.send({"id": message["id"], "error": type(e).__name__, "message": str(e)})
+            return
+        self.coordinator.writes += 1
+        self.send({"id": message["id"], "ok": True})
+        self.coordinator.changed(paths, sender=self)
+
+    def on_stats(self, message):
+        self.send({"id": message["id"], "stats": self.coordinator.stats()})
+
+    def closed(self):
+        """Release locks of the worker, it can't release them anymore"""
+        for lock in self.locks.values():
+            lock.release()
+        self.locks.clear()
+
+
+class Client:
+    """
+    Worker side: connection to the coordinator. It is the lock manager of `locks.Lock`
+    of the worker (see `locks.LockManager`), their table is kept by the coordinator
+    """
+
+    def __init__(self, path, on_changed, on_closed):
+        """
+        :param path(str): Unix socket of the coordinator
+        :param on_changed: called with db paths changed by other workers or the coordinator
+        :param on_closed: called when connection to the coordinator is lost
+        """
+        self.path = path
+        self.on_changed = on_changed
+        self.on_closed = on_closed
+        self.stream = None
+        self._ids = itertools.count(1)
+        self._replies = {}  # request id -> future of reply
+        self._locks = {}  # locks.Lock acquired or waiting -> request id
+        self.acquired = 0
+        self.conflicts = 0
+
+    @tornado.gen.coroutine
+    def connect(self):
+        self.stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        yield self.stream.connect(self.path)
+        tornado.ioloop.IOLoop.current().add_future(self._read(), lambda future: future.result())
+
+    def request(self, op, **kw):
+        """Send request, return future of reply. Its exception is `RemoteError` if request failed"""
+        return self._request(op, **kw)[1]
+
+    def write(self, queue):
+        """Write queue of metadata changes (see `db.WriteBehind`) by the single writer of the coordinator"""
+        return self.request("write", queue=queue)
+
+    def lock(self, path, mode):
+        return locks.Lock(self, path, mode)
+
+    def acquire(self, lock, timeout=0):
+        """See `locks.Lock.acquire`"""
+        future = tornado.concurrent.Future()
+        self._locks[lock], reply = self._request("lock", path=lock.path, mode=lock.mode, timeout=timeout)
+        lock._future = future
+        tornado.ioloop.IOLoop.current().add_future(reply, lambda _: self._acquired(lock, reply))
+        return future
+
+    def release(self, lock):
+        id = self._locks.pop(lock, None)
+        if id is None:
+            return
+        self._send({"op": "release", "id": id})
+        if lock.acquired:
+            lock.acquired = False
+        else:
+            self._stop_waiting(lock, locks.Conflict(lock.path))
+
+    def stats(self):
+        return OrderedDict([
+            ("waiting", sum(1 for lock in self._locks if not lock.acquired)),
+            ("acquired", self.acquired),
+            ("conflicts", self.conflicts),
+        ])
+
+    def _acquired(self, lock, reply):
+        if lock not in self._locks:
+            return  # released while waiting
+        if reply.exception() is not None:
+            del self._locks[lock]
+            self._stop_waiting(lock, reply.exception())
+            return
+        if "conflict" in reply.result():
+            del self._locks[lock]
+            self.conflicts += 1
+            self._stop_waiting(lock, locks.Conflict(reply.result()["conflict"]))
+            return
+        lock.acquired = True
+        self.acquired += 1
+        self._stop_waiting(lock)
+
+    @staticmethod
+    def _stop_waiting(lock, exception=None):
+        future, lock._future = lock._future, None
+        if exception is None:
+            future.set_result(lock)
+        else:
+            future.set_exception(exception)
+
+    def _request(self, op, **kw):
+        id = next(self._ids)
+        future = tornado.concurrent.Future()
+        self._replies[id] = future
+        self._send(dict(kw, op=op, id=id))
+        return id, future
+
+    def _send(self, message):
+        try:
+            self.stream.write(encode(message))
+        except tornado.iostream.StreamClosedError:
+            pass  # replies are failed when reading is stopped
+
+    @tornado.gen.coroutine
+    def _read(self):
+        try:
+            while True:
+                line = yield self.stream.read_until(b"\n")
+                message = json.loads(line.decode())
+                if "id" not in message:
+                    self.on_changed(message["paths"])
+                    continue
+                future = self._replies.pop(message["id"])
+                if "error" in message:
+                    future.set_exception(RemoteError(message["error"], message["message"]))
+                else:
+                    future.set_result(message)
+        except tornado.iostream.StreamClosedError:
+            log.error("Connection to coordinator process is lost")
+        replies, self._replies = self._replies, {}
+        for future in replies.values():
+            future.set_exception(RemoteError("StreamClosedError", "Connection to coordinator process is lost"))
+        self.on_closed()
@@ -1,16 +1,24 @@
+import concurrent.futures
+import itertools
 import logging
 import os
-import uuid
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime
 from pprint import pprint
 
+import tornado.gen
 import tornado.ioloop
+import tornado.locks
 from tornado.options import options
-from playhouse.sqlite_ext import SqliteExtDatabase, ClosureTable
+from playhouse.sqlite_ext import SqliteExtDatabase, ClosureTable, AutoIncrementField
+from playhouse.migrate import SqliteMigrator, migrate
 from peewee import (Model, CharField, ForeignKeyField, IntegerField,
-                    BooleanField, DateTimeField, DoesNotExist, OperationalError)
+                    BooleanField, DateTimeField, DoesNotExist, OperationalError, SQL, fn)
 
 import fs
+import utils
 
 log = logging.getLogger("tornado.general")
 
@@ -19,17 +27,25 @@ connect to db
 load closure module
 create tables
 """
-db = SqliteExtDatabase(options.db_file)
+# WAL lets read connections work while the writer thread holds a write transaction
+db = SqliteExtDatabase(options.db_file, pragmas=[('journal_mode', 'wal')] if options.db_read_threads else [])
 db.load_extension(options.sqlite_closure_table_so)
 
 
 class File(Model):
-    path = CharField()
-    bytes = IntegerField()
+    path = CharField(unique=True)
+    bytes = IntegerField(index=True)
     is_dir = BooleanField()
-    modified = DateTimeField()
+    modified = DateTimeField(index=True)
     size = CharField()  # redundant
+    content_hash = CharField(null=True)  # sha256 of file contents, computed on upload
     parent = ForeignKeyField('self', null=True, related_name='children')
+    parent_path = CharField(null=True, index=True)  # redundant, children are looked up without joins
+    depth = IntegerField(default=0)  # number of path components, 0 for "/"
+    # bytes and number of files in the subtree (of the file itself for files), kept up to date
+    # incrementally on every change of a file inside of it, see `add_to_ancestors`
+    tree_bytes = IntegerField(default=0)
+    tree_files = IntegerField(default=0)
 
     class Meta:
         database = db
@@ -37,8 +53,212 @@ class File(Model):
 
 FileClosure = ClosureTable(File)
 
-File.create_table(True)
-FileClosure.create_table(True)
+
+class Change(Model):
+    """
+    Log of changes of the tree for incremental sync. Id is the cursor: ids are never reused
+    and grow in the order changes were committed, since they are written by the single writer
+    """
+    id = AutoIncrementField()
+    action = CharField()  # "update" (created or changed) or "delete" (with all descendants)
+    path = CharField()
+    is_dir = BooleanField()
+    bytes = IntegerField()
+    modified = DateTimeField()
+    content_hash = CharField(null=True)
+
+    class Meta:
+        database = db
+
+# version of the schema, stored in `PRAGMA user_version` of db file
+SCHEMA_VERSION = 5
+
+
+def migrate_schema():
+    """Create tables or upgrade existing db in place up to `SCHEMA_VERSION`"""
+    table = File._meta.table_name
+    if not File.table_exists():
+        db.create_tables([File, Change])
+        FileClosure.create_table(True)
+        db.pragma('user_version', SCHEMA_VERSION)
+        create_name_index()
+        return
+    version = db.pragma('user_version')
+    if version >= SCHEMA_VERSION:
+        create_name_index()
+        return
+    log.warning("Upgrading db schema from version %d to %d", version, SCHEMA_VERSION)
+    migrator = SqliteMigrator(db)
+    with db.atomic():
+        columns = {column.name for column in db.get_columns(table)}
+        if 'content_hash' not in columns:
+            migrate(migrator.add_column(table, 'content_hash', File.content_hash))
+        if version < 2:
+            # get_or_create without unique index could leave duplicates, keep the latest row of each path
+            db.execute_sql('DELETE FROM "{0}" WHERE id NOT IN (SELECT MAX(id) FROM "{0}" GROUP BY path)'.format(table))
+            migrate(migrator.add_column(table, 'parent_path', File.parent_path),
+                    migrator.add_column(table, 'depth', File.depth))
+            db.execute_sql(_MATERIALIZE_PARENT_PATH.format(table))
+            migrate(migrator.add_index(table, ('path',), unique=True))
+            # parents of removed duplicates
+            db.execute_sql('UPDATE "{0}" SET parent_id = (SELECT parent.id FROM "{0}" AS parent '
+                           'WHERE parent.path = "{0}".parent_path)'.format(table))
+        if version < 3:
+            migrate(migrator.add_column(table, 'tree_bytes', File.tree_bytes),
+                    migrator.add_column(table, 'tree_files', File.tree_files))
+            db.execute_sql(_AGGREGATE_TREE_TOTALS.format(table))
+        if version < 4:
+            # search by size and modification time ranges
+            migrate(migrator.add_index(table, ('bytes',)),
+                    migrator.add_index(table, ('modified',)))
+        if version < 5:
+            Change.create_table()
+        db.pragma('user_version', SCHEMA_VERSION)
+    FileClosure.create_table(True)
+    create_name_index()
+
+
+# name of the node is the part of its path after the last "/"
+_BASENAME = "substr({0}, length(rtrim({0}, replace({0}, '/', ''))) + 1)"
+
+NAME_INDEX = "file_name"
+
+
+def create_name_index():
+    """
+    Create trigram full text index of node names unless it exists. It is kept in sync by triggers,
+    so it is changed in the same transactions as File table. Search falls back to scanning
+    File table if sqlite is built without FTS5 or its trigram tokenizer (sqlite < 3.34)
+    """
+    table = File._meta.table_name
+    if db.table_exists(NAME_INDEX):
+        return
+    try:
+        with db.atomic():
+            db.execute_sql('CREATE VIRTUAL TABLE "{}" USING fts5(name, tokenize = "trigram")'.format(NAME_INDEX))
+            db.execute_sql('INSERT INTO "{0}" (rowid, name) SELECT id, {2} FROM "{1}"'.format(
+                NAME_INDEX, table, _BASENAME.format("path")))
+            db.execute_sql('CREATE TRIGGER "{0}_insert" AFTER INSERT ON "{1}" BEGIN '
+                           'INSERT INTO "{0}" (rowid, name) VALUES (new.id, {2}); END'.format(
+                               NAME_INDEX, table, _BASENAME.format("new.path")))
+            db.execute_sql('CREATE TRIGGER "{0}_delete" AFTER DELETE ON "{1}" BEGIN '
+                           'DELETE FROM "{0}" WHERE rowid = old.id; END'.format(NAME_INDEX, table))
+    except OperationalError as e:
+        log.warning("Names are not indexed, search will scan the whole tree: %s", e)
+        return
+    log.warning("Indexed names of all nodes for search")
+
+
+# depth is the number of "/" in path, parent path is path without the last component
+_MATERIALIZE_PARENT_PATH = """
+UPDATE "{0}" SET
+    depth = CASE WHEN path = '/' THEN 0 ELSE length(path) - length(replace(path, '/', '')) END,
+    parent_path = CASE
+        WHEN path = '/' THEN NULL
+        WHEN length(path) - length(replace(path, '/', '')) = 1 THEN '/'
+        ELSE rtrim(rtrim(path, replace(path, '/', '')), '/')
+    END
+"""
+
+# one range scan of path index per folder, run once when schema is upgraded
+_AGGREGATE_TREE_TOTALS = """
+UPDATE "{0}" SET
+    tree_bytes = CASE WHEN NOT is_dir THEN bytes ELSE (
+        SELECT coalesce(sum(descendant.bytes), 0) FROM "{0}" AS descendant
+        WHERE NOT descendant.is_dir
+          AND descendant.path > rtrim("{0}".path, '/') || '/' AND descendant.path < rtrim("{0}".path, '/') || '0'
+    ) END,
+    tree_files = CASE WHEN NOT is_dir THEN 1 ELSE (
+        SELECT count(*) FROM "{0}" AS descendant
+        WHERE NOT descendant.is_dir
+          AND descendant.path > rtrim("{0}".path, '/') || '/' AND descendant.path < rtrim("{0}".path, '/') || '0'
+    ) END
+"""
+
+migrate_schema()
+name_index = db.table_exists(NAME_INDEX)
+
+
+def connect():
+    """Open connection for the current thread unless it is already opened"""
+    if db.is_closed():
+        db.connect()
+
+
+class Executor:
+    """
+    Threads running db work off the IOLoop, with queue depth and latency (wait in the queue
+    plus run time) counters. Each thread uses its own connection, see `connect`
+    """
+
+    def __init__(self, name, threads):
+        self.name = name
+        self._pool = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)  # of recent calls, in seconds
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, func, *a, **kw):
+        """Run `func` on one of the threads, return future to yield in coroutines"""
+        queued = time.monotonic()
+
+        def run():
+            try:
+                return func(*a, **kw)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self.completed += 1
+                    self._latencies.append(time.monotonic() - queued)
+
+        with self._lock:
+            self.submitted += 1
+        return self._pool.submit(run)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = OrderedDict([
+                ("queue_depth", self.submitted - self.completed),
+                ("submitted", self.submitted),
+                ("failed", self.failed),
+            ])
+        for name, quantile in (("latency_p50_ms", 0.5), ("latency_p99_ms", 0.99)):
+            stats[name] = round(1000 * latencies[int(quantile * (len(latencies) - 1))], 3) if latencies else None
+        stats["latency_max_ms"] = round(1000 * latencies[-1], 3) if latencies else None
+        return stats
+
+
+# single writer: sqlite serializes write transactions anyway
+writer_executor = Executor("db-writer", 1)
+reader_executor = Executor("db-reader", options.db_read_threads) if options.db_read_threads else writer_executor
+
+
+def read(func, *a, **kw):
+    """Run `func` (e.g. `get_tree`) on a read connection, return future"""
+    return reader_executor.submit(func, *a, **kw)
+
+
+@tornado.gen.coroutine
+def read_fresh(path, func, *a, **kw):
+    """Write queued changes inside of `path` before reading it with `func(path, *a, **kw)`"""
+    if writer.pending(path):
+        yield writer.flush()
+    result = yield read(func, path, *a, **kw)
+    return result
+
+
+def stats():
+    return OrderedDict([
+        ("write_behind", writer.stats()),
+        ("writer", writer_executor.stats()),
+        ("readers", reader_executor.stats() if reader_executor is not writer_executor else None),
+    ])
 
 
 def traverse(statinfo, func):
@@ -47,98 +267,690 @@ def traverse(statinfo, func):
         traverse(statinfo['children'], func)
 
 
-# # Without `get_or_create`, we might write:
-# try:
-#     person = Person.get(
-#         (Person.first_name == 'John') &
-#         (Person.last_name == 'Lennon'))
-# except Person.DoesNotExist:
-#     person = Person.create(
-#         first_name='John',
-#         last_name='Lennon',
-#         birthday=datetime.date(1940, 10, 9))
-#
-# person, created = Person.get_or_create(
-#     first_name='John',
-#     last_name='Lennon',
-#     defaults={'birthday': datetime.date(1940, 10, 9)})
-
-def node_update(statinfo):
-    node_path = statinfo['path']
-    parent = None
+NODE_COLUMNS = {
+    'path': File.path,
+    'bytes': File.bytes,
+    'size': File.size,
+    'modified': File.modified,
+    'is_dir': File.is_dir,
+}
+
+
+def _node_info(fields, values):
+    current = OrderedDict(zip(fields, values))
+    if 'modified' in current:
+        current['modified'] = current['modified'].strftime(fs.Worker.MODIFIED_DATETIME_FORMAT)
+    return current
+
+
+def get_tree(path, depth=None, limit=None, cursor=None, fields=None):
+    """
+    Build the same tree as `fs.Worker.get_tree` does, but from the index:
+    one lookup of the root node, one query for the (paginated) direct children
+    and one range scan of path index for deeper descendants limited by `depth`
+    :param path(str): db path of the folder, e.g. "/" or "/a/b"
+    :param depth, limit, cursor, fields: see `fs.Worker.get_tree`
+    :raise DoesNotExist: folder is not indexed (yet)
+    :return(collections.OrderedDict):
+    """
+    fields = fields or fs.Worker.NODE_FIELDS
+    columns = [NODE_COLUMNS[field] for field in fields]
+
+    def select():
+        return File.select(File.path, File.parent_path, File.is_dir, File.depth, *columns)
+
+    connect()
+    root_path, _, root_is_dir, root_depth, *info = select().where(File.path == path).tuples().get()
+    tree = _node_info(fields, info)
+    if not root_is_dir or depth == 0:
+        return tree
+
+    tree['children'] = []
+    nodes = {root_path: tree}
+    prefix = root_path.rstrip("/") + "/"
+    children = File.parent_path == root_path
+    if cursor is not None:
+        children &= File.path > prefix + cursor
+    query = select().where(children).order_by(File.path).tuples()
+    if limit is not None:
+        query = query.limit(limit + 1)
+    paths = []
+    for node_path, _, is_dir, _, *info in query:
+        if len(paths) == limit:
+            tree['next_cursor'] = os.path.basename(paths[-1])
+            # keys in the same order as in the tree built by walking the disk
+            tree.move_to_end('children')
+            break
+        current = _node_info(fields, info)
+        if is_dir and depth != 1:
+            current['children'] = []
+            nodes[node_path] = current
+        tree['children'].append(current)
+        paths.append(node_path)
+
+    if not paths or depth == 1:
+        return tree
+
+    # "0" follows "/", so path + "0" is greater than any path inside of it
+    deeper = (File.path > paths[0]) & (File.path < max(path + "0" for path in paths)) & (File.depth > root_depth + 1)
+    if depth is not None:
+        deeper &= File.depth <= root_depth + depth
+    query = select().where(deeper).order_by(File.path).tuples()
+    # parent path is a prefix of child path, so ordering by path guarantees that parent
+    # is already in `nodes` when its children are reached. Nodes outside of the page are dropped
+    for node_path, parent_path, is_dir, node_depth, *info in query:
+        if parent_path not in nodes:
+            continue
+        current = _node_info(fields, info)
+        if is_dir and (depth is None or node_depth < root_depth + depth):
+            current['children'] = []
+            nodes[node_path] = current
+        nodes[parent_path]['children'].append(current)
+    return tree
+
+
+def children(path, names=None):
+    """
+    Indexed folder and its direct children, see `watcher.scan` for the same read from disk
+    :param names: only children with these names, all of them if None
+    :return: (node info of the folder or None if it is not indexed, dict of db path -> node info of children)
+    """
+    fields = fs.Worker.NODE_FIELDS
+    columns = [NODE_COLUMNS[field] for field in fields]
+    connect()
+    folder = File.select(*columns).where(File.path == path).tuples().first()
+    prefix = path.rstrip("/") + "/"
+    if names is None:
+        queries = [File.select(*columns).where(File.parent_path == path)]
+    else:
+        paths = [prefix + name for name in names]
+        # sqlite limits number of variables of a statement
+        queries = [File.select(*columns).where(File.path.in_(paths[start:start + 100]))
+                   for start in range(0, len(paths), 100)]
+    nodes = OrderedDict()
+    for query in queries:
+        for info in query.tuples():
+            node = _node_info(fields, info)
+            nodes[node['path']] = node
+    return _node_info(fields, folder) if folder else None, nodes
+
+
+def walk(path, depth=None, limit=None, cursor=None, fields=None):
+    """
+    Lazy counterpart of `get_tree`, see `fs.Worker.walk`: nodes are read
+    folder by folder so memory doesn't depend on the size of the whole tree
+    :raise DoesNotExist: folder is not indexed (yet)
+    """
+    fields = fields or fs.Worker.NODE_FIELDS
+    columns = [NODE_COLUMNS[field] for field in fields]
+
+    def select():
+        return File.select(File.path, File.is_dir, *columns)
+
+    def from_root_to_leafs(node_path, is_dir, info, level):
+        current = _node_info(fields, info)
+        if not is_dir or (depth is not None and level >= depth):
+            yield level, current, False
+            return
+        children = File.parent_path == node_path
+        if level == 0 and cursor is not None:
+            children &= File.path > node_path.rstrip("/") + "/" + cursor
+        query = select().where(children).order_by(File.path).tuples()
+        if level == 0 and limit is not None:
+            rows = list(query.limit(limit + 1))
+            if len(rows) > limit:
+                rows = rows[:limit]
+                current['next_cursor'] = os.path.basename(rows[-1][0])
+        else:
+            # children are fetched at once, so the walk may be continued on another thread
+            # (cursors are bound to connection of the thread they were opened on)
+            rows = list(query)
+        yield level, current, True
+        for child_path, child_is_dir, *child_info in rows:
+            yield from from_root_to_leafs(child_path, child_is_dir, child_info, level + 1)
+
+    connect()
+    root_path, root_is_dir, *info = select().where(File.path == path).tuples().get()
+    yield from from_root_to_leafs(root_path, root_is_dir, info, 0)
+
+
+def content_hash(path, bytes, modified):
+    """
+    :param path(str): db path of the file
+    :param bytes, modified: current size and modification time of the file (datetime),
+    stored hash is ignored if the file was changed since it was indexed
+    :return: sha256 of file contents or None if it is unknown
+    """
+    connect()
     try:
-        parent = File.get(File.path == os.path.dirname(node_path))
+        stored, stored_bytes, stored_modified = (File.select(File.content_hash, File.bytes, File.modified)
+                                                 .where(File.path == path).tuples().get())
     except DoesNotExist:
-        log.warning("Didn't find parent of %s. This maybe a sign of a problem with data persistence model", node_path)
-
-    # node_info = {
-    #     "path" : statinfo['path'],
-    #     "bytes" : statinfo['bytes'],
-    #     "is_dir" : statinfo['is_dir'],
-    #     "modified" : datetime.strptime(statinfo['modified'], fs.FSWorker.MODIFIED_DATETIME_FORMAT),
-    #     "size" : statinfo['size'],
-    #     "parent" : parent
-    # }
-    node_info = statinfo.copy()
-    # if "children" in node_info:
-    #     del node_info["children"]
-    del node_info["path"]
-    node_info['modified'] = datetime.strptime(node_info['modified'], fs.Worker.MODIFIED_DATETIME_FORMAT)
-    node_info['parent'] = parent
-    node, created = File.get_or_create(
-        path=node_path,
-        defaults=node_info
-    )
-
-    if created:
-        log.info("New node '%s' with parent '%s' was created", node_path, parent.path if parent else "NULL")
-    else:
-        node.modified = node_info['modified']
-        node.parent = node_info['parent'] # if parent else node
-        node.save()
-        log.info("Node '%s' with parent '%s' was updated", node_path, parent.path if parent else "NULL")
+        return None
+    if stored_bytes != bytes or stored_modified != modified.replace(microsecond=0):
+        return None
+    return stored
+
 
+def content_hashes(path):
+    """
+    :param path(str): db path of a file or a folder
+    :return(dict): db path -> sha256 of contents, of files in the subtree with known hash
+    """
+    connect()
+    node, prefix, end = _subtree_bounds(path)
+    subtree = (File.path == node) | ((File.path > prefix) & (File.path < end))
+    return dict(File.select(File.path, File.content_hash)
+                .where(subtree & File.content_hash.is_null(False)).tuples())
 
 
-def _generic(statinfo):
+def usage(path):
     """
-    - delete file from db
-    - update parent folder's `modified` field
-    :param statinfo(collections.OrderedDict):
-    {
-        "bytes": 39,
-        "is_dir": false,
-        "modified": "Wed, 29 Jun 2016 10:37:12",
-        "path": "/johntravolta4",
-        "size": "39.0B"
+    Bytes and number of files under `path`, read from aggregated totals of the node
+    :param path(str): db path of a folder or a file
+    :raise DoesNotExist: path is not indexed (yet)
+    :return(collections.OrderedDict):
+    """
+    connect()
+    tree_bytes, tree_files = (File.select(File.tree_bytes, File.tree_files)
+                              .where(File.path == path).tuples().get())
+    return OrderedDict([
+        ("path", path),
+        ("bytes", tree_bytes),
+        ("size", utils.sizeof_fmt(tree_bytes)),
+        ("files", tree_files),
+    ])
+
+
+def search(path, name=None, contains=None, prefix=None, min_bytes=None, max_bytes=None,
+           modified_after=None, modified_before=None, is_dir=None, limit=100, cursor=None, fields=None):
+    """
+    Find nodes inside of folder `path` (the folder itself is not included) by name, size and
+    modification time. Names are matched with trigram index, sizes and times with indexes of File table
+    :param name(str): glob pattern (case sensitive) the whole name must match, e.g. "*.pdf"
+    :param contains(str): substring of the name (ASCII case insensitive)
+    :param prefix(str): prefix of the name (ASCII case insensitive)
+    :param min_bytes, max_bytes(int): range of sizes, inclusive
+    :param modified_after, modified_before(datetime): range of modification times, inclusive
+    :param is_dir(bool): find only folders or only files
+    :param limit(int): max number of results, ordered by path
+    :param cursor(str): path of the last result of the previous page
+    :param fields(tuple): see `fs.Worker.get_tree`
+    :raise DoesNotExist: folder is not indexed (yet)
+    :return(collections.OrderedDict): {"path": ..., "results": [...], "next_cursor": ...}
+    """
+    fields = fields or fs.Worker.NODE_FIELDS
+    connect()
+    File.select(File.id).where((File.path == path) & File.is_dir).get()
+    prefix_path = path.rstrip("/") + "/"
+    where = (File.path > max(prefix_path, cursor or "")) & (File.path < path.rstrip("/") + "0")
+    conditions, params = _name_conditions(name, contains, prefix)
+    if conditions:
+        if name_index:
+            # peewee doesn't parenthesize raw SQL on the right of IN
+            where &= File.id.in_(SQL('(SELECT rowid FROM "{}" WHERE {})'.format(
+                NAME_INDEX, " AND ".join(conditions).format(column="name")), params))
+        else:
+            where &= SQL(" AND ".join(conditions).format(column=_BASENAME.format('"path"')), params)
+    if min_bytes is not None:
+        where &= File.bytes >= min_bytes
+    if max_bytes is not None:
+        where &= File.bytes <= max_bytes
+    if modified_after is not None:
+        where &= File.modified >= modified_after
+    if modified_before is not None:
+        where &= File.modified <= modified_before
+    if is_dir is not None:
+        where &= File.is_dir == is_dir
+    query = (File.select(File.path, *[NODE_COLUMNS[field] for field in fields])
+             .where(where).order_by(File.path).limit(limit + 1).tuples())
+    results = []
+    result = OrderedDict([("path", path), ("results", results)])
+    paths = []
+    for node_path, *info in query:
+        if len(paths) == limit:
+            result['next_cursor'] = paths[-1]
+            break
+        results.append(_node_info(fields, info))
+        paths.append(node_path)
+    return result
+
+
+def _name_conditions(name, contains, prefix):
+    """
+    SQL conditions on `{column}` with name and their parameters. Substring and prefix are matched
+    with LIKE, it is served by trigram index, but treats "%" and "_" as wildcards,
+    so exact match is checked after it
+    """
+    conditions, params = [], []
+    if name:
+        conditions.append("{column} GLOB ?")
+        params.append(name)
+    for value, position in ((contains, "> 0"), (prefix, "= 1")):
+        if value:
+            conditions.append("{column} LIKE ? AND instr(lower({column}), lower(?)) " + position)
+            params.extend(("%" + value + "%" if position == "> 0" else value + "%", value))
+    return conditions, params
+
+
+class WriteBehind:
+    """
+    Queue of metadata changes written in one transaction every `delay` ms or as soon as
+    `batch` of them are pending. Changes of the same node queued by concurrent requests
+    (e.g. `modified` of their common ancestors) are coalesced and written once
+    """
+
+    UPDATE, DELETE, MOVE, COPY = "update", "delete", "move", "copy"
+
+    def __init__(self, delay, batch):
+        """
+        :param delay(int): ms to wait for more changes before writing them
+        :param batch(int): write as soon as this many changes are pending
+        """
+        self.delay = delay
+        self.batch = batch
+        # in order of arrival: (UPDATE, OrderedDict of db path -> node info to create or update),
+        # (DELETE, node info of deleted node) or (MOVE or COPY, node info of the destination with
+        # db path of the moved or copied node as "source"). Each but UPDATE starts a new group of updates
+        self._queue = []
+        self._writing = []  # queues being written
+        self._callbacks = []
+        self._pending = 0
+        self._timeout = None
+        # callable writing queue elsewhere (by the coordinator process, see `coordinator.Client.write`),
+        # returns future. Queue is written by the writer thread of this process if it is None
+        self.sink = None
+        self.queued = 0
+        self.coalesced = 0
+        self.transactions = 0
+        self.failures = 0
+
+    def update(self, statinfo, callback=None):
+        """Queue creation or update of the node and its chain of children, see `fs.Worker.get_updated_info`"""
+        traverse(statinfo, self._update_node)
+        self._queued(callback)
+
+    def delete(self, statinfo, callback=None):
+        """Queue update of the chain of ancestors and deletion of its last node with all descendants"""
+        nodes = []
+        traverse(statinfo, nodes.append)
+        for node in nodes[:-1]:
+            self._update_node(node)
+        deleted = nodes[-1].copy()
+        deleted.pop('children', None)
+        self._queue.append((self.DELETE, deleted))
+        self.queued += 1
+        self._pending += 1
+        self._queued(callback)
+
+    def move(self, statinfo, target, callback=None):
+        """
+        Queue moving of the last node of `statinfo` chain with all descendants to the last node
+        of `target` chain, the rest of both chains are ancestors to update (see `delete`)
+        """
+        nodes = []
+        traverse(statinfo, nodes.append)
+        for node in nodes[:-1]:
+            self._update_node(node)
+        self._relocate(self.MOVE, nodes[-1]['path'], target, callback)
+
+    def copy(self, source, target, callback=None):
+        """Queue copying of the node at `source` (db path) with all descendants to the last node of `target` chain"""
+        self._relocate(self.COPY, source, target, callback)
+
+    def _relocate(self, action, source, target, callback):
+        nodes = []
+        traverse(target, nodes.append)
+        for node in nodes[:-1]:
+            self._update_node(node)
+        relocated = nodes[-1].copy()
+        relocated.pop('children', None)
+        relocated['source'] = source
+        self._queue.append((action, relocated))
+        self.queued += 1
+        self._pending += 1
+        self._queued(callback)
+
+    @classmethod
+    def paths(cls, action, item):
+        """Db paths of nodes changed by queued change (descendants of deleted, moved or copied ones aside)"""
+        if action == cls.UPDATE:
+            return list(item)
+        if action == cls.MOVE:
+            return [item['source'], item['path']]
+        return [item['path']]
+
+    def pending(self, path):
+        """
+        Is there a queued (or being written) change inside of `path` (db path of a folder or a file),
+        or of its ancestor deleted, moved or copied with all descendants
+        """
+        prefix = path.rstrip("/") + "/"
+        for action, item in itertools.chain(self._queue, *self._writing):
+            for queued in self.paths(action, item):
+                if queued == path or queued.startswith(prefix):
+                    return True
+                if action != self.UPDATE and path.startswith(queued.rstrip("/") + "/"):
+                    return True
+        return False
+
+    def flush(self):
+        """
+        Write all queued changes now, return future resolved when they are written. Queues are
+        written in order, so it is resolved after changes being written already are written too
+        """
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        queue, callbacks = self._queue, self._callbacks
+        self._queue, self._callbacks, self._pending = [], [], 0
+        self._writing.append(queue)
+        future = self.sink(queue) if self.sink is not None else writer_executor.submit(self._write, queue)
+        tornado.ioloop.IOLoop.current().add_future(future, lambda f: self._written(f, queue, callbacks))
+        return future
+
+    def _write(self, queue):
+        """Runs on the writer thread"""
+        if not queue:
+            return
+        connect()
+        for action, item in queue:
+            if action == self.DELETE and item['is_dir']:
+                del_descendants(item, options.db_delete_batch)
+        with db.atomic():
+            for action, item in queue:
+                if action == self.UPDATE:
+                    upsert_nodes(item.values())
+                elif action == self.MOVE:
+                    move_node_tree(item)
+                elif action == self.COPY:
+                    copy_node_tree(item)
+                elif item['is_dir']:
+                    del_node_tree(item)
+                else:
+                    del_node(item)
+            log_changes(queue)
+        log.info("Wrote %d metadata changes in one transaction", self._count(queue))
+
+    def _written(self, future, queue, callbacks):
+        self._writing.remove(queue)
+        if not queue:
+            return
+        if isinstance(future.exception(), OperationalError):
+            self.failures += 1
+            log.error("Failed to write %d metadata changes. Retrying in 5 seconds",
+                      self._count(queue), exc_info=future.exception())
+            self._queue, self._callbacks = queue + self._queue, callbacks + self._callbacks
+            self._pending += self._count(queue)
+            self._schedule(5000)
+            return
+        try:
+            if future.exception() is not None:
+                self.failures += 1
+                log.error("Failed to write %d metadata changes, dropping them", self._count(queue),
+                          exc_info=future.exception())
+            else:
+                self.transactions += 1
+        finally:
+            # cached metadata is invalidated even if the changes are dropped, it is read from disk then
+            for callback in callbacks:
+                callback()
+            changes_written.notify_all()
+
+    def stats(self):
+        return OrderedDict([
+            ("pending", self._pending),
+            ("queued", self.queued),
+            ("coalesced", self.coalesced),
+            ("transactions", self.transactions),
+            ("failures", self.failures),
+        ])
+
+    def _update_node(self, statinfo):
+        node = statinfo.copy()
+        node.pop('children', None)
+        self.queued += 1
+        if not self._queue or self._queue[-1][0] != self.UPDATE:
+            self._queue.append((self.UPDATE, OrderedDict()))
+        nodes = self._queue[-1][1]
+        if node['path'] in nodes:
+            # position of the first update is kept, so parents are still written before children
+            nodes[node['path']].update(node)
+            self.coalesced += 1
+        else:
+            nodes[node['path']] = node
+            self._pending += 1
+
+    def _count(self, queue):
+        return sum(len(item) if action == self.UPDATE else 1 for action, item in queue)
+
+    def _queued(self, callback):
+        if callback is not None:
+            self._callbacks.append(callback)
+        if self._pending >= self.batch:
+            self._schedule(0)
+        elif self._timeout is None:
+            self._schedule(self.delay)
+
+    def _schedule(self, delay):
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self._timeout is not None:
+            io_loop.remove_timeout(self._timeout)
+        self._timeout = io_loop.call_later(delay / 1000, self.flush)
+
+
+writer = WriteBehind(options.db_write_delay, options.db_write_batch)
+# notified on the IOLoop when a batch of changes is committed, see `changes`
+changes_written = tornado.locks.Condition()
+
+
+def write(queue):
+    """
+    Write queue of changes sent by a worker process (see `WriteBehind._queue`) by the writer thread
+    :return: future of db paths of changed nodes
+    """
+    def run():
+        writer._write(queue)
+        return [path for action, item in queue for path in WriteBehind.paths(action, item)]
+    return writer_executor.submit(run)
+
+
+def log_changes(queue):
+    """
+    Append written changes (see `WriteBehind._queue`) to Change log and drop the oldest ones beyond limit.
+    Moved node is logged as deletion of the source, and every node of moved or copied subtree
+    as update of its new path, so clients sync them as any other changes
+    """
+    rows = []
+    for action, item in queue:
+        if action == WriteBehind.UPDATE:
+            rows.extend(_change(action, node) for node in item.values())
+            continue
+        if action != WriteBehind.COPY:
+            rows.append(_change(WriteBehind.DELETE, dict(item, path=item.get('source', item['path']))))
+        if action in (WriteBehind.MOVE, WriteBehind.COPY):
+            _insert_changes(rows)
+            rows = []
+            db.execute_sql(_LOG_SUBTREE.format(Change._meta.table_name, File._meta.table_name),
+                           (WriteBehind.UPDATE, *_subtree_bounds(item['path'])))
+    _insert_changes(rows)
+    last = Change.select(fn.MAX(Change.id)).scalar()
+    if last is not None and options.changes_keep:
+        Change.delete().where(Change.id <= last - options.changes_keep).execute()
+
+
+def _change(action, node):
+    return {
+        'action': action,
+        'path': node['path'],
+        'is_dir': node['is_dir'],
+        'bytes': node['bytes'],
+        'modified': datetime.strptime(node['modified'], fs.Worker.MODIFIED_DATETIME_FORMAT),
+        'content_hash': node.get('content_hash'),
     }
-    :return:
+
+
+def _insert_changes(rows):
+    # sqlite limits number of variables of a statement
+    for start in range(0, len(rows), 100):
+        Change.insert_many(rows[start:start + 100]).execute()
+
+
+# parents are logged before their children
+_LOG_SUBTREE = """
+INSERT INTO "{0}" (action, path, is_dir, bytes, modified, content_hash)
+SELECT ?, path, is_dir, bytes, modified, content_hash FROM "{1}"
+WHERE path = ? OR (path > ? AND path < ?) ORDER BY path
+"""
+
+
+def changes(cursor=None, limit=1000, path=None):
+    """
+    Changes committed after `cursor`
+    :param cursor(int): id of the last change client has seen, None to get current cursor only
+    :param limit(int): max number of changes to return
+    :param path(str): db path of a folder to get changes inside of it only
+    (deletion of the folder or its ancestors included)
+    :raise LookupError: changes after cursor are not kept anymore, client has to sync the whole tree
+    :return(collections.OrderedDict): {"cursor": id of the last returned change, "changes": [...]}
+    """
+    connect()
+    # one read transaction: the last id and changes are read from the same snapshot
+    with db.atomic():
+        oldest, last = Change.select(fn.MIN(Change.id), fn.MAX(Change.id)).tuples().get()
+        if last is None:
+            # log is empty, but ids of removed changes are still not reused
+            last = db.execute_sql("SELECT seq FROM sqlite_sequence WHERE name = ?",
+                                  (Change._meta.table_name,)).fetchone()
+            last = last[0] if last else 0
+            oldest = last + 1
+        if cursor is None:
+            return OrderedDict([("cursor", last), ("changes", [])])
+        if cursor < oldest - 1:
+            raise LookupError(cursor)
+        where = Change.id > cursor
+        if path is not None and path != "/":
+            prefix = path.rstrip("/") + "/"
+            ancestors = [ancestor for ancestor in fs.Worker.iterate_path(path) if ancestor != path]
+            where &= ((Change.path == path) | ((Change.path > prefix) & (Change.path < path.rstrip("/") + "0"))
+                      | ((Change.action == WriteBehind.DELETE) & Change.path.in_(ancestors)))
+        rows = list(Change.select(Change.id, Change.action, Change.path, Change.is_dir, Change.bytes,
+                                  Change.modified, Change.content_hash)
+                    .where(where).order_by(Change.id).limit(limit).tuples())
+    result = []
+    for change_id, action, change_path, is_dir, bytes, modified, content_hash in rows:
+        change = OrderedDict([
+            ("cursor", change_id),
+            ("action", action),
+            ("path", change_path),
+            ("is_dir", is_dir),
+            ("bytes", bytes),
+            ("size", utils.sizeof_fmt(bytes)),
+            ("modified", modified.strftime(fs.Worker.MODIFIED_DATETIME_FORMAT)),
+        ])
+        if content_hash:
+            change['content_hash'] = content_hash
+        result.append(change)
+    # changes outside of `path` are skipped: cursor moves past all of them unless the page is full
+    cursor = result[-1]['cursor'] if len(result) == limit else max(cursor, last)
+    return OrderedDict([("cursor", cursor), ("changes", result)])
+
+
+def upsert_nodes(nodes):
+    """
+    Create or update nodes ordered from parents to children, one upsert statement for all of them.
+    Size changes of files are added to totals of their ancestors
     """
+    rows = []
+    changes = []
+    cursor = db.cursor()
+    for node in nodes:
+        node_path = node['path']
+        parent_path = os.path.dirname(node_path) if node_path != "/" else None
+        modified = str(datetime.strptime(node['modified'], fs.Worker.MODIFIED_DATETIME_FORMAT))
+        tree_bytes, tree_files = (0, 0) if node['is_dir'] else (node['bytes'], 1)
+        if not node['is_dir']:
+            indexed = cursor.execute(_SELECT_TREE_TOTALS.format(File._meta.table_name), (node_path,)).fetchone()
+            indexed_bytes, indexed_files = indexed or (0, 0)
+            changes.append((node_path, tree_bytes - indexed_bytes, tree_files - indexed_files))
+        rows.append((node_path, node['bytes'], node['is_dir'], modified, node['size'], node.get('content_hash'),
+                     parent_path, node_path.count("/") if node_path != "/" else 0, tree_bytes, tree_files,
+                     parent_path))
+    cursor.executemany(_UPSERT.format(File._meta.table_name), rows)
+    add_to_ancestors(changes)
+
 
-    with db.transaction():
-        traverse(statinfo, node_update)
+def add_to_ancestors(changes):
+    """
+    Add size changes of files to totals of all their (indexed) ancestors, one update per ancestor
+    :param changes: iterable of (db path, bytes delta, files delta)
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for path, bytes_delta, files_delta in changes:
+        while path != "/":
+            path = os.path.dirname(path)
+            totals[path][0] += bytes_delta
+            totals[path][1] += files_delta
+    rows = [(bytes_delta, files_delta, path) for path, (bytes_delta, files_delta) in totals.items()
+            if bytes_delta or files_delta]
+    if rows:
+        db.cursor().executemany(
+            'UPDATE "{}" SET tree_bytes = tree_bytes + ?, tree_files = tree_files + ? WHERE path = ?'.format(
+                File._meta.table_name), rows)
 
 
-def file_or_folder_deleted(update):
-    node = update
-    prev = None
-    while "children" in node and node["children"]:
-        prev = node
-        node = node["children"]
-    if prev:
-        prev["children"] = []
-    if node['is_dir']:
-        folder_deleted(update, node)
+_SELECT_TREE_TOTALS = 'SELECT tree_bytes, tree_files FROM "{0}" WHERE path = ?'
+
+# parent is looked up by unique path index, so it has to be created before its children.
+# Totals of folders are changed by `add_to_ancestors` only. Stored content hash is kept
+# unless the file was changed (e.g. bypassing the app) and no new hash is known
+_UPSERT = """
+INSERT INTO "{0}" (path, bytes, is_dir, modified, size, content_hash, parent_path, depth, tree_bytes, tree_files,
+                   parent_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT id FROM "{0}" WHERE path = ?))
+ON CONFLICT (path) DO UPDATE SET
+    bytes = excluded.bytes,
+    is_dir = excluded.is_dir,
+    modified = excluded.modified,
+    size = excluded.size,
+    content_hash = CASE WHEN excluded.bytes = bytes AND excluded.modified = modified
+                        THEN coalesce(excluded.content_hash, content_hash) ELSE excluded.content_hash END,
+    parent_path = excluded.parent_path,
+    depth = excluded.depth,
+    tree_bytes = CASE WHEN excluded.is_dir THEN tree_bytes ELSE excluded.tree_bytes END,
+    tree_files = CASE WHEN excluded.is_dir THEN tree_files ELSE excluded.tree_files END,
+    parent_id = excluded.parent_id
+"""
 
-    else:
-        file_deleted(update, node)
 
+def file_or_folder_deleted(update, callback=None):
+    """
+    Queue deletion of the last node of `update` chain, the rest of the chain are its ancestors to update
+    :param callback: called when change is written
+    """
+    writer.delete(update, callback)
 
 
-def file_uploaded(update):
+def file_or_folder_moved(update, target_update, callback=None):
     """
-    - upload file stat info to db
-    - update parent folder's `modified` field
+    Queue moving of the last node of `update` chain to the last node of `target_update` chain,
+    the rest of the chains are ancestors to update
+    :param callback: called when change is written
+    """
+    writer.move(update, target_update, callback)
+
+
+def file_or_folder_copied(source, target_update, callback=None):
+    """
+    Queue copying of the node at `source` (db path) to the last node of `target_update` chain
+    :param callback: called when change is written
+    """
+    writer.copy(source, target_update, callback)
+
+
+def file_uploaded(update, callback=None):
+    """
+    Queue creation of uploaded file and update of its parent folders' `modified` field
     {
         "bytes": 39,
         "is_dir": false,
@@ -146,103 +958,154 @@ def file_uploaded(update):
         "path": "/johntravolta4",
         "size": "39.0B"
     }
-    :return:
+    :param callback: called when change is written
     """
-    try:
-        db.connect()
-        debug = str(uuid.uuid4())
-        log.info("File %s has been created. Updating DB  with quert_id %s", update['path'], debug)
-        _generic(update)
-        log.info("Successfully updated database with quert_id %s", debug)
-    except OperationalError:
-        log.exception("Failed on DB operation. Adding callback with timeout")
-        tornado.ioloop.IOLoop.instance().add_timeout(timedelta(seconds=5), folder_created, update)
+    writer.update(update, callback)
 
 
-def file_deleted(update_struct, deleted_node):
+def folder_created(update, callback=None):
     """
-    - delete file from db
-    - update parent folder's `modified` field
-    :param rminfo(collections.OrderedDict):
-    {
-        "is_dir": False,
-        "path": self._part_path,
-        "modified": None # Attention, here modified is datetime obj
-    }
-    :return:
+    Queue creation of folder and update of its parent folders' `modified` field
+    :param callback: called when change is written
     """
-    try:
-        db.connect()
-        debug = str(uuid.uuid4())
-        log.info("File %s has been deleted. Updating DB  with quert_id %s", deleted_node['path'], debug)
-        with db.transaction():
-            traverse(update_struct, node_update)
-            del_node(deleted_node)
-        log.info("Successfully updated database with quert_id %s", debug)
-    except OperationalError:
-        log.exception("Failed on DB operation. Adding callback with timeout")
-        tornado.ioloop.IOLoop.instance().add_timeout(timedelta(seconds=5), folder_created, update_struct, deleted_node)
-
-
-def folder_created(update):
-    """
-    - upload folder stat info to db
-    - update parent folder's `modified` field
-    :return:
-        """
-    try:
-        db.connect()
-        debug = str(uuid.uuid4())
-        log.info("Folder %s has been created. Updating DB  with quert_id %s", update['path'], debug)
-        _generic(update)
-        log.info("Successfully updated database with quert_id %s", debug)
-    except OperationalError:
-        log.exception("Failed on DB operation. Adding callback with timeout")
-        tornado.ioloop.IOLoop.instance().add_timeout(timedelta(seconds=5), folder_created, update)
-
+    writer.update(update, callback)
 
-def folder_deleted(update_struct, deleted_node):
-    """
-    - delete folder,
-    - all subfolders and files
-    - update parent folder's `modified` field
-    :return:
-    """
-    try:
-        db.connect()
-        debug = str(uuid.uuid4())
-        log.info("Folder %s has been deleted. Updating DB  with quert_id %s", deleted_node['path'], debug)
-        with db.transaction():
-            traverse(update_struct, node_update)
-            del_node_tree(deleted_node)
-        log.info("Successfully updated database with quert_id %s", debug)
-    except OperationalError:
-        log.exception("Failed on DB operation. Adding callback with timeout")
-        tornado.ioloop.IOLoop.instance().add_timeout(timedelta(seconds=5), folder_created, update_struct, deleted_node)
 
 def del_node(node):
     try:
+        rows = list(File.select(File.content_hash, File.tree_bytes, File.tree_files)
+                    .where(File.path == node['path']).tuples())
         query = File.delete().where(File.path == node['path'])
         deleted = query.execute()
         if not deleted:
             raise DoesNotExist
         log.info("deleted {} descendants".format(deleted))
+        add_to_ancestors((node['path'], -tree_bytes, -tree_files) for _, tree_bytes, tree_files in rows)
+        release_blobs(content_hash for content_hash, _, _ in rows)
     except DoesNotExist:
         log.error("Didn't find file node %s. This maybe a sign of a problem with data persistence model", node['path'])
 
 def del_node_tree(node):
+    """Delete folder with all descendants, they are found by range scan of path index"""
+    prefix = node['path'].rstrip("/") + "/"
+    subtree = (File.path == node['path']) | ((File.path > prefix) & (File.path < node['path'].rstrip("/") + "0"))
+    content_hashes = [content_hash for content_hash, in
+                      File.select(File.content_hash).where(subtree & File.content_hash.is_null(False)).tuples()]
+    totals = list(File.select(File.tree_bytes, File.tree_files).where(File.path == node['path']).tuples())
+    deleted = File.delete().where(subtree).execute()
+    if not deleted:
+        log.error("Didn't find folder node %s. This maybe a sign of a problem with data persistence model", node['path'])
+    log.info("deleted {} descendants".format(deleted))
+    add_to_ancestors((node['path'], -tree_bytes, -tree_files) for tree_bytes, tree_files in totals)
+    release_blobs(content_hashes)
 
-    try:
-        parent = File.get(File.path == node['path'])
-        subquery = (FileClosure
-                    .select(FileClosure.id)
-                    .where(FileClosure.root == parent))
-        query = File.delete().where(File.id << subquery)
-        log.info("deleted {} descendants".format(query.execute()))
-        # for descendant in File.delete().where(File.id << subquery):
-        #     print(descendant.path)
 
-    except DoesNotExist:
-        log.error("Didn't find folder node %s. This maybe a sign of a problem with data persistence model", node['path'])
+def del_descendants(node, batch):
+    """
+    Delete descendants of the folder in transactions of `batch` nodes, deepest first, so huge trees
+    don't hold the write lock and grow the journal. The folder itself is deleted by `del_node_tree`
+    """
+    prefix = node['path'].rstrip("/") + "/"
+    descendants = (File.path > prefix) & (File.path < node['path'].rstrip("/") + "0")
+    while True:
+        with db.atomic():
+            rows = list(File.select(File.content_hash).where(descendants)
+                        .order_by(File.path.desc()).limit(batch).tuples())
+            if rows:
+                File.delete().where(File.id.in_(
+                    File.select(File.id).where(descendants).order_by(File.path.desc()).limit(batch))).execute()
+        release_blobs(content_hash for content_hash, in rows)
+        if len(rows) < batch:
+            return
+
+
+def _subtree_bounds(path):
+    """Parameters of "path = ? OR (path > ? AND path < ?)": the node and range of its descendants in path index"""
+    return path, path.rstrip("/") + "/", path.rstrip("/") + "0"
+
+
+def _free_path(path):
+    """Delete stale node at `path` which was free on disk: index is out of sync with it"""
+    stale = File.select(File.is_dir).where(File.path == path).tuples().first()
+    if stale is not None:
+        log.warning("Deleting stale node %s from the index", path)
+        (del_node_tree if stale[0] else del_node)({'path': path})
+
+
+def move_node_tree(node):
+    """
+    Move node with all descendants to a new path by one update of their rows, found by range scan
+    of path index. Ids are kept, so only parent of the moved node is changed in the closure table
+    :param node: node info of the destination with db path of the moved node as "source"
+    """
+    source, target = node['source'], node['path']
+    table = File._meta.table_name
+    _free_path(target)
+    found = File.select(File.id, File.tree_bytes, File.tree_files).where(File.path == source).tuples().first()
+    if found is None:
+        log.error("Didn't find moved node %s. This maybe a sign of a problem with data persistence model", source)
+        return
+    node_id, tree_bytes, tree_files = found
+    add_to_ancestors([(source, -tree_bytes, -tree_files)])
+    db.execute_sql(_MOVE_SUBTREE.format(table), (target, source, source, os.path.dirname(target), target, source,
+                                                 target.count("/") - source.count("/"), *_subtree_bounds(source)))
+    db.execute_sql('UPDATE "{0}" SET parent_id = (SELECT id FROM "{0}" WHERE path = ?) WHERE id = ?'.format(table),
+                   (os.path.dirname(target), node_id))
+    add_to_ancestors([(target, tree_bytes, tree_files)])
+    if name_index:
+        # names index is kept in sync by triggers on insert and delete only
+        db.execute_sql('UPDATE "{}" SET name = ? WHERE rowid = ?'.format(NAME_INDEX),
+                       (os.path.basename(target), node_id))
+    log.info("moved %s to %s", source, target)
+
+
+def copy_node_tree(node):
+    """
+    Copy node with all descendants to a new path by one insert selecting their rows by range scan of path index
+    :param node: node info of the destination with db path of the copied node as "source"
+    """
+    source, target = node['source'], node['path']
+    table = File._meta.table_name
+    _free_path(target)
+    found = File.select(File.tree_bytes, File.tree_files).where(File.path == source).tuples().first()
+    if found is None:
+        log.error("Didn't find copied node %s. This maybe a sign of a problem with data persistence model", source)
+        return
+    copied = db.execute_sql(_COPY_SUBTREE.format(table), (
+        target, source, source, os.path.dirname(target), target, source,
+        target.count("/") - source.count("/"), *_subtree_bounds(source))).rowcount
+    db.execute_sql(_SET_PARENTS.format(table), _subtree_bounds(target))
+    add_to_ancestors([(target, *found)])
+    log.info("copied {} nodes".format(copied))
+
+
+# paths of moved or copied nodes keep their part after the path of the source node.
+# Parameters: target, source, source, parent of target, target, source, depth delta, `_subtree_bounds` of source
+_NEW_PATHS = """
+    ? || substr(path, length(?) + 1),
+    CASE WHEN path = ? THEN ? ELSE ? || substr(parent_path, length(?) + 1) END,
+    depth + ?
+"""
+
+_MOVE_SUBTREE = """
+UPDATE "{{0}}" SET (path, parent_path, depth) = ({})
+WHERE path = ? OR (path > ? AND path < ?)
+""".format(_NEW_PATHS)
+
+_COPY_SUBTREE = """
+INSERT INTO "{{0}}" (path, parent_path, depth, bytes, is_dir, modified, size, content_hash, tree_bytes, tree_files)
+SELECT {}, bytes, is_dir, modified, size, content_hash, tree_bytes, tree_files FROM "{{0}}"
+WHERE path = ? OR (path > ? AND path < ?) ORDER BY path
+""".format(_NEW_PATHS)
+
+# parents are looked up by unique path index
+_SET_PARENTS = """
+UPDATE "{0}" SET parent_id = (SELECT parent.id FROM "{0}" AS parent WHERE parent.path = "{0}".parent_path)
+WHERE path = ? OR (path > ? AND path < ?)
+"""
 
 
+def release_blobs(content_hashes):
+    """Drop blobs of deleted files from deduplicated store unless other files still reference them"""
+    if options.upload_deduplicate:
+        fs.release_blobs(content_hash for content_hash in content_hashes if content_hash)
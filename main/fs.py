@@ -1,7 +1,17 @@
+import bisect
+import concurrent.futures
+import errno
+import fnmatch
+import hashlib
+import logging
+import mmap
 import os
+import stat
 import tempfile
+import time
 import urllib.parse
-from collections import OrderedDict
+import uuid
+from collections import OrderedDict, deque
 import datetime as d
 from pprint import pprint
 
@@ -10,6 +20,159 @@ from tornado.options import options
 import utils
 from pathlib import PurePath
 
+log = logging.getLogger("tornado.general")
+
+
+def staging_dir():
+    """Folder for files being uploaded, should be on the same filesystem as storage path"""
+    return (options.upload_staging_dir or os.path.join(options.storage_path, ".staging")).rstrip(os.path.sep)
+
+
+def preallocate(fd, size):
+    """Preallocate disk space for file if enabled, raise OSError if there is not enough of it"""
+    if size and options.upload_preallocate:
+        os.posix_fallocate(fd, 0, size)
+
+
+def blobs_dir():
+    """Content addressed store of deduplicated files, see `Worker.publish_deduplicated`"""
+    return os.path.join(options.storage_path.rstrip(os.path.sep), ".blobs")
+
+
+def blob_path(content_hash):
+    return os.path.join(blobs_dir(), content_hash[:2], content_hash)
+
+
+def release_blobs(content_hashes):
+    """
+    Remove blobs which are not linked from the tree anymore. Number of hard links
+    of the blob is its reference count: the blob itself plus files with its contents
+    """
+    for content_hash in content_hashes:
+        blob = blob_path(content_hash)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+
+def sweep_blobs(inodes=None):
+    """
+    Remove all unreferenced blobs, e.g. left after files were deleted bypassing the app
+    :param inodes(set): only blobs with these inode numbers
+    """
+    try:
+        folders = os.listdir(blobs_dir())
+    except FileNotFoundError:
+        return
+    for folder in folders:
+        names = os.listdir(os.path.join(blobs_dir(), folder))
+        if inodes is not None:
+            names = [name for name in names if os.stat(blob_path(name)).st_ino in inodes]
+        release_blobs(names)
+
+
+def trash_dir():
+    """Deleted folders waiting to be emptied by `Reaper`, on the same filesystem as the tree"""
+    return os.path.join(options.storage_path.rstrip(os.path.sep), ".trash")
+
+
+def move_to_trash(path):
+    """
+    Atomically move folder out of the tree
+    :raise OSError: EXDEV if the folder is on another filesystem (mounted inside of storage)
+    :return: path of the folder in trash
+    """
+    os.makedirs(trash_dir(), exist_ok=True)
+    trashed = os.path.join(trash_dir(), uuid.uuid4().hex)
+    os.rename(path, trashed)
+    return trashed
+
+
+def internal_dirs():
+    """Service folders, they are hidden from listings and not accessible by uri"""
+    return {staging_dir(), blobs_dir(), trash_dir()}
+
+
+class Reaper:
+    """
+    Empties trash on its own thread: folders are removed bottom up, at most `rate` entries
+    (files and folders) per second, so removal of a huge tree doesn't starve requests of disk
+    """
+    BATCH = 100
+
+    def __init__(self, rate):
+        """:param rate(int): entries removed per second, 0 for no limit"""
+        self.rate = rate
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="reaper")
+        self._batch_started = time.monotonic()
+        self.trashed = 0
+        self.emptied = 0
+        self.removed = 0
+        self.failures = 0
+
+    def empty(self, trashed):
+        """Remove folder moved to trash (see `move_to_trash`) in background, return future"""
+        self.trashed += 1
+        return self._executor.submit(self._remove_tree, trashed)
+
+    def sweep(self):
+        """Empty folders left in trash by stopped server"""
+        try:
+            names = os.listdir(trash_dir())
+        except FileNotFoundError:
+            return
+        for name in names:
+            self.empty(os.path.join(trash_dir(), name))
+
+    def stats(self):
+        return OrderedDict([
+            ("pending", self.trashed - self.emptied),
+            ("emptied", self.emptied),
+            ("removed", self.removed),
+            ("failures", self.failures),
+        ])
+
+    def _remove_tree(self, top):
+        """Runs on reaper thread"""
+        linked = set()  # inodes of files with other hard links, e.g. to deduplicated blobs
+        folders = [(top, False)]
+        try:
+            while folders:
+                folder, listed = folders.pop()
+                if listed:
+                    os.rmdir(folder)
+                    self._removed()
+                    continue
+                folders.append((folder, True))
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append((entry.path, False))
+                            continue
+                        if options.upload_deduplicate and entry.stat(follow_symlinks=False).st_nlink > 1:
+                            linked.add(entry.inode())
+                        os.remove(entry.path)
+                        self._removed()
+            if linked:
+                # blobs of the files were not released when they were deleted from db index
+                sweep_blobs(linked)
+        except OSError as e:
+            self.failures += 1
+            log.error("Failed to empty %s from trash, it is emptied again after restart: %s", top, e)
+        finally:
+            self.emptied += 1
+
+    def _removed(self):
+        self.removed += 1
+        if self.rate and self.removed % self.BATCH == 0:
+            pause = self._batch_started + self.BATCH / self.rate - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            self._batch_started = time.monotonic()
+
+
 class Path:
     def __init__(self, uri="", abspath=""):
         if not any((uri, abspath)): raise ValueError("either uri or abspath should be provided to constructor")
@@ -32,6 +195,13 @@ class Path:
             self._public_path = self._abspath[len(self._base_dir):] or self._uri_based
         return self._public_path
 
+    @property
+    def db_path(self):
+        """Path of the node as it is stored in db: no trailing slash, root is '/'"""
+        if not self._db_path:
+            self._db_path = self.abspath[len(self._base_dir):] or "/"
+        return self._db_path
+
     @property
     def base_dir(self):
         return self._base_dir
@@ -44,19 +214,317 @@ class Path:
     def validate(self):
         assert os.path.isabs(self.abspath) and os.path.commonpath((self.abspath, self._base_dir)) == self._base_dir
 
+    def is_public(self):
+        """False for paths outside of storage and inside of service folders (see `internal_dirs`)"""
+        if os.path.commonpath((self.abspath, self._base_dir)) != self._base_dir:
+            return False
+        return not any(self.abspath == folder or self.abspath.startswith(folder + os.path.sep)
+                       for folder in internal_dirs())
+
     def work_with_file(self):
         return self._uri_based[-1] != "/"
 
 
+def page(names, limit=None, cursor=None):
+    """
+    Return stable (sorted by name) page of `names` following `cursor`
+    and cursor for the next page (None if this is the last one)
+    """
+    names = sorted(names)
+    if cursor is not None:
+        names = names[bisect.bisect_right(names, cursor):]
+    if limit is not None and len(names) > limit:
+        return names[:limit], names[limit - 1]
+    return names, None
+
+
+def mapped_chunks(abspath, start=None, end=None, chunk_size=1024 * 1024):
+    """
+    Yield memoryviews of `[start:end)` range of mmap-ed file, they are sent straight
+    from page cache to socket. Files in storage are never modified in place (uploads are
+    published by rename), so the mapping can't be truncated under the reader
+    """
+    with open(abspath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start, end = start or 0, size if end is None else min(end, size)
+        if start >= end:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        for offset in range(start, end, chunk_size):
+            yield view[offset:min(offset + chunk_size, end)]
+    finally:
+        view = None
+        try:
+            mapped.close()
+        except BufferError:
+            # some chunk is still referenced, mapping is released with the last of them
+            pass
+
+
+def file_hash(fd, size, block_size=1024 * 1024):
+    """sha256 of the first `size` bytes of opened file"""
+    content_hash = hashlib.sha256()
+    for offset in range(0, size, block_size):
+        content_hash.update(os.pread(fd, min(block_size, size - offset), offset))
+    return content_hash
+
+
+_copy_executor = None
+
+
+def copy_executor():
+    """Threads copying files and folders (COPY requests), not to take writer threads of uploads"""
+    global _copy_executor
+    if _copy_executor is None:
+        _copy_executor = concurrent.futures.ThreadPoolExecutor(options.copy_threads, thread_name_prefix="copy")
+    return _copy_executor
+
+
+def copy_range(src, dst, size, block_size=1024 * 1024):
+    """
+    Copy the first `size` bytes of opened file `src` to `dst` in kernel with `os.copy_file_range`,
+    filesystems with reflinks (btrfs, XFS) share extents instead of copying them.
+    Blocks are streamed through user space where it is not supported
+    """
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src, dst, size - offset, offset, offset)
+                if not copied:
+                    return
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while offset < size:
+        block = os.pread(src, min(block_size, size - offset), offset)
+        if not block:
+            return
+        BufferedWriter._pwrite(dst, block, offset)
+        offset += len(block)
+
+
+def copy_file(source, target, content_hash=None):
+    """
+    Copy file keeping its modification time, so content hash stored in db index stays valid.
+    Deduplicated files are never changed in place, so copy of a file linked to its blob is one
+    more hard link of the same contents. Other files are copied by bytes
+    :param content_hash(str): sha256 of contents of the file stored in db index
+    """
+    stat_info = os.lstat(source)
+    if stat.S_ISLNK(stat_info.st_mode):
+        os.symlink(os.readlink(source), target)
+        return
+    if options.upload_deduplicate and content_hash and is_blob(stat_info, content_hash):
+        try:
+            os.link(source, target)
+            return
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        copy_range(src.fileno(), dst.fileno(), stat_info.st_size)
+    os.utime(target, ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns))
+
+
+def is_blob(stat_info, content_hash):
+    """File of `stat_info` is a hard link to the blob of `content_hash`"""
+    if stat_info.st_nlink < 2:
+        return False
+    try:
+        blob = os.stat(blob_path(content_hash))
+    except OSError:
+        return False
+    return (blob.st_ino, blob.st_dev) == (stat_info.st_ino, stat_info.st_dev)
+
+
+def copy_tree(source, target, content_hashes=None):
+    """
+    Copy file or folder with all its contents (see `copy_file`), folders are read with `os.scandir`
+    :param content_hashes(dict): absolute path -> sha256 of contents of files stored in db index
+    """
+    content_hashes = content_hashes or {}
+    if not os.path.isdir(source) or os.path.islink(source):
+        copy_file(source, target, content_hashes.get(source))
+        return
+    folders = [(source, target)]
+    copied = []
+    while folders:
+        folder, copy = folders.pop()
+        os.mkdir(copy)
+        copied.append((folder, copy))
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append((entry.path, os.path.join(copy, entry.name)))
+                else:
+                    copy_file(entry.path, os.path.join(copy, entry.name), content_hashes.get(entry.path))
+    # entries created in copied folders changed their modification times
+    for folder, copy in copied:
+        stat_info = os.stat(folder)
+        os.utime(copy, ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns))
+
+
+def build_tree(walk):
+    """Assemble nested tree from pre-order (level, node, expanded) walk"""
+    tree = None
+    expanded_nodes = []
+    for level, node, expanded in walk:
+        del expanded_nodes[level:]
+        if expanded_nodes:
+            expanded_nodes[-1]['children'].append(node)
+        else:
+            tree = node
+        if expanded:
+            node['children'] = []
+            expanded_nodes.append(node)
+    return tree
+
+
+class BufferedWriter:
+    """
+    Coalesce uploaded chunks into `buffer_size` blocks and write them with `os.pwrite`
+    on a thread pool, so the IOLoop never waits for the disk. At most `max_pending`
+    blocks are in flight, `write` returns a future to wait for when the disk falls behind.
+    """
+    _executor = None
+
+    def __init__(self, fd, buffer_size, max_pending, offset=0):
+        self.fd = fd
+        self.buffer_size = buffer_size
+        self.max_pending = max_pending
+        self.offset = offset  # where the next block will be written
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._error = None
+
+    @classmethod
+    def executor(cls):
+        if cls._executor is None:
+            cls._executor = concurrent.futures.ThreadPoolExecutor(options.upload_writer_threads)
+        return cls._executor
+
+    @property
+    def written(self):
+        """Number of bytes accepted so far"""
+        return self.offset + len(self._buffer)
+
+    def write(self, chunk):
+        """
+        Buffer the chunk, submit full blocks for writing
+        :return: None or future to wait for before writing more
+        :raise OSError: if one of the previous blocks failed to be written
+        """
+        self._check()
+        self._buffer += chunk
+        while len(self._buffer) >= self.buffer_size:
+            block, self._buffer = self._buffer, self._buffer[self.buffer_size:]
+            del block[self.buffer_size:]
+            self._submit(block)
+        while self._pending and self._pending[0][0].done():
+            self._pending.popleft()
+        if len(self._pending) >= self.max_pending:
+            return self._pending[0][0]
+        return None
+
+    def flush(self, func=None, *a):
+        """
+        Submit what is left in buffer, return future resolved when everything is on disk
+        and optional `func` is called on the writer thread. Write errors are raised by the future
+        """
+        self._check()
+        if self._buffer:
+            self._submit(self._buffer)
+            self._buffer = bytearray()
+
+        def check_and_call(pending):
+            for future, _, _ in pending:
+                if future.exception() is not None:
+                    raise future.exception()
+            return func(*a) if func is not None else None
+
+        return self.when_idle(check_and_call)
+
+    def abort(self, func, *a, keep_buffered=False):
+        """
+        Drop buffered data (or write it if `keep_buffered`) and call `func(saved, *a)` (e.g. to close the file)
+        when writes in flight are finished. `saved` is where successfully written data ends, None if it is unknown
+        """
+        if keep_buffered and self._buffer and self._error is None:
+            self._submit(self._buffer)
+        self._buffer = bytearray()
+        offset = self.offset
+
+        def saved_and_call(pending):
+            saved = pending[0][1] if pending else offset
+            for future, _, end in pending:
+                if future.exception() is not None:
+                    break
+                saved = end
+            return func(None if self._error is not None else saved, *a)
+
+        return self.when_idle(saved_and_call)
+
+    def when_idle(self, func):
+        """
+        Call `func(pending)` on the writer thread after all submitted blocks are written,
+        `pending` are (future, start, end) of blocks which were in flight.
+        Executor queue is FIFO, so all of them are taken by the time func is taken
+        """
+        pending = list(self._pending)
+        self._pending.clear()
+
+        def wait_and_call():
+            concurrent.futures.wait([future for future, _, _ in pending])
+            return func(pending)
+
+        return self.executor().submit(wait_and_call)
+
+    def _submit(self, block):
+        future = self.executor().submit(self._pwrite, self.fd, block, self.offset)
+        future.add_done_callback(self._done)
+        self._pending.append((future, self.offset, self.offset + len(block)))
+        self.offset += len(block)
+
+    def _done(self, future):
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    @staticmethod
+    def _pwrite(fd, block, offset):
+        view = memoryview(block)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+
 class Worker:
     MODIFIED_DATETIME_FORMAT = "%a, %d %b %Y %H:%M:%S"
-    TEMP_FILE_DIR = '/tmp'
+    NODE_FIELDS = ('path', 'bytes', 'size', 'modified', 'is_dir')
 
     def __init__(self, uri, openfile=False):
         self.path = Path(uri)
         self._fo = None
+        self._writer = None
+        self.expected_size = None  # of uploaded file, e.g. from Content-Length
+        self.resumable = False
+        self.content_hash = None  # sha256 of uploaded file, known after `flush_file`
+        self._hash = None
         self._updated_path_root = None
         self._updates = None
+        self._stats = {}
+        self.trashed = None  # deleted folder moved to trash, see `rm_dirs`
 
     @property
     def updates(self):
@@ -82,54 +550,283 @@ class Worker:
         """Answers to the question are we working with file (True if file, False if Dir)"""
         return self.path.work_with_file()
 
-    def open_file(self):
+    def stat(self, path):
+        """
+        `os.stat` memoized for the lifetime of the worker (i.e. one request),
+        so every path is queried at most once. Call `forget` after changing the path
+        """
+        try:
+            result = self._stats[path]
+        except KeyError:
+            try:
+                result = os.stat(path)
+            except (FileNotFoundError, NotADirectoryError) as e:
+                result = e
+            self._stats[path] = result
+        if isinstance(result, OSError):
+            raise type(result)(result.errno, result.strerror, path)
+        return result
+
+    def forget(self, *paths):
+        """Drop memoized stat info of changed paths"""
+        for path in paths:
+            self._stats.pop(path, None)
+
+    def isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def isfile(self, path):
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def open_file(self, staged=None, offset=0):
+        """
+        Open file in staging folder. If `expected_size` is known, space is preallocated
+        to avoid fragmentation and to fail early if there is not enough of it.
+        Existing `staged` file (of resumable upload) is reopened to continue writing from `offset`,
+        it is kept when upload is interrupted
+        """
         if not self._fo:
-            if os.path.isfile(self.path.abspath):
+            if self.isfile(self.path.abspath):
                 raise FileExistsError
-            self._fo = tempfile.NamedTemporaryFile(
-                'wb', dir=Worker.TEMP_FILE_DIR, delete=False)
+            if staged is None:
+                os.makedirs(staging_dir(), exist_ok=True)
+                self._fo = tempfile.NamedTemporaryFile('wb', dir=staging_dir(), delete=False)
+                self._hash = hashlib.sha256()
+                try:
+                    preallocate(self._fo.fileno(), self.expected_size)
+                except OSError:
+                    self._discard(self._fo)
+                    self._fo = None
+                    raise
+            else:
+                self._fo = open(staged, 'r+b')
+                self.resumable = True
+            self._writer = BufferedWriter(self._fo.fileno(),
+                                          1024 * options.upload_buffer_size,
+                                          options.upload_max_pending_buffers,
+                                          offset)
 
+    @property
+    def written(self):
+        """Size of uploaded file so far"""
+        return self._writer.written if self._writer else 0
 
     def save_file_chunk(self, chunk):
+        """Return None or future to wait for before saving more chunks (disk falls behind)"""
         if not self._fo:
             self.open_file()
-        self._fo.write(chunk)
+        if self._hash is not None:
+            self._hash.update(chunk)
+        return self._writer.write(chunk)
+
+    def flush_file(self):
+        """
+        Return future resolved when all saved chunks are on disk: preallocated
+        space beyond written data is cut off and file is fsync-ed if configured
+        """
+        self.open_file()
+        return self._writer.flush(self._finalize, self._fo.fileno(), self._writer.written)
+
+    def _finalize(self, fd, size):
+        if self.expected_size and self.expected_size != size and options.upload_preallocate and not self.resumable:
+            os.ftruncate(fd, size)
+        if options.upload_fsync in ('file', 'full'):
+            os.fsync(fd)
+        if self._hash is not None:
+            self.content_hash = self._hash.hexdigest()
+        elif size == self.expected_size:
+            # resumable upload is received by parts in different requests, it is hashed when the last one is received
+            self.content_hash = file_hash(fd, size).hexdigest()
 
     def close_file(self, interrupted=False):
-
+        """
+        Publish uploaded file, or discard it if upload was interrupted. Call `flush_file` first.
+        Interrupted resumable upload is kept, future resolved with saved size is returned for it
+        """
         if self._fo is not None:
-            tempname = self._fo.name
-            self._fo.close()
-            if not interrupted:
+            fo, self._fo = self._fo, None
+            if interrupted:
+                if self.resumable:
+                    return self._writer.abort(self._close, fo, keep_buffered=True)
+                self._writer.abort(lambda saved: self._discard(fo))
+                return None
+            fo.close()
+            self.path._create_dir_for_file = True
+            try:
                 try:
-                    self.path._create_dir_for_file = True
-                    try:
-                        self.create_folder()
-                    except FileExistsError: pass
-                    finally:
-                        os.rename(tempname, self.path.abspath)
-                except FileNotFoundError: pass
+                    self.create_folder()
+                except FileExistsError: pass
+                if options.upload_deduplicate and self.content_hash:
+                    self.publish_deduplicated(fo.name, self.path.abspath, self.content_hash)
+                else:
+                    self.publish(fo.name, self.path.abspath)
+            except OSError:
+                self._discard(fo)
+                raise
+            finally:
+                self.forget(self.path.abspath, os.path.dirname(self.path.abspath))
+
+    @staticmethod
+    def publish(staged, target):
+        """
+        Atomically move staged file into storage, never replacing existing file.
+        Hard link fails with FileExistsError if target was created meanwhile
+        """
+        try:
+            os.link(staged, target)
+        except (PermissionError, NotImplementedError) as e:
+            # filesystem doesn't support hard links
+            if os.path.lexists(target):
+                raise FileExistsError(target) from e
+            os.rename(staged, target)
+        else:
+            os.remove(staged)
+
+    @classmethod
+    def publish_deduplicated(cls, staged, target, content_hash):
+        """
+        Publish staged file as a hard link to the blob with its contents. Staged file becomes
+        the blob if there is no such contents in storage yet, otherwise it is dropped
+        """
+        blob = blob_path(content_hash)
+        while True:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(staged, blob)
+            except FileExistsError:
+                pass  # the same contents are stored already
+            try:
+                os.link(blob, target)
+            except FileNotFoundError:
+                if os.path.exists(blob):
+                    raise
+                # the blob was released by deletion of its last file in between, staged file becomes the blob
+                continue
+            except OSError as e:
+                if e.errno != errno.EMLINK:
+                    raise
+                # too many files with the same contents for one inode, store this one separately
+                cls.publish(staged, target)
+            else:
+                os.remove(staged)
+            return
+
+    def sync_published(self):
+        """Return None or future resolved when folder of published file is fsync-ed (fsync = full)"""
+        if options.upload_fsync != 'full':
+            return None
+
+        def fsync_folder(path):
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        return BufferedWriter.executor().submit(fsync_folder, os.path.dirname(self.path.abspath))
+
+    @staticmethod
+    def _close(saved, fo):
+        fo.close()
+        return saved
+
+    @staticmethod
+    def _discard(fo):
+        fo.close()
+        try:
+            os.remove(fo.name)
+        except FileNotFoundError:
+            pass
 
     def create_folder(self):
         """Create folder, return path where was update"""
-        if os.path.isdir(self.path.create_dir_path):
+        if self.isdir(self.path.create_dir_path):
             raise FileExistsError
         self.updated_path_root = self.mkdir_p()
 
     def remove_file_or_folder(self):
         self._updates = self.get_updated_info()
         try:
-            self.rm_dirs()
-        except NotADirectoryError:
-            self.rm_file()
+            if self.isdir(self.path.abspath):
+                self.rm_dirs()
+            else:
+                self.rm_file()
         finally:
-            if self.path.abspath not in self.path.base_dir:
-                self._updates['modified'] = d.datetime.fromtimestamp(os.path.getmtime(self.updated_path_root)).strftime(
-                    self.MODIFIED_DATETIME_FORMAT)
+            self._removed()
+
+    def _removed(self):
+        """The node was taken out of its parent folder, `modified` of the parent in `updates` chain is changed"""
+        self.forget(self.path.abspath, self.updated_path_root)
+        if self.path.abspath not in self.path.base_dir:
+            self._updates['modified'] = d.datetime.fromtimestamp(self.stat(self.updated_path_root).st_mtime).strftime(
+                self.MODIFIED_DATETIME_FORMAT)
+
+    def move_to(self, target):
+        """
+        Rename the file or folder to path of `target` (Worker), never replacing existing node there.
+        `updates` is the chain of the node before it was moved (see `remove_file_or_folder`),
+        `target.updates` is the chain of the destination
+        """
+        self._updates = self.get_updated_info()
+        if os.path.lexists(target.path.abspath):
+            raise FileExistsError(errno.EEXIST, "Destination exists", target.path.abspath)
+        try:
+            os.rename(self.path.abspath, target.path.abspath)
+        finally:
+            self._removed()
+            target.forget(target.path.abspath, os.path.dirname(target.path.abspath))
+
+    def copy_to(self, target, content_hashes=None):
+        """
+        Copy the file or folder to path of `target` (Worker) on a thread of `copy_executor`, return future.
+        Copy is assembled in staging folder and published by one rename, so it appears in storage complete
+        or not at all
+        :param content_hashes(dict): db path -> sha256 of contents of files (see `db.content_hashes`)
+        """
+        content_hashes = {self.path.base_dir + path: content_hash
+                          for path, content_hash in (content_hashes or {}).items()}
+        if os.path.lexists(target.path.abspath):
+            raise FileExistsError(errno.EEXIST, "Destination exists", target.path.abspath)
+
+        def copy():
+            os.makedirs(staging_dir(), exist_ok=True)
+            staged = os.path.join(staging_dir(), uuid.uuid4().hex)
+            try:
+                copy_tree(self.path.abspath, staged, content_hashes)
+                if os.path.isdir(staged) and not os.path.islink(staged):
+                    if os.path.lexists(target.path.abspath):
+                        raise FileExistsError(errno.EEXIST, "Destination exists", target.path.abspath)
+                    os.rename(staged, target.path.abspath)
+                else:
+                    self.publish(staged, target.path.abspath)
+            except BaseException:
+                if os.path.isdir(staged) and not os.path.islink(staged):
+                    import shutil
+                    shutil.rmtree(staged, ignore_errors=True)
+                elif os.path.lexists(staged):
+                    os.remove(staged)
+                raise
+            finally:
+                target.forget(target.path.abspath, os.path.dirname(target.path.abspath))
+
+        return copy_executor().submit(copy)
 
     def rm_dirs(self):
-        import shutil
-        shutil.rmtree(self.path.abspath)
+        """Move folder to trash, it is emptied by `Reaper` in background"""
+        try:
+            self.trashed = move_to_trash(self.path.abspath)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            log.warning("%s is on another filesystem than trash. Removing it in place", self.path.abspath)
+            import shutil
+            shutil.rmtree(self.path.abspath)
 
     def rm_file(self):
         os.remove(self.path.abspath)
@@ -137,22 +834,15 @@ class Worker:
     def mkdir_p(self):
         prev = self.path.base_dir
         for cur in Worker.iterate_path(self.path.create_dir_path, root=self.path.base_dir):
-            if os.path.isdir(cur):
+            if self.isdir(cur):
                 prev = cur
             else:
                 os.makedirs(self.path.create_dir_path)
+                self.forget(*Worker.iterate_path(self.path.create_dir_path, root=self.path.base_dir))
                 break
         return prev
 
 
-    def lock_components(self):
-        """Return paths based on request uri, that has to be checked before performing writing ops"""
-        for path in Worker.iterate_path(self.path.public_path):
-            if path != "/":
-                yield path
-
-        yield (self.path.public_path + "/") if self.path.work_with_file() else (self.path.public_path.rstrip("/"))
-
     @staticmethod
     def iterate_path(top, root=None, trailing_slash=False, from_root_to_top=True):
         if not root:
@@ -170,49 +860,138 @@ class Worker:
 
 
 
-    def get_tree(self, full_tree=False):
-        import stat
-
-        def from_root_to_leafs(file_path):
-            current = OrderedDict()
-            stat_info = os.stat(file_path)
+    def get_tree(self, depth=None, limit=None, cursor=None, fields=None):
+        """
+        Walk the disk and build folder tree
+        :param depth(int): how many levels of children to include, None for the whole subtree
+        :param limit(int): max number of direct children of the root to include
+        :param cursor(str): name of the last child returned on previous page
+        :param fields(tuple): subset of `NODE_FIELDS` to include in every node, None for all
+        """
+        return build_tree(self.walk(depth, limit, cursor, fields))
+
+    def walk(self, depth=None, limit=None, cursor=None, fields=None):
+        """
+        Lazily walk folder tree in pre-order, arguments are the same as for `get_tree`.
+        Folders are read with `os.scandir`, so every entry is stat-ed at most once
+        and not stat-ed at all if only "path" and "is_dir" fields are requested
+        :yield: (level, node, expanded) where node is stat info without children
+                and expanded tells whether children of the node follow it
+        """
+        fields = fields or self.NODE_FIELDS
+        need_stat = not set(fields) <= {'path', 'is_dir'}
+        hidden = internal_dirs()
+
+        def from_root_to_leafs(file_path, level, entry=None):
+            try:
+                if entry is None:
+                    stat_info = self.stat(file_path)
+                    is_dir = stat.S_ISDIR(stat_info.st_mode)
+                else:
+                    stat_info = entry.stat() if need_stat else None
+                    is_dir = stat.S_ISDIR(stat_info.st_mode) if need_stat else entry.is_dir()
+            except FileNotFoundError:
+                if level == 0:
+                    raise
+                return  # removed while we were walking
+            current = self.node_info(file_path, stat_info, fields, is_dir)
+            if not is_dir or (depth is not None and level >= depth):
+                yield level, current, False
+                return
+            try:
+                with os.scandir(file_path) as it:
+                    entries = {entry.name: entry for entry in it if entry.path not in hidden}
+            except FileNotFoundError:
+                if level == 0:
+                    raise
+                entries = {}
+            names, next_cursor = page(entries, *((limit, cursor) if level == 0 else ()))
+            if next_cursor is not None:
+                current['next_cursor'] = next_cursor
+            yield level, current, True
+            for name in names:
+                yield from from_root_to_leafs(entries[name].path, level + 1, entries.pop(name))
+
+        return from_root_to_leafs(self.path.abspath, 0)
+
+    def usage(self):
+        """Bytes and number of files under the path, counted by walking the disk (see `db.usage`)"""
+        total_bytes = files = 0
+        for _, node, _ in self.walk(fields=('bytes', 'is_dir')):
+            if not node['is_dir']:
+                total_bytes += node['bytes']
+                files += 1
+        return OrderedDict([
+            ("path", self.path.db_path),
+            ("bytes", total_bytes),
+            ("size", utils.sizeof_fmt(total_bytes)),
+            ("files", files),
+        ])
+
+    def search(self, name=None, contains=None, prefix=None, min_bytes=None, max_bytes=None,
+               modified_after=None, modified_before=None, is_dir=None, limit=100, cursor=None, fields=None):
+        """Walk the disk and find nodes inside of the folder, arguments and result are the same as of `db.search`"""
+        fields = fields or self.NODE_FIELDS
+
+        def matches(node):
+            node_name = os.path.basename(node['path'])
+            modified = d.datetime.strptime(node['modified'], self.MODIFIED_DATETIME_FORMAT)
+            return ((not name or fnmatch.fnmatchcase(node_name, name))
+                    and (not contains or contains.lower() in node_name.lower())
+                    and (not prefix or node_name.lower().startswith(prefix.lower()))
+                    and (min_bytes is None or node['bytes'] >= min_bytes)
+                    and (max_bytes is None or node['bytes'] <= max_bytes)
+                    and (modified_after is None or modified >= modified_after)
+                    and (modified_before is None or modified <= modified_before)
+                    and (is_dir is None or node['is_dir'] == is_dir))
+
+        walk = self.walk()
+        next(walk)
+        # walk is ordered by names of siblings, results are ordered by paths as in db
+        found = sorted((node for _, node, _ in walk if matches(node) and node['path'] > (cursor or "")),
+                       key=lambda node: node['path'])
+        result = OrderedDict([
+            ("path", self.path.db_path),
+            ("results", [OrderedDict((field, node[field]) for field in fields) for node in found[:limit]]),
+        ])
+        if len(found) > limit:
+            result['next_cursor'] = found[limit - 1]['path']
+        return result
+
+    def node_info(self, file_path, stat_info, fields=None, is_dir=None):
+        """
+        Format stat info of a single node, children are not included.
+        `stat_info` may be None if only "path" and "is_dir" fields are requested and `is_dir` is known
+        """
+        fields = fields or self.NODE_FIELDS
+        current = OrderedDict()
+        if 'path' in fields:
             current['path'] = file_path[len(self.path.base_dir):] or "/"
+        if 'bytes' in fields:
             current['bytes'] = stat_info.st_size
+        if 'size' in fields:
             current['size'] = utils.sizeof_fmt(stat_info.st_size)
+        if 'modified' in fields:
             current['modified'] = d.datetime.fromtimestamp(stat_info.st_mtime).strftime(self.MODIFIED_DATETIME_FORMAT)
-            if stat.S_ISDIR(stat_info.st_mode):
-                current['is_dir'] = True
-                current['children'] = [from_root_to_leafs(os.path.join(file_path, x)) for x in os.listdir(file_path)]
-            else:
-                current['is_dir'] = False
-            return current
-
-        return from_root_to_leafs(self.path.abspath)
+        if 'is_dir' in fields:
+            current['is_dir'] = stat.S_ISDIR(stat_info.st_mode) if is_dir is None else is_dir
+        return current
 
     def get_updated_info(self):
-        import stat
         if not self.updated_path_root:
             self.updated_path_root = os.path.dirname(self.path.abspath)
         lower = self.updated_path_root
         upper = self.path.abspath
 
-        # TODO: can be optimized to query disk only once
         def from_leaf_to_root():
             children = []
             current = None
             for file_path in Worker.iterate_path(upper, lower):
-                current = OrderedDict()
-                stat_info = os.stat(file_path)
-                current['path'] = file_path[len(self.path.base_dir):] or "/"
-                current['bytes'] = stat_info.st_size
-                current['size'] = utils.sizeof_fmt(stat_info.st_size)
-                current['modified'] = d.datetime.fromtimestamp(stat_info.st_mtime).strftime(
-                    self.MODIFIED_DATETIME_FORMAT)
-                if stat.S_ISDIR(stat_info.st_mode):
-                    current['is_dir'] = True
+                current = self.node_info(file_path, self.stat(file_path))
+                if file_path == upper and self.content_hash:
+                    current['content_hash'] = self.content_hash
+                if current['is_dir']:
                     current['children'] = children
-                else:
-                    current['is_dir'] = False
                 children = current
             return current
 
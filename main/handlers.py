@@ -1,42 +1,246 @@
+import datetime
+import errno
 import http.client
+import itertools
+import json
 import logging
+import os
+import urllib.parse
 
+import tornado.gen
+import tornado.iostream
 import tornado.web
 import tornado.ioloop
 from tornado.options import options
 
+import archive
 import fs
 import db
+import locks
+import uploads
+import utils
 
 class BaseHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = tornado.web.RequestHandler.SUPPORTED_METHODS + ('MOVE', 'COPY')
+
+    @tornado.gen.coroutine
     def prepare(self):
         """Initialize all resources"""
         self.log = logging.getLogger("tornado.general")
-        self.fs = fs.Worker(self.request.uri)
+        self.fs = fs.Worker(self.request.path)
+        self.target = None  # fs.Worker of Destination of MOVE and COPY
+        self.lock = None
+        self.target_lock = None
+        self.reservation = None
+        self.db = db
+        if not self.fs.path.is_public():
+            self.send_error(403)
+            return
+        if self.request.method in ('MOVE', 'COPY') and not self.load_destination():
+            return
         if options.locking:
-            self.globlocks = self.application.locks
-            self.locks = set()
-            for path in self.fs.lock_components():
-                if path in self.globlocks:
-                    self.send_error(409, msg="Upload is conflicting with another pending upload on {}".format(path))
-                    break
-            self.locks = set(fs.Worker.iterate_path(self.fs.path.public_path))
-            self.locks.remove("/")
-            for path in self.locks:
-                self.globlocks[path] = 1
+            self.lock = self.application.locks.lock(self.fs.path.db_path, self.lock_mode())
+            if self.target is not None:
+                self.target_lock = self.application.locks.lock(self.target.path.db_path, locks.X)
+            try:
+                # in order of paths, so requests moving two nodes to each other don't wait for each other
+                for lock in sorted(filter(None, (self.lock, self.target_lock)), key=lambda lock: lock.path):
+                    yield lock.acquire(options.locking_timeout)
+            except locks.Conflict as e:
+                self.send_error(409, msg="Request is conflicting with another pending request on {}".format(e.path))
+                return
 
-        self.db = db
+        if not self._finished and self.request.method in ('PUT', 'POST', 'PATCH') and self.fs.work_with_file():
+            self.admit_upload()
+
+    def lock_mode(self):
+        """
+        Downloads (of archives of folders too) and copies share the file or folder, listings only
+        read entries of the folder, everything else changes the path
+        """
+        if self.request.method == 'COPY':
+            return locks.S
+        if self.request.method in ('GET', 'HEAD'):
+            if self.fs.work_with_file() or self.get_query_argument('archive', None) is not None:
+                return locks.S
+            return locks.IS
+        return locks.X
+
+    def load_destination(self):
+        """Parse Destination header of MOVE and COPY (path or absolute URL), send error if it is invalid"""
+        destination = self.request.headers.get('Destination')
+        if not destination:
+            self.send_error(400, msg="Destination header is required")
+            return False
+        self.target = fs.Worker(urllib.parse.urlsplit(destination).path or "/")
+        if not self.target.path.is_public():
+            self.send_error(403)
+            return False
+        source, target = self.fs.path.db_path, self.target.path.db_path
+        if source == target or source in locks.ancestors(target) or target in locks.ancestors(source):
+            self.send_error(409, msg="Destination must not be the same path, inside of it or containing it")
+            return False
+        return True
+
+    def admit_upload(self):
+        """
+        Reserve quota of folders containing uploaded file by its declared length
+        (Upload-Length of resumable upload), send 507 before the body is read if it doesn't fit
+        """
+        header = 'Upload-Length' if self.request.method == 'POST' else 'Content-Length'
+        length = self.request.headers.get(header, '')
+        try:
+            self.reservation = self.application.quotas.admit(
+                self.fs.path.db_path, int(length) if length.isdigit() else 0,
+                # file of resumable upload is checked when the session is started and
+                # reserved by the PATCH completing it, see `admit_file`
+                files=0 if self.request.method == 'PATCH' else 1)
+        except OSError as e:
+            self.send_error(507, msg=e.strerror)
 
+    def admit_file(self):
+        """
+        Reserve the file of resumable upload in quotas of folders containing it before it is published,
+        send 507 if it doesn't fit (the session keeps its offset, so upload can be completed later)
+        """
+        if self.reservation is None:
+            return True
+        try:
+            self.reservation.grow(self.reservation.bytes, files=1)
+        except OSError as e:
+            self.disk_error(e)
+            return False
+        return True
+
+    @tornado.gen.coroutine
     def delete(self, _=None):
         """Delete is basically the same for both files and folders"""
+        quotas = self.application.quotas
+        path = self.fs.path.db_path
+        usage = None
+        if quotas.covering(path) and self.fs.isdir(self.fs.path.abspath):
+            usage = yield self.usage()
         try:
             self.fs.remove_file_or_folder()
-            self.add_callback(self.db.file_or_folder_deleted, self.fs.updates)
+            if self.fs.trashed is not None:
+                self.application.reaper.empty(self.fs.trashed)
+            self.changed(self.db.file_or_folder_deleted, self.fs.updates)
             # self.write(self.fs.updates)
         except FileNotFoundError:
             self.send_error(404)
+            return
         except PermissionError:
             self.send_error(403)
+            return
+        if usage is not None:
+            quotas.removed(path, usage['bytes'], usage['files'])
+        else:
+            deleted = self.deleted_node()
+            quotas.removed(path, *((0, 0) if deleted['is_dir'] else (deleted['bytes'], 1)))
+
+    @tornado.gen.coroutine
+    def move(self, _=None):
+        """
+        Rename file or folder to the path in Destination header, its parent folder must exist and the path
+        must be free. Nothing is copied: one rename on disk and one update of the moved rows in db index
+        """
+        yield self.relocate(copy=False)
+
+    @tornado.gen.coroutine
+    def copy(self, _=None):
+        """Copy file or folder to the path in Destination header, see `move` and `fs.copy_file`"""
+        yield self.relocate(copy=True)
+
+    @tornado.gen.coroutine
+    def relocate(self, copy):
+        source, target = self.fs.path.db_path, self.target.path.db_path
+        is_dir = self.fs.isdir(self.fs.path.abspath)
+        if not is_dir and not self.fs.isfile(self.fs.path.abspath):
+            self.send_error(404)
+            return
+        if not self.target.isdir(os.path.dirname(self.target.path.abspath)):
+            self.send_error(409, msg="Parent folder of {} doesn't exist".format(target))
+            return
+        quotas = self.application.quotas
+        bytes = files = 0
+        if quotas.covering(target) or (not copy and (quotas.covering(source) or quotas.inside(source))):
+            if is_dir:
+                usage = yield self.usage()
+                bytes, files = usage['bytes'], usage['files']
+            else:
+                bytes, files = self.fs.stat(self.fs.path.abspath).st_size, 1
+        try:
+            self.reservation = quotas.admit(target, bytes, files, source=None if copy else source)
+        except OSError as e:
+            self.send_error(507, msg=e.strerror)
+            return
+        content_hashes = None
+        if copy and options.upload_deduplicate:
+            # files linked to their blobs are copied as hard links, see `fs.copy_file`
+            try:
+                content_hashes = yield self.db.read_fresh(source, self.db.content_hashes)
+            except self.db.OperationalError:
+                self.log.exception("Failed to read content hashes of %s from db. Copying it by bytes", source)
+        try:
+            if copy:
+                yield self.fs.copy_to(self.target, content_hashes)
+            else:
+                self.fs.move_to(self.target)
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        except (FileExistsError, NotADirectoryError):
+            self.send_error(409)
+            return
+        except PermissionError:
+            self.send_error(403)
+            return
+        except OSError as e:
+            self.disk_error(e)
+            return
+        if copy:
+            self.changed(self.db.file_or_folder_copied, source, self.target.updates, paths=(target,))
+        else:
+            self.changed(self.db.file_or_folder_moved, self.fs.updates, self.target.updates, paths=(source, target))
+            quotas.removed(source, bytes, files)
+        quotas.add(target, bytes, files)
+        yield self.reload_quotas(quotas.inside(target))
+        self.set_status(201)
+        self.write(self.target.updates)
+
+    @tornado.gen.coroutine
+    def reload_quotas(self, folders):
+        """Count usage of limited folders again, e.g. when they were moved or copied into place"""
+        for folder in folders:
+            worker = fs.Worker(folder + "/")
+            usage = {'bytes': 0, 'files': 0}
+            if worker.isdir(worker.path.abspath):
+                usage = yield self.usage(worker)
+            self.application.quotas.set(folder, usage['bytes'], usage['files'])
+
+    def deleted_node(self):
+        """The last node of updated chain is the deleted one, it was stat-ed before it was removed"""
+        node = self.fs.updates
+        while node.get('children'):
+            node = node['children']
+        return node
+
+    @tornado.gen.coroutine
+    def usage(self, worker=None):
+        """
+        Read aggregated totals of the folder from db index, count them on disk if folder is not indexed
+        :param worker(fs.Worker): of the folder, the requested one by default
+        """
+        worker = worker or self.fs
+        if options.listing_from_db:
+            try:
+                usage = yield self.db.read_fresh(worker.path.db_path, self.db.usage)
+                return usage
+            except self.db.DoesNotExist:
+                self.log.info("Folder %s is not indexed. Counting its usage on disk", worker.path.db_path)
+            except self.db.OperationalError:
+                self.log.exception("Failed to read usage of %s from db. Counting it on disk", worker.path.db_path)
+        return worker.usage()
 
     def write(self, chunk):
         """Override this method to have access over response body"""
@@ -55,12 +259,47 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def on_finish(self):
         """Add some logging, release resources"""
-        self.fs.close_file()
-        if self.locks:
-            for path in self.locks:
-                self.globlocks[path] -= 1
-                if self.globlocks[path] == 0:
-                    del self.globlocks[path]
+        self.fs.close_file(interrupted=True)
+        self.release_locks()
+        self.release_quota()
+
+    def on_connection_close(self):
+        """Client is gone: stop waiting for the lock, acquired one is released when the request is finished"""
+        if any(lock is not None and not lock.acquired for lock in (self.lock, self.target_lock)):
+            self.release_locks()
+
+    def release_locks(self):
+        for lock in (self.lock, self.target_lock):
+            if lock is not None:
+                lock.release()
+        self.lock = self.target_lock = None
+
+    def release_quota(self):
+        if self.reservation is not None:
+            self.reservation.release()
+            self.reservation = None
+
+    def changed(self, db_callback, *updates, paths=None):
+        """Queue change of the requested path (or of `paths`) to db and drop cached listings which include it"""
+        cache = self.application.cache
+        paths = paths or (self.fs.path.db_path,)
+
+        def invalidate():
+            for path in paths:
+                cache.invalidate(path)
+
+        invalidate()
+        # listings read from db before the change is written could be cached again
+        db_callback(*updates, invalidate)
+
+    def disk_error(self, error):
+        if error.errno in (errno.ENOSPC, errno.EDQUOT):
+            self.send_error(507, msg=error.strerror if error.errno == errno.EDQUOT else None)
+        elif error.errno == errno.EFBIG:
+            self.send_error(413)
+        else:
+            self.log.error("Failed to save %s: %s", self.fs.path.db_path, error)
+            self.send_error(500)
 
     def add_callback(self, callback, *a, **kw):
         tornado.ioloop.IOLoop.instance().add_callback(callback, *a, **kw)
@@ -74,43 +313,587 @@ class DirHandler(BaseHandler):
         """Create new directory with this method"""
         try:
             self.fs.create_folder()
-            self.add_callback(self.db.folder_created, self.fs.updates)
+            self.changed(self.db.folder_created, self.fs.updates)
             self.write(self.fs.updates)
         except (FileExistsError, NotADirectoryError):
             self.send_error(409)
         except PermissionError:
             self.send_error(403)
 
+    STREAM_FORMATS = {
+        'json': (utils.tree_to_json, "application/json; charset=UTF-8"),
+        'ndjson': (utils.tree_to_ndjson, "application/x-ndjson; charset=UTF-8"),
+    }
+
+    @tornado.gen.coroutine
     def get(self):
-        """Get dir tree and stat info"""
+        """
+        Get dir tree and stat info. Query arguments:
+        - depth: how many levels of children to include (whole subtree by default)
+        - limit, cursor: paginate direct children of the folder, ordered by name.
+          Pass `next_cursor` of the previous page as `cursor` to get the next one
+        - fields: comma separated subset of "path,bytes,size,modified,is_dir"
+        - stream: "json" or "ndjson" (one node per line) to send the tree
+          chunk by chunk while it is being walked
+        - usage: send total bytes and number of files in the subtree instead of the tree
+        - search: find nodes in the subtree instead of sending it, see `search_arguments`
+        - archive: "tar" or "zip" to download the folder with all its files as one archive,
+          compressed if "compress" is passed as well, see `send_archive`
+        """
         try:
-            # TODO: change to read from BD
-            self.write(self.fs.get_tree(full_tree=True))
+            if self.get_query_argument('archive', None) is not None:
+                yield self.send_archive(self.get_query_argument('archive'),
+                                        self.get_query_argument('compress', None) is not None)
+                return
+            if self.get_query_argument('usage', None) is not None:
+                usage = yield self.usage()
+                self.write(usage)
+                return
+            if self.get_query_argument('search', None) is not None:
+                found = yield self.search(**self.search_arguments())
+                self.write(found)
+                return
+            arguments = self.listing_arguments()
+            stream = self.get_query_argument('stream', None)
+            if stream is None:
+                tree = yield self.get_tree(**arguments)
+                self.write(tree)
+                return
+            if stream not in self.STREAM_FORMATS:
+                raise ValueError("'stream' must be one of: {}".format(", ".join(sorted(self.STREAM_FORMATS))))
+            walk = yield self.walk(**arguments)
+        except ValueError as e:
+            self.send_error(400, msg=str(e))
+            return
         except FileNotFoundError:
             self.send_error(404)
+            return
+
+        encode, content_type = self.STREAM_FORMATS[stream]
+        self.set_header("Content-Type", content_type)
+        chunks = encode(walk)
+        try:
+            while True:
+                # db walk queries each folder when it is reached, keep them off the IOLoop
+                chunk = yield self.db.read(next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.log.info("Client closed connection while streaming %s", self.fs.path.db_path)
+
+    @tornado.gen.coroutine
+    def send_archive(self, archive_format, compress):
+        """
+        Stream archive of the folder while it is walked on disk (see `archive.chunks`). The folder is
+        locked in shared mode until the archive is sent, so nothing inside of it is changed meanwhile
+        """
+        if archive_format not in archive.FORMATS:
+            raise ValueError("'archive' must be one of: {}".format(", ".join(sorted(archive.FORMATS))))
+        if not self.fs.isdir(self.fs.path.abspath):
+            raise FileNotFoundError(self.fs.path.abspath)
+        content_type, compressed_type, extension, compressed_extension = archive.FORMATS[archive_format]
+        name = (os.path.basename(self.fs.path.db_path) or "storage") + (compressed_extension if compress else extension)
+        self.set_header("Content-Type", compressed_type if compress else content_type)
+        self.set_header("Content-Disposition", "attachment; filename*=UTF-8''{}".format(urllib.parse.quote(name)))
+        chunks = archive.chunks(self.fs, archive_format, compress, 1024 * options.download_chunk_size)
+        try:
+            while True:
+                chunk = yield archive.executor().submit(next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.log.info("Client closed connection while downloading archive of %s", self.fs.path.db_path)
+        except OSError as e:
+            self.log.error("Failed to read archive of %s: %s", self.fs.path.db_path, e)
+            # client sees truncated response instead of complete but broken archive
+            self.request.connection.close()
+        finally:
+            chunks.close()
+
+    def listing_arguments(self):
+        """Parse and validate listing query arguments, raise ValueError on invalid ones"""
+        arguments = {}
+        for name in ('depth', 'limit'):
+            value = self.get_query_argument(name, None)
+            if value is not None:
+                if not value.isdigit() or (name == 'limit' and int(value) == 0):
+                    raise ValueError("'{}' must be a {} integer".format(
+                        name, "non negative" if name == 'depth' else "positive"))
+                arguments[name] = int(value)
+        arguments['cursor'] = self.get_query_argument('cursor', None)
+        fields = self.fields_argument()
+        if fields:
+            arguments['fields'] = fields
+        return arguments
+
+    def fields_argument(self):
+        """Validated subset of node fields from 'fields' query argument, None if it is not passed"""
+        fields = self.get_query_argument('fields', None)
+        if not fields:
+            return None
+        fields = tuple(field.strip() for field in fields.split(","))
+        unknown = set(fields) - set(fs.Worker.NODE_FIELDS)
+        if unknown:
+            raise ValueError("Unknown fields: {}".format(", ".join(sorted(unknown))))
+        # keep the order of fields the same as in full listing
+        return tuple(field for field in fs.Worker.NODE_FIELDS if field in fields)
+
+    SEARCH_LIMIT = 10000
+
+    def search_arguments(self):
+        """
+        Parse and validate search query arguments, raise ValueError on invalid ones:
+        - name: glob pattern of the whole name, e.g. "*.pdf" (case sensitive)
+        - contains, prefix: substring or prefix of the name (case insensitive)
+        - min_bytes, max_bytes: range of sizes
+        - modified_after, modified_before: range of modification times, e.g. "2016-06-29T10:37:12"
+        - type: "file" or "dir"
+        - limit (100 by default), cursor: paginate results ordered by path. Pass `next_cursor`
+          of the previous page as `cursor` to get the next one
+        - fields: same as for listings
+        """
+        arguments = {}
+        for name in ('name', 'contains', 'prefix', 'cursor'):
+            arguments[name] = self.get_query_argument(name, None) or None
+        for name in ('min_bytes', 'max_bytes', 'limit'):
+            value = self.get_query_argument(name, None)
+            if value is not None:
+                if not value.isdigit() or (name == 'limit' and not 0 < int(value) <= self.SEARCH_LIMIT):
+                    raise ValueError("'{}' must be a {} integer".format(
+                        name, "positive (up to {})".format(self.SEARCH_LIMIT) if name == 'limit' else "non negative"))
+                arguments[name] = int(value)
+        for name in ('modified_after', 'modified_before'):
+            value = self.get_query_argument(name, None)
+            if value is not None:
+                try:
+                    arguments[name] = datetime.datetime.fromisoformat(value).replace(microsecond=0)
+                except ValueError:
+                    raise ValueError("'{}' must be a date or time in ISO 8601 format".format(name))
+        node_type = self.get_query_argument('type', None)
+        if node_type is not None:
+            if node_type not in ('file', 'dir'):
+                raise ValueError("'type' must be 'file' or 'dir'")
+            arguments['is_dir'] = node_type == 'dir'
+        fields = self.fields_argument()
+        if fields:
+            arguments['fields'] = fields
+        return arguments
+
+    @tornado.gen.coroutine
+    def search(self, **arguments):
+        """Search db index, walk the disk only if folder is not indexed"""
+        if options.listing_from_db:
+            try:
+                found = yield self.db.read_fresh(self.fs.path.db_path, self.db.search, **arguments)
+                return found
+            except self.db.DoesNotExist:
+                self.log.info("Folder %s is not indexed. Searching it on disk", self.fs.path.db_path)
+            except self.db.OperationalError:
+                self.log.exception("Failed to search %s in db. Searching it on disk", self.fs.path.db_path)
+        found = yield self.db.read(self.fs.search, **arguments)
+        return found
+
+    @tornado.gen.coroutine
+    def get_tree(self, **arguments):
+        """Read tree from cache, db index or disk (if folder is not indexed) in that order"""
+        cache = self.application.cache
+        key = tuple(sorted(arguments.items()))
+        tree = cache.get(self.fs.path.db_path, key)
+        if tree is None:
+            generation = cache.generation
+            tree = yield self.read_tree(**arguments)
+            cache.put(self.fs.path.db_path, key, tree, generation)
+        return tree
+
+    @tornado.gen.coroutine
+    def read_tree(self, **arguments):
+        """Read tree from db index, walk the disk only if folder is not indexed"""
+        if options.listing_from_db:
+            try:
+                tree = yield self.db.read_fresh(self.fs.path.db_path, self.db.get_tree, **arguments)
+                return tree
+            except self.db.DoesNotExist:
+                self.log.info("Folder %s is not indexed. Reading it from disk", self.fs.path.db_path)
+            except self.db.OperationalError:
+                self.log.exception("Failed to read %s from db. Reading it from disk", self.fs.path.db_path)
+        return self.fs.get_tree(**arguments)
+
+    @tornado.gen.coroutine
+    def walk(self, **arguments):
+        """Same as `get_tree`, but returns lazy pre-order walk of the tree"""
+        if options.listing_from_db:
+            try:
+                walk = self.db.walk(self.fs.path.db_path, **arguments)
+                # get the root node now, so missing folder is reported before response is started
+                first = yield self.db.read_fresh(self.fs.path.db_path, lambda path: next(walk))
+                return itertools.chain([first], walk)
+            except self.db.DoesNotExist:
+                self.log.info("Folder %s is not indexed. Reading it from disk", self.fs.path.db_path)
+            except self.db.OperationalError:
+                self.log.exception("Failed to read %s from db. Reading it from disk", self.fs.path.db_path)
+        walk = self.fs.walk(**arguments)
+        return itertools.chain([next(walk)], walk)
 
 @tornado.web.stream_request_body
 class FileHandler(BaseHandler, tornado.web.StaticFileHandler):
-    def data_received(self, chunk):
-        """Receive uploaded files chunk by chunk"""
+    @tornado.gen.coroutine
+    def prepare(self):
+        """Open staging file before the body is received, to reject upload early"""
+        self.upload = None
+        self.stored_hash = None
+        yield super().prepare()
+        if self._finished:
+            return
+        if self.request.method in ('GET', 'HEAD', 'DELETE') or 'If-Match' in self.request.headers:
+            yield self.load_content_hash()
+        if 'Upload-Id' not in self.request.headers and not self.check_if_match():
+            self.send_error(412)
+            return
+        if self.request.method == 'PUT':
+            if self.request.headers.get('If-None-Match', '').strip() == '*' and self.fs.isfile(self.fs.path.abspath):
+                self.send_error(412)
+                return
+            if uploads.active(self.fs.path.db_path) is not None:
+                self.send_error(409, msg="There is resumable upload in progress on {}".format(self.fs.path.db_path))
+                return
+            self.fs.expected_size = int(self.request.headers.get('Content-Length', 0)) or None
+            self.open_file()
+        elif self.request.method == 'PATCH':
+            if not self.load_upload():
+                return
+            offset = self.request.headers.get('Upload-Offset', '')
+            if not offset.isdigit() or int(offset) != self.upload.offset:
+                self.set_header('Upload-Offset', self.upload.offset)
+                self.send_error(409, msg="Upload-Offset must be {}".format(self.upload.offset))
+                return
+            length = self.request.headers.get('Content-Length', '')
+            if length.isdigit() and int(offset) + int(length) >= self.upload.length and not self.admit_file():
+                return
+            self.fs.expected_size = self.upload.length
+            self.open_file(staged=self.upload.staged, offset=self.upload.offset)
+
+    def open_file(self, **kw):
         try:
-            self.fs.save_file_chunk(chunk)
-        except FileExistsError:
+            self.fs.open_file(**kw)
+        except (FileExistsError, NotADirectoryError):
             self.send_error(409)
-        except NotADirectoryError:
+        except OSError as e:
+            self.disk_error(e)
+
+    def load_upload(self):
+        """Find resumable upload session by Upload-Id header, send 404 if there is no such session"""
+        try:
+            self.upload = uploads.get(self.request.headers.get('Upload-Id', ''))
+        except KeyError:
+            self.send_error(404, msg="Upload session not found or expired")
+            return False
+        if self.upload.path != self.fs.path.db_path:
+            self.upload = None
+            self.send_error(404, msg="Upload session belongs to another path")
+            return False
+        return True
+
+    @tornado.gen.coroutine
+    def data_received(self, chunk):
+        """Receive uploaded files chunk by chunk, stop reading the body while disk falls behind"""
+        if self._finished or self.request.method not in ('PUT', 'PATCH'):
+            return
+        if self.upload is not None and self.fs.written + len(chunk) > self.upload.length:
+            self.send_error(413, msg="Upload-Length of {} bytes exceeded".format(self.upload.length))
+            return
+        try:
+            if self.reservation is not None:
+                # body without Content-Length (chunked) is admitted as it is received
+                self.reservation.grow(self.fs.written + len(chunk) - (self.upload.offset if self.upload else 0))
+            wait = self.fs.save_file_chunk(chunk)
+            if wait is not None:
+                yield wait
+        except (FileExistsError, NotADirectoryError):
             self.send_error(409)
+        except OSError as e:
+            self.disk_error(e)
 
+    @tornado.gen.coroutine
     def put(self, _):
         """Called when all chunks are received"""
-        # TODO: add update tree
         try:
-            self.fs.open_file()
-            self.fs.close_file()
-            self.add_callback(self.db.file_uploaded, self.fs.updates)
-            self.write(self.fs.updates)
+            yield self.fs.flush_file()
+            yield self.publish()
+        except (FileExistsError, NotADirectoryError):
+            self.send_error(409)
+        except OSError as e:
+            self.disk_error(e)
+
+    @tornado.gen.coroutine
+    def publish(self):
+        self.fs.close_file()
+        wait = self.fs.sync_published()
+        if wait is not None:
+            yield wait
+        self.changed(self.db.file_uploaded, self.fs.updates)
+        self.application.quotas.add(self.fs.path.db_path, self.fs.written, 1)
+        self.set_header('Etag', self.content_etag())
+        self.write(self.fs.updates)
+
+    def post(self, _):
+        """
+        Start resumable upload of the file, its size is passed in Upload-Length header.
+        Id of the upload session is returned in Upload-Id header, send the file
+        with PATCH requests then
+        """
+        length = self.request.headers.get('Upload-Length', '')
+        if not length.isdigit():
+            self.send_error(400, msg="Upload-Length header is required")
+            return
+        if int(length) > 1024 * 1024 * options.file_size_limit:
+            self.send_error(413)
+            return
+        if self.fs.isfile(self.fs.path.abspath) or self.fs.isdir(self.fs.path.abspath):
+            self.send_error(409)
+            return
+        try:
+            self.upload = uploads.create(self.fs.path.db_path, int(length))
         except FileExistsError:
+            self.send_error(409, msg="There is resumable upload in progress on {}".format(self.fs.path.db_path))
+            return
+        except OSError as e:
+            self.disk_error(e)
+            return
+        self.set_status(201)
+        self.set_upload_headers()
+        self.write(self.upload.info())
+
+    @tornado.gen.coroutine
+    def patch(self, _):
+        """
+        Continue resumable upload from Upload-Offset (must be equal to the offset saved on server).
+        File is published when all Upload-Length bytes are received
+        """
+        try:
+            yield self.fs.flush_file()
+            if self.fs.written < self.upload.length:
+                saved = yield self.fs.close_file(interrupted=True)
+                self.upload.saved(saved)
+                self.set_upload_headers()
+                self.set_status(204)
+                return
+            if not self.admit_file():
+                return
+            yield self.publish()
+            self.upload.discard()
+        except (FileExistsError, NotADirectoryError):
             self.send_error(409)
+        except OSError as e:
+            self.disk_error(e)
+
+    def head(self, path):
+        """Offset of resumable upload if Upload-Id header is passed, file headers otherwise"""
+        if 'Upload-Id' not in self.request.headers:
+            return super().head(path)
+        if self.load_upload():
+            self.set_upload_headers()
+            self.set_header('Cache-Control', 'no-store')
+
+    def delete(self, _=None):
+        """Cancel resumable upload if Upload-Id header is passed, delete the file otherwise"""
+        if 'Upload-Id' not in self.request.headers:
+            return super().delete()
+        if self.load_upload():
+            self.upload.discard()
+            self.set_status(204)
+
+    @classmethod
+    def get_content(cls, abspath, start=None, end=None):
+        """Read file by mmap-ed chunks instead of copying it into bytes"""
+        if not options.download_mmap:
+            return super().get_content(abspath, start, end)
+        return fs.mapped_chunks(abspath, start, end, 1024 * options.download_chunk_size)
+
+    def write(self, chunk):
+        """Memoryviews of mapped file are passed to connection as they are, see `flush`"""
+        if isinstance(chunk, memoryview) and not self._transforms:
+            self._mapped = chunk
+            return
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        super().write(chunk)
+
+    def flush(self, include_footers=False):
+        """RequestHandler joins written chunks into bytes, write mapped chunk after it to avoid copying"""
+        mapped, self._mapped = getattr(self, '_mapped', None), None
+        future = super().flush(include_footers)
+        if mapped is not None:
+            future = self.request.connection.write(mapped)
+        return future
+
+    def compute_etag(self):
+        """Upload sessions are not static files"""
+        if self.upload is not None:
+            return None
+        return self.content_etag()
+
+    def content_etag(self):
+        """
+        Strong ETag is sha256 of file contents computed on upload, so files are never read to get it.
+        Files which were not uploaded through the app get weak ETag built from their size and mtime
+        """
+        try:
+            stat_info = self.fs.stat(self.fs.path.abspath)
+        except OSError:
+            return None
+        content_hash = self.fs.content_hash or self.stored_hash
+        if content_hash is not None:
+            return '"{}"'.format(content_hash)
+        return 'W/"{:x}-{:x}"'.format(int(stat_info.st_mtime), stat_info.st_size)
+
+    @tornado.gen.coroutine
+    def load_content_hash(self):
+        """Read hash of existing file from db before ETag is needed, see `content_etag`"""
+        try:
+            stat_info = self.fs.stat(self.fs.path.abspath)
+        except OSError:
+            return
+        try:
+            self.stored_hash = yield self.db.read(self.db.content_hash, self.fs.path.db_path, stat_info.st_size,
+                                                  datetime.datetime.fromtimestamp(stat_info.st_mtime))
+        except self.db.OperationalError:
+            self.log.exception("Failed to read content hash of %s from db", self.fs.path.db_path)
+
+    def check_if_match(self):
+        """If-Match precondition, ETags are compared strongly: weak ones never match"""
+        if_match = self.request.headers.get('If-Match')
+        if if_match is None:
+            return True
+        etag = self.content_etag()
+        if etag is None:
+            return False
+        if if_match.strip() == '*':
+            return True
+        return not etag.startswith('W/') and etag in (tag.strip() for tag in if_match.split(','))
+
+    def set_upload_headers(self):
+        self.set_header('Upload-Id', self.upload.id)
+        self.set_header('Upload-Offset', self.upload.offset)
+        self.set_header('Upload-Length', self.upload.length)
+
+    def save_progress(self):
+        """Close file of interrupted upload, remember its offset if upload is resumable"""
+        saved = self.fs.close_file(interrupted=True)
+        if saved is not None and self.upload is not None:
+            upload = self.upload
+            tornado.ioloop.IOLoop.current().add_future(
+                saved, lambda future: future.exception() or upload.saved(future.result()))
+
+    def on_finish(self):
+        self.save_progress()
+        super().on_finish()
 
     def on_connection_close(self):
-        self.fs.close_file(interrupted=True)
+        """Upload is interrupted, on_finish is not called in this case"""
+        self.save_progress()
+        self.release_locks()
+        self.release_quota()
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        """Server internals counters, of the worker process serving the request and of the coordinator one"""
+        coordinator = self.application.coordinator
+        self.write({
+            "cache": self.application.cache.stats(),
+            "db": db.stats(),
+            "quotas": self.application.quotas.stats(),
+            "locks": self.application.locks.stats(),
+            "watcher": self.application.watcher.stats() if self.application.watcher else None,
+            "trash": self.application.reaper.stats(),
+            "coordinator": (yield coordinator.request("stats"))["stats"] if coordinator else None,
+        })
+
+
+class ChangesHandler(tornado.web.RequestHandler):
+    """Change feed for incremental sync of the tree, see `get`"""
+    MAX_LIMIT = 10000
+    MAX_WAIT = 300
+    HEARTBEAT = 15
+
+    write_error = BaseHandler.write_error
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Changes committed after cursor, ordered as they were committed. Query arguments:
+        - cursor: `cursor` of the previous response. Only the current cursor is returned without it
+        - path: changes inside of this folder only (and deletion of the folder or its parents)
+        - limit: max number of changes to return (1000 by default)
+        - wait: seconds to wait for changes if there are none yet (long polling)
+        - stream=sse: keep connection open and send changes as server-sent events as soon as they are
+          committed. `Last-Event-ID` header of reconnected event source is used as cursor
+        410 is returned if changes after cursor are not kept anymore, sync the whole tree then
+        """
+        try:
+            cursor, limit, path, wait = self.changes_arguments()
+            stream = self.get_query_argument('stream', None)
+            if stream not in (None, 'sse'):
+                raise ValueError("'stream' must be 'sse'")
+        except ValueError as e:
+            self.send_error(400, msg=str(e))
+            return
+        try:
+            found = yield db.read(db.changes, cursor, limit, path)
+            deadline = tornado.ioloop.IOLoop.current().time() + wait
+            while cursor is not None and not found['changes'] and tornado.ioloop.IOLoop.current().time() < deadline:
+                yield db.changes_written.wait(timeout=deadline)
+                found = yield db.read(db.changes, found['cursor'], limit, path)
+        except LookupError:
+            self.send_error(410, msg="Changes after cursor {} are not kept anymore".format(cursor))
+            return
+        if stream is None:
+            self.write(found)
+            return
+        self.set_header('Content-Type', "text/event-stream; charset=UTF-8")
+        self.set_header('Cache-Control', 'no-store')
+        try:
+            yield self.send_events(found, limit, path)
+        except tornado.iostream.StreamClosedError:
+            logging.getLogger("tornado.general").info("Change feed client disconnected")
+
+    @tornado.gen.coroutine
+    def send_events(self, found, limit, path):
+        """Send changes as events with their cursors as ids, wait for the next ones or send heartbeat comment"""
+        while True:
+            for change in found['changes']:
+                self.write("id: {}\nevent: change\ndata: {}\n\n".format(change['cursor'], json.dumps(change)))
+            if not found['changes']:
+                self.write(": heartbeat\n\n")
+            yield self.flush()
+            if len(found['changes']) < limit:
+                yield db.changes_written.wait(timeout=datetime.timedelta(seconds=self.HEARTBEAT))
+            try:
+                found = yield db.read(db.changes, found['cursor'], limit, path)
+            except LookupError:
+                self.write("event: reset\ndata: {}\n\n")
+                return
 
+    def changes_arguments(self):
+        """:return: cursor, limit, path, wait; raise ValueError on invalid arguments"""
+        cursor = self.request.headers.get('Last-Event-ID') or self.get_query_argument('cursor', None)
+        limit = self.get_query_argument('limit', '1000')
+        wait = self.get_query_argument('wait', '0')
+        if cursor is not None and not cursor.isdigit():
+            raise ValueError("'cursor' must be a non negative integer")
+        if not limit.isdigit() or not 0 < int(limit) <= self.MAX_LIMIT:
+            raise ValueError("'limit' must be a positive (up to {}) integer".format(self.MAX_LIMIT))
+        if not wait.isdigit() or int(wait) > self.MAX_WAIT:
+            raise ValueError("'wait' must be a non negative (up to {}) integer".format(self.MAX_WAIT))
+        path = self.get_query_argument('path', None)
+        if path is not None:
+            path = fs.Path(path)
+            if not path.is_public():
+                raise ValueError("'path' must be inside of storage")
+            path = path.db_path
+        return int(cursor) if cursor is not None else None, int(limit), path, int(wait)
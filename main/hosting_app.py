@@ -1,11 +1,17 @@
 import configparser
+import functools
 import logging
 import os
+import shutil
 import signal
+import sys
+import tempfile
 import time
+from collections import OrderedDict
 
 import tornado.gen
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
 import tornado.process
 import tornado.web
@@ -13,15 +19,38 @@ from tornado.httpserver import HTTPServer
 from tornado.options import define, options
 
 import config
-from handlers import FileHandler, DirHandler
+import coordinator
+import db
+import fs
+import locks
+import quota
+import uploads
+import watcher
+from cache import MetadataCache
+from handlers import FileHandler, DirHandler, StatsHandler, ChangesHandler
 
 _SHUTDOWN_TIMEOUT = 30
+_MAX_RESTARTS = 100
+
+
+def on_stop_signals(io_loop, handler):
+    """
+    Call `handler(signum)` on the IOLoop on SIGQUIT, SIGTERM and SIGINT. Signals are received by
+    the IOLoop, so it is woken up even if a signal is delivered to one of the worker threads
+    """
+    for signum in (signal.SIGQUIT, signal.SIGTERM, signal.SIGINT):
+        io_loop.asyncio_loop.add_signal_handler(signum, handler, signum)
 
 
 def make_safe_shutdownable(srv):
-    io_loop = srv.io_loop or tornado.ioloop.IOLoop.instance()
+    io_loop = tornado.ioloop.IOLoop.current()
+    stopping = []
 
-    def stop_handler(signum, stack_frm, *args, **keywords):
+    def stop_handler(signum):
+        if stopping:
+            # workers get both SIGINT of Ctrl+C and SIGTERM of the supervisor process
+            return
+        stopping.append(signum)
 
         logging.getLogger("tornado.general").warning(
             "{signame} signal received. Closing HTTP server. "
@@ -36,10 +65,12 @@ def make_safe_shutdownable(srv):
         def shutdown():
             def stop_loop():
                 now = time.time()
-                if now < deadline and (io_loop._callbacks or io_loop._timeouts or len(io_loop._handlers) > 1):
+                # connections are removed from the server when they are closed
+                if now < deadline and srv._connections:
                     io_loop.add_timeout(now + 1, stop_loop)
                 else:
-                    io_loop.stop()
+                    # write queued metadata changes before stopping
+                    io_loop.add_future(db.writer.flush(), lambda future: io_loop.stop())
 
             srv.stop()  # this may still disconnection backlogs at a low probability
             deadline = time.time() + _SHUTDOWN_TIMEOUT
@@ -47,14 +78,16 @@ def make_safe_shutdownable(srv):
 
         io_loop.add_callback(shutdown)
 
-    signal.signal(signal.SIGQUIT, stop_handler)  # SIGQUIT is send by our supervisord to stop this server.
-    signal.signal(signal.SIGTERM, stop_handler)  # SIGTERM is send by Ctrl+C or supervisord's default.
-    signal.signal(signal.SIGINT, stop_handler)
+    # SIGQUIT is send by our supervisord to stop this server.
+    # SIGTERM is send by Ctrl+C or supervisord's default.
+    on_stop_signals(io_loop, stop_handler)
 
 
 class Application(tornado.web.Application):
     def __init__(self):
         handlers = [
+            ('/_stats', StatsHandler),
+            ('/_changes', ChangesHandler),
             ('.*/', DirHandler),
             ('/(.+)', FileHandler, {"path": options.storage_path}),
         ]
@@ -63,16 +96,203 @@ class Application(tornado.web.Application):
         }
         super(Application, self).__init__(handlers, **settings)
         self.log = logging.getLogger("torando.general")
-        self.locks = dict()
+        self.locks = locks.LockManager()
+        self.cache = MetadataCache(1024 * 1024 * options.cache_max_memory)
+        self.reaper = fs.Reaper(options.trash_rate)
+        self.quotas = quota.Quotas(quota.parse_limits(options.quota_limits), shared=options.processes != 1)
+        # connection to the coordinator process in worker processes, see `serve_worker`
+        self.coordinator = None
+        self.watcher = watcher.Watcher(self, options.watch_delay) if options.watch_enabled else None
+
+
+def folder_usage(path):
+    """(bytes, files) in the folder from db index, counted on disk if folder is not indexed"""
+    try:
+        usage = db.read(db.usage, path).result()
+    except db.DoesNotExist:
+        usage = fs.Worker(path.rstrip("/") + "/").usage() if os.path.isdir(fs.Path(path).abspath) else None
+    return (usage['bytes'], usage['files']) if usage else (0, 0)
+
+
+def fork(target, *a):
+    """Run `target(*a)` in a child process exiting with its return value as status, return pid of the child"""
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 1
+    try:
+        status = target(*a) or 0
+    except Exception:
+        logging.getLogger("tornado.general").exception("Process %d failed", os.getpid())
+    finally:
+        # don't return into the loop of the supervisor process
+        logging.shutdown()
+        os._exit(status)
+
+
+def supervise(application, processes):
+    """
+    Fork the coordinator process and `processes` workers accepting connections on the same
+    listening socket, restart workers which die. SIGTERM, SIGINT and SIGQUIT stop the workers
+    gracefully (see `make_safe_shutdownable`) and then the coordinator, so it writes their changes
+    """
+    log = logging.getLogger("tornado.general")
+    sockets = tornado.netutil.bind_sockets(options.port)
+    folder = tempfile.mkdtemp(prefix="hosting_app-")
+    path = os.path.join(folder, "coordinator.sock")
+    unix_socket = tornado.netutil.bind_unix_socket(path)
+    # sqlite connections must not be used by forked processes
+    db.db.close()
+    supervisor = os.getpid()
+    workers = {}  # pid -> number of the worker
+    stopping = []
+
+    def stop_workers():
+        stopping.append(True)
+        # connections waiting in the backlog are refused when workers close their sockets too
+        for sock in sockets:
+            sock.close()
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def stop_handler(signum, stack_frm):
+        if os.getpid() == supervisor and not stopping:
+            log.warning("Signal %d received. Stopping %d workers", signum, len(workers))
+            stop_workers()
+
+    for signum in (signal.SIGQUIT, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop_handler)
+    coordinator_pid = fork(serve_coordinator, application, unix_socket)
+    for number in range(processes):
+        workers[fork(serve_worker, application, sockets, path)] = number
+    log.info("Started coordinator process %d and %d workers", coordinator_pid, processes)
+    restarts = status = 0
+    try:
+        while workers:
+            pid, code = os.wait()
+            code = os.waitstatus_to_exitcode(code)
+            if pid == coordinator_pid:
+                log.error("Coordinator process exited with status %d. Stopping workers", code)
+                coordinator_pid, status = None, 1
+                if not stopping:
+                    stop_workers()
+                continue
+            number = workers.pop(pid, None)
+            if number is None or stopping:
+                continue
+            restarts += 1
+            if restarts > _MAX_RESTARTS:
+                log.error("Too many restarts of workers. Stopping")
+                status = 1
+                stop_workers()
+                continue
+            log.warning("Worker %d (pid %d) exited with status %d. Restarting it", number, pid, code)
+            workers[fork(serve_worker, application, sockets, path)] = number
+        if coordinator_pid is not None:
+            os.kill(coordinator_pid, signal.SIGTERM)
+            _, code = os.waitpid(coordinator_pid, 0)
+            status = status or os.waitstatus_to_exitcode(code)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return status
+
+
+def serve_coordinator(application, unix_socket):
+    """Coordinator process: lock table and db writer of all workers, quotas loading, file watcher, leftover trash"""
+    io_loop = tornado.ioloop.IOLoop.current()
+    server = coordinator.Coordinator(application.locks, db.write, lambda: OrderedDict([
+        ("pid", os.getpid()),
+        ("workers", len(server.peers)),
+        ("writes", server.writes),
+        ("db", db.stats()),
+        ("locks", application.locks.stats()),
+        ("watcher", application.watcher.stats() if application.watcher else None),
+        ("trash", application.reaper.stats()),
+    ]))
+    # listings are cached by workers, changes found by the watcher are announced to them
+    application.cache = server
+
+    stopping = []
+
+    def stop():
+        # signal may be sent to the whole process group (Ctrl+C, systemd), workers still write their changes
+        if server.peers:
+            io_loop.call_later(0.1, stop)
+        else:
+            io_loop.add_future(db.writer.flush(), lambda future: io_loop.stop())
+
+    def stop_handler(signum):
+        if not stopping:
+            stopping.append(signum)
+            stop()
+
+    on_stop_signals(io_loop, stop_handler)
+    application.quotas.load(folder_usage)
+    if options.upload_deduplicate:
+        fs.sweep_blobs()
+    application.reaper.sweep()
+    # workers wait for replies to their first requests until usage of quotas is loaded
+    server.add_socket(unix_socket)
+    if application.watcher is not None:
+        application.watcher.start()
+    io_loop.start()
+
+
+def coordinator_changed(application, paths):
+    """Paths were changed by another worker or by the file watcher of the coordinator"""
+    for path in paths:
+        application.cache.invalidate(path)
+    db.changes_written.notify_all()
+
+
+@tornado.gen.coroutine
+def write_by_coordinator(client, queue):
+    """Sink of `db.writer` of worker processes, writes failed because db is locked are retried"""
+    try:
+        yield client.write(queue)
+    except coordinator.RemoteError as e:
+        if e.name == "OperationalError":
+            raise db.OperationalError(e.message)
+        raise
+
+
+def serve_worker(application, sockets, path):
+    """Worker process: serves requests with path locks and db writer of the coordinator listening at `path`"""
+    io_loop = tornado.ioloop.IOLoop.current()
+    client = coordinator.Client(path, functools.partial(coordinator_changed, application), io_loop.stop)
+    io_loop.run_sync(client.connect)
+    application.locks = application.coordinator = client
+    application.watcher = None
+    db.writer.sink = functools.partial(write_by_coordinator, client)
+    server = HTTPServer(application, max_buffer_size=1024 * 1024 * options.file_size_limit)
+    make_safe_shutdownable(server)
+    uploads.sweep()
+    tornado.ioloop.PeriodicCallback(uploads.sweep, 1000 * 60 * 10).start()
+    server.add_sockets(sockets)
+    io_loop.start()
+    # lost connection to the coordinator stops the loop too
+    return 1 if client.stream.closed() else 0
 
 
 def main():
     tornado.options.parse_command_line()
-    server = HTTPServer(Application(), max_buffer_size=1024 * 1024 * options.file_size_limit)
+    application = Application()
+    processes = options.processes or tornado.process.cpu_count()
+    if processes > 1:
+        return supervise(application, processes)
+    server = HTTPServer(application, max_buffer_size=1024 * 1024 * options.file_size_limit)
     make_safe_shutdownable(server)
+    application.quotas.load(folder_usage)
+    uploads.sweep()
+    if options.upload_deduplicate:
+        fs.sweep_blobs()
+    application.reaper.sweep()
+    tornado.ioloop.PeriodicCallback(uploads.sweep, 1000 * 60 * 10).start()
+    if application.watcher is not None:
+        application.watcher.start()
     server.listen(options.port)
     tornado.ioloop.IOLoop.instance().start()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Minimal ctypes binding of inotify(7): watch folders without dependencies"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+# see <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# written files are checked once they are closed, not on every write
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+_EVENT = struct.Struct("iIII")
+
+
+def parse_events(buffer):
+    """:yield: (watch descriptor, mask, cookie, name) of every event in `buffer` read from inotify fd"""
+    offset = 0
+    while offset < len(buffer):
+        wd, mask, cookie, length = _EVENT.unpack_from(buffer, offset)
+        offset += _EVENT.size
+        yield wd, mask, cookie, os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+        offset += length
+
+
+class Inotify:
+    """Minimal ctypes binding of inotify, raises OSError where it is not available"""
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, "inotify is not available") from e
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = self._call(init, IN_NONBLOCK | IN_CLOEXEC)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """:return(int): watch descriptor, the same one if the folder is watched already"""
+        return self._call(self._add_watch, self.fd, os.fsencode(path), mask, path=path)
+
+    def rm_watch(self, wd):
+        try:
+            self._call(self._rm_watch, self.fd, wd)
+        except OSError:
+            pass  # folder is gone and its watch is removed already
+
+    def read(self):
+        """:return(list): events available without blocking, see `parse_events`"""
+        try:
+            return list(parse_events(os.read(self.fd, 1024 * 1024)))
+        except BlockingIOError:
+            return []
+
+    def close(self):
+        os.close(self.fd)
+
+    @staticmethod
+    def _call(func, *a, path=None):
+        result = func(*a)
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return result
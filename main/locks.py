@@ -0,0 +1,179 @@
+"""
+Hierarchical reader/writer locks of paths, so conflicting requests (e.g. upload of /a/b/file
+and creation of file /a/b) don't run at the same time while unrelated ones do. A request locks
+its target path in shared (S) or exclusive (X) mode and every ancestor of the target in the
+matching intention mode (IS or IX), so a conflict is found by looking at depth + 1 paths only.
+Folder listings lock the folder in IS mode: they are not snapshots (files being uploaded are
+invisible until they are published), so they don't wait for writes inside of the folder
+"""
+from collections import Counter, OrderedDict
+
+import tornado.concurrent
+import tornado.ioloop
+
+IS, IX, S, X = "IS", "IX", "S", "X"
+
+COMPATIBLE = {
+    IS: {IS, IX, S},
+    IX: {IS, IX},
+    S: {IS, S},
+    X: set(),
+}
+
+INTENTION = {IS: IS, S: IS, IX: IX, X: IX}
+
+
+class Conflict(Exception):
+    """Lock can't be acquired because of lock of another request on `path`"""
+
+    def __init__(self, path):
+        super().__init__("Conflicting lock on {}".format(path))
+        self.path = path
+
+
+def ancestors(path):
+    """"/a/b" -> ["/", "/a"]"""
+    if path == "/":
+        return []
+    parts = path.split("/")[1:-1]
+    return ["/"] + ["/" + "/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+class Lock:
+    """Locks of one request: `mode` of the target path and intention locks of its ancestors"""
+
+    def __init__(self, manager, path, mode):
+        self.manager = manager
+        self.path = path
+        self.mode = mode
+        self.items = [(ancestor, INTENTION[mode]) for ancestor in ancestors(path)] + [(path, mode)]
+        self.acquired = False
+        self._future = None
+        self._timeout = None
+
+    def acquire(self, timeout=0):
+        """
+        :param timeout(float): seconds to wait for conflicting locks to be released, 0 not to wait
+        :return: future resolved when the lock is acquired, its exception is `Conflict` if it is not
+        """
+        return self.manager.acquire(self, timeout)
+
+    def release(self):
+        """Release acquired lock or stop waiting for it"""
+        self.manager.release(self)
+
+
+class LockManager:
+    """
+    Lock table of all requests: path -> counts of held modes. Waiting locks are granted
+    in order of arrival, and a new lock doesn't jump ahead of a conflicting waiting one,
+    so exclusive locks are not starved by a stream of shared ones
+    """
+
+    def __init__(self):
+        self._held = {}  # path -> Counter of modes
+        self._waiting = []  # locks in order of arrival
+        self.acquired = 0
+        self.waited = 0
+        self.conflicts = 0
+        self.timeouts = 0
+
+    def lock(self, path, mode):
+        """:param path(str): db path, see `fs.Path.db_path`"""
+        return Lock(self, path, mode)
+
+    def locked(self, path, mode=X):
+        """Is the path itself locked in `mode` by some request"""
+        return bool(self._held.get(path, {}).get(mode))
+
+    def acquire(self, lock, timeout=0):
+        """See `Lock.acquire`"""
+        future = tornado.concurrent.Future()
+        conflict = self._conflict(lock, self._waiting)
+        if conflict is None:
+            self._grant(lock)
+            future.set_result(lock)
+            return future
+        if not timeout:
+            self.conflicts += 1
+            future.set_exception(Conflict(conflict))
+            return future
+        self.waited += 1
+        lock._future = future
+        lock._timeout = tornado.ioloop.IOLoop.current().call_later(timeout, self._expire, lock, conflict)
+        self._waiting.append(lock)
+        return future
+
+    def release(self, lock):
+        if lock.acquired:
+            lock.acquired = False
+            for path, mode in lock.items:
+                held = self._held[path]
+                held[mode] -= 1
+                if not +held:
+                    del self._held[path]
+        elif lock in self._waiting:
+            self._waiting.remove(lock)
+            self._stop_waiting(lock, Conflict(lock.path))
+        else:
+            return
+        self._wake()
+
+    def stats(self):
+        return OrderedDict([
+            ("locked_paths", len(self._held)),
+            ("waiting", len(self._waiting)),
+            ("acquired", self.acquired),
+            ("waited", self.waited),
+            ("conflicts", self.conflicts),
+            ("timeouts", self.timeouts),
+        ])
+
+    def _conflict(self, lock, waiting=()):
+        """:return: path where `lock` conflicts with held locks or with `waiting` ones, None if it doesn't"""
+        for path, mode in lock.items:
+            held = self._held.get(path)
+            if held and any(count and other not in COMPATIBLE[mode] for other, count in held.items()):
+                return path
+        for other in waiting:
+            modes = dict(other.items)
+            for path, mode in lock.items:
+                if path in modes and modes[path] not in COMPATIBLE[mode]:
+                    return path
+        return None
+
+    def _grant(self, lock):
+        for path, mode in lock.items:
+            self._held.setdefault(path, Counter())[mode] += 1
+        lock.acquired = True
+        self.acquired += 1
+
+    def _wake(self):
+        """Grant waiting locks which don't conflict with held ones or with locks waiting before them"""
+        waiting = []
+        for lock in self._waiting:
+            if self._conflict(lock, waiting) is None:
+                self._grant(lock)
+                self._stop_waiting(lock)
+            else:
+                waiting.append(lock)
+        self._waiting = waiting
+
+    def _expire(self, lock, conflict):
+        if lock not in self._waiting:
+            return
+        self.timeouts += 1
+        self.conflicts += 1
+        self._waiting.remove(lock)
+        self._stop_waiting(lock, Conflict(self._conflict(lock) or conflict))
+        # locks waiting after this one may not conflict with the rest
+        self._wake()
+
+    @staticmethod
+    def _stop_waiting(lock, exception=None):
+        tornado.ioloop.IOLoop.current().remove_timeout(lock._timeout)
+        future, lock._future, lock._timeout = lock._future, None, None
+        if exception is None:
+            future.set_result(lock)
+        else:
+            future.set_exception(exception)
@@ -0,0 +1,185 @@
+"""
+Per folder quotas. Limits of bytes and files are set for folders, usage of every
+limited folder is kept in memory: loaded from db index on start and changed by
+uploads and deletes. Uploads in progress reserve their declared length, so
+concurrent uploads can't overfill a folder together. Worker processes (see `processes`
+option) keep usage in shared memory created before they are forked
+"""
+import contextlib
+import errno
+import logging
+import multiprocessing
+from collections import OrderedDict
+
+import utils
+
+log = logging.getLogger("tornado.general")
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """'10G' -> bytes, suffixes K, M, G and T are powers of 1024"""
+    value = value.strip().upper()
+    unit = value[-1:] if value[-1:] in UNITS else ""
+    number = value[:len(value) - len(unit)]
+    if not number.isdigit():
+        raise ValueError("Invalid size: {}".format(value))
+    return int(number) * UNITS[unit]
+
+
+def parse_limits(text):
+    """
+    :param text(str): lines of "folder max_bytes [max_files]", "-" stands for no limit
+    :raise ValueError: on invalid lines
+    :return(dict): db path of the folder -> (max bytes or None, max files or None)
+    """
+    limits = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) not in (2, 3) or not parts[0].startswith("/"):
+            raise ValueError("Invalid quota: {}".format(line))
+        max_bytes, max_files = (parts[1:] + ["-"])[:2]
+        limits[parts[0].rstrip("/") or "/"] = (
+            None if max_bytes == "-" else parse_size(max_bytes),
+            None if max_files == "-" else int(max_files),
+        )
+    return limits
+
+
+class Reservation:
+    """Bytes and files reserved in limited folders by one upload, see `Quotas.admit`"""
+
+    def __init__(self, quotas, folders, bytes, files):
+        self.quotas = quotas
+        self.folders = folders
+        self.bytes = bytes
+        self.files = files
+
+    def grow(self, bytes, files=None):
+        """
+        Reserve more bytes for upload which sent more than it declared
+        :param files(int): files to reserve in total (resumable upload adds its file when it is completed)
+        :raise OSError: EDQUOT if they don't fit
+        """
+        more_bytes = max(bytes - self.bytes, 0)
+        more_files = max((files or 0) - self.files, 0)
+        if not more_bytes and not more_files:
+            return
+        with self.quotas.lock:
+            self.quotas.check(self.folders, more_bytes, more_files)
+            self.quotas.reserve(self.folders, more_bytes, more_files)
+        self.bytes += more_bytes
+        self.files += more_files
+
+    def release(self):
+        self.quotas.reserve(self.folders, -self.bytes, -self.files)
+        self.bytes = self.files = 0
+
+
+class Quotas:
+    def __init__(self, limits, shared=False):
+        """
+        :param limits(dict): see `parse_limits`
+        :param shared(bool): keep usage in shared memory, so processes forked after this admit uploads together
+        """
+        self.limits = limits
+        if shared:
+            # used and reserved (bytes, files) of every folder
+            counters = memoryview(multiprocessing.RawArray('q', 4 * len(limits))).cast('B').cast('q')
+            self.used = {folder: counters[4 * i:4 * i + 2] for i, folder in enumerate(limits)}
+            self.reserved = {folder: counters[4 * i + 2:4 * i + 4] for i, folder in enumerate(limits)}
+            self.lock = multiprocessing.RLock()
+        else:
+            self.used = {folder: [0, 0] for folder in limits}
+            self.reserved = {folder: [0, 0] for folder in limits}
+            self.lock = contextlib.nullcontext()
+        self.rejected = 0
+
+    def covering(self, path):
+        """Limited folders containing `path` (db path), including the path itself"""
+        return [folder for folder in self.limits
+                if folder == "/" or path == folder or path.startswith(folder + "/")]
+
+    def inside(self, path):
+        """Limited folders inside of `path` (db path of a folder), excluding the path itself"""
+        prefix = path.rstrip("/") + "/"
+        return [folder for folder in self.limits if folder.startswith(prefix)]
+
+    def load(self, usage):
+        """
+        Read usage of every limited folder
+        :param usage: callable returning (bytes, files) of a folder by its db path
+        """
+        for folder in self.limits:
+            self.set(folder, *usage(folder))
+            log.info("Quota of %s: %s bytes and %s files used", folder, *self.used[folder])
+
+    def set(self, folder, bytes, files):
+        with self.lock:
+            self.used[folder][0], self.used[folder][1] = bytes, files
+
+    def admit(self, path, bytes, files=1, source=None):
+        """
+        Reserve space for upload of `bytes` to `path`. Release the reservation when upload is finished
+        :param source(str): db path the node is moved from, folders containing it too are not checked
+        :raise OSError: EDQUOT if upload exceeds quota of any folder containing the path
+        :return(Reservation): or None if the path is not limited
+        """
+        folders = [folder for folder in self.covering(path) if source is None or folder not in self.covering(source)]
+        if not folders:
+            return None
+        with self.lock:
+            self.check(folders, bytes, files)
+            self.reserve(folders, bytes, files)
+        return Reservation(self, folders, bytes, files)
+
+    def check(self, folders, bytes, files):
+        for folder in folders:
+            max_bytes, max_files = self.limits[folder]
+            used, reserved = self.used[folder], self.reserved[folder]
+            if max_bytes is not None and used[0] + reserved[0] + bytes > max_bytes:
+                self.rejected += 1
+                raise OSError(errno.EDQUOT, "Quota of {} bytes in {} exceeded".format(max_bytes, folder), folder)
+            if max_files is not None and files and used[1] + reserved[1] + files > max_files:
+                self.rejected += 1
+                raise OSError(errno.EDQUOT, "Quota of {} files in {} exceeded".format(max_files, folder), folder)
+
+    def reserve(self, folders, bytes, files):
+        with self.lock:
+            for folder in folders:
+                self.reserved[folder][0] += bytes
+                self.reserved[folder][1] += files
+
+    def add(self, path, bytes, files):
+        """File of `bytes` size was uploaded to `path` (negative numbers for deleted files or folders)"""
+        with self.lock:
+            for folder in self.covering(path):
+                self.used[folder][0] += bytes
+                self.used[folder][1] += files
+
+    def removed(self, path, bytes, files):
+        """Folder or file at `path` was deleted with `bytes` and `files` inside of it"""
+        with self.lock:
+            for folder in self.inside(path):
+                self.set(folder, 0, 0)
+            self.add(path, -bytes, -files)
+
+    def stats(self):
+        folders = OrderedDict()
+        for folder in sorted(self.limits):
+            folders[folder] = OrderedDict([
+                ("max_bytes", self.limits[folder][0]),
+                ("max_files", self.limits[folder][1]),
+                ("bytes", self.used[folder][0]),
+                ("size", utils.sizeof_fmt(self.used[folder][0])),
+                ("files", self.used[folder][1]),
+                ("reserved_bytes", self.reserved[folder][0]),
+                ("reserved_files", self.reserved[folder][1]),
+            ])
+        return OrderedDict([
+            ("rejected", self.rejected),
+            ("folders", folders),
+        ])
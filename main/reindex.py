@@ -0,0 +1,281 @@
+"""
+Rebuild db index from disk, e.g. after files were changed bypassing the app.
+
+    $ python reindex.py [--full] [--workers=N] [--batch=N]
+
+Folders are scanned by a pool of worker processes. By default every scanned folder is
+compared with its children in the index and only differences are written (they are
+added to the change log too), so it may run while the server is running.
+With --full the index is built from scratch into a new table which replaces File table
+in one transaction at the end. Stop the server first: changes it makes meanwhile are lost
+"""
+import concurrent.futures
+import logging
+import os
+import stat
+import time
+from collections import OrderedDict, defaultdict
+
+import tornado.options
+from tornado.options import define, options
+
+import config
+import db
+import fs
+import utils
+
+log = logging.getLogger("tornado.general")
+
+define('full', default=False, type=bool, help='Build index from scratch instead of applying differences')
+define('workers', default=os.cpu_count(), type=int, help='Processes scanning folders')
+define('batch', default=100000, type=int, help='Rows written in one transaction')
+
+DB_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def scan(folder, hidden):
+    """
+    Runs on a worker process: stat entries of one folder
+    :return: folder and list of (name, is_dir, bytes, mtime) or None if folder is gone
+    """
+    entries = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.path in hidden:
+                    continue
+                try:
+                    stat_info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name, stat.S_ISDIR(stat_info.st_mode), stat_info.st_size, stat_info.st_mtime))
+    except (FileNotFoundError, NotADirectoryError):
+        return folder, None
+    return folder, entries
+
+
+def walk(root, workers):
+    """
+    Scan all folders under `root` in parallel
+    :yield: (abspath of folder, its entries) in the order folders are scanned, parents before children
+    """
+    hidden = fs.internal_dirs()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = {executor.submit(scan, root, hidden)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                folder, entries = future.result()
+                if entries is None:
+                    continue
+                for name, is_dir, _, _ in entries:
+                    if is_dir:
+                        pending.add(executor.submit(scan, os.path.join(folder, name), hidden))
+                yield folder, entries
+
+
+class Reindex:
+    """Walks the disk and builds rows of File table, counts totals of folders along the way"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.base_dir = options.storage_path.rstrip(os.path.sep)
+        self.folders = 0
+        self.files = 0
+        # db path of folder -> [bytes, files] of its direct children, summed up to subtree totals by `totals`
+        self._direct = defaultdict(lambda: [0, 0])
+
+    def db_path(self, abspath):
+        return abspath[len(self.base_dir):] or "/"
+
+    def rows(self):
+        """
+        :yield: (db path of folder, [(path, bytes, is_dir, modified, size, parent_path, depth)] of its children),
+        root folder itself is yielded first as the only child of None
+        """
+        root = os.stat(self.base_dir)
+        yield None, [("/", root.st_size, True, self._modified(root.st_mtime), utils.sizeof_fmt(root.st_size),
+                      None, 0)]
+        for folder, entries in walk(self.base_dir, self.workers):
+            parent_path = self.db_path(folder)
+            prefix = parent_path.rstrip("/") + "/"
+            depth = prefix.count("/")
+            children = []
+            direct = self._direct[parent_path]
+            for name, is_dir, size, mtime in entries:
+                children.append((prefix + name, size, is_dir, self._modified(mtime), utils.sizeof_fmt(size),
+                                 parent_path, depth))
+                if not is_dir:
+                    direct[0] += size
+                    direct[1] += 1
+            self.folders += 1
+            self.files += len(entries)
+            if self.folders % 10000 == 0:
+                log.info("Scanned %d folders, %d nodes", self.folders, self.files)
+            yield parent_path, children
+
+    def totals(self):
+        """:return(dict): db path of every scanned folder -> (bytes, files) in its subtree"""
+        totals = {path: list(direct) for path, direct in self._direct.items()}
+        # children are deeper than their parents
+        for path in sorted(totals, key=lambda path: path.count("/") if path != "/" else 0, reverse=True):
+            if path != "/":
+                parent = totals.setdefault(os.path.dirname(path), [0, 0])
+                parent[0] += totals[path][0]
+                parent[1] += totals[path][1]
+        return totals
+
+    @staticmethod
+    def _modified(mtime):
+        return time.strftime(DB_DATETIME_FORMAT, time.localtime(mtime))
+
+
+def full(reindex, batch):
+    """Build new table from scratch, then replace File table with it"""
+    table = db.File._meta.table_name
+    new = table + "_reindex"
+    # triggers of name index are created with the index
+    schema = {kind: [sql for sql, in db.db.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE type = ? AND tbl_name = ? AND sql IS NOT NULL AND name NOT LIKE ?",
+        (kind, table, db.NAME_INDEX + "%"))]
+        for kind in ('table', 'index', 'trigger')}
+    db.db.execute_sql('DROP TABLE IF EXISTS "{}"'.format(new))
+    db.db.execute_sql(schema['table'][0].replace('"{}"'.format(table), '"{}"'.format(new), 1))
+    insert = ('INSERT INTO "{}" (path, bytes, is_dir, modified, size, parent_path, depth, tree_bytes, tree_files) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)').format(new)
+    rows = []
+    for _, children in reindex.rows():
+        for path, size, is_dir, modified, size_fmt, parent_path, depth in children:
+            rows.append((path, size, is_dir, modified, size_fmt, parent_path, depth,
+                         0 if is_dir else size, 0 if is_dir else 1))
+        if len(rows) >= batch:
+            with db.db.atomic():
+                db.db.cursor().executemany(insert, rows)
+            rows = []
+    with db.db.atomic():
+        db.db.cursor().executemany(insert, rows)
+    log.info("Scanned %d folders, %d nodes. Replacing index", reindex.folders, reindex.files)
+
+    with db.db.atomic():
+        # hashes of files which were not changed since they were uploaded
+        db.db.execute_sql(
+            'UPDATE "{0}" SET content_hash = (SELECT indexed.content_hash FROM "{1}" AS indexed '
+            'WHERE indexed.path = "{0}".path AND indexed.bytes = "{0}".bytes '
+            'AND indexed.modified = "{0}".modified)'.format(new, table))
+        db.db.execute_sql('DROP TABLE "{}"'.format(table))
+        db.db.execute_sql('ALTER TABLE "{}" RENAME TO "{}"'.format(new, table))
+        for sql in schema['index'] + schema['trigger']:
+            db.db.execute_sql(sql)
+        db.db.execute_sql('UPDATE "{0}" SET parent_id = (SELECT parent.id FROM "{0}" AS parent '
+                          'WHERE parent.path = "{0}".parent_path)'.format(table))
+        write_totals(reindex.totals())
+        # filling new name index is several times faster than replacing contents of the old one
+        db.db.execute_sql('DROP TABLE IF EXISTS "{}"'.format(db.NAME_INDEX))
+        db.create_name_index()
+        # what has changed is unknown, clients have to sync the whole tree: the cursor is
+        # moved past the last change, so even the latest cursor is older than the log
+        db.Change.delete().execute()
+        moved = db.db.execute_sql("UPDATE sqlite_sequence SET seq = seq + 1 WHERE name = ?",
+                                  (db.Change._meta.table_name,)).rowcount
+        if not moved:
+            db.db.execute_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, 1)", (db.Change._meta.table_name,))
+    return OrderedDict([("folders", reindex.folders), ("nodes", reindex.files)])
+
+
+def diff(reindex, batch):
+    """Compare every scanned folder with its children in the index, write only differences"""
+    table = db.File._meta.table_name
+    counts = OrderedDict([("folders", 0), ("nodes", 0), ("created", 0), ("changed", 0), ("deleted", 0)])
+    queue = []
+    pending = 0
+    for parent_path, children in reindex.rows():
+        if parent_path is None:
+            where, params = "path = ?", ("/",)
+        else:
+            where, params = "parent_path = ?", (parent_path,)
+        # modification time may be stored with microseconds by older versions
+        indexed = {path: (bytes, is_dir, modified[:19]) for path, bytes, is_dir, modified in db.db.execute_sql(
+            'SELECT path, bytes, is_dir, modified FROM "{}" WHERE {}'.format(table, where), params)}
+        deleted = []
+        updated = OrderedDict()
+        for path, size, is_dir, modified, size_fmt, _, _ in children:
+            node = indexed.pop(path, None)
+            if node == (size, is_dir, modified):
+                continue
+            if node is not None and node[1] and not is_dir:
+                # folder was replaced with a file, descendants of the folder are deleted with it
+                deleted.append((path, node))
+                node = None
+            counts["created" if node is None else "changed"] += 1
+            updated[path] = node_info(path, size, is_dir, modified)
+        deleted.extend(indexed.items())
+        for path, (size, is_dir, modified) in deleted:
+            counts["deleted"] += 1
+            queue.append((db.WriteBehind.DELETE, node_info(path, size, bool(is_dir), modified)))
+        if updated:
+            queue.append((db.WriteBehind.UPDATE, updated))
+        pending += len(updated) + len(deleted)
+        if pending >= batch:
+            write(queue)
+            queue, pending = [], 0
+    write(queue)
+
+    # totals are counted from scratch, so they are repaired even if nodes were not changed
+    totals = reindex.totals()
+    indexed = db.db.execute_sql('SELECT path, tree_bytes, tree_files FROM "{}" WHERE is_dir'.format(table))
+    wrong = {path: totals.get(path, (0, 0)) for path, tree_bytes, tree_files in indexed
+             if tuple(totals.get(path, (0, 0))) != (tree_bytes, tree_files)}
+    with db.db.atomic():
+        write_totals(wrong)
+    counts["folders"], counts["nodes"] = reindex.folders, reindex.files
+    counts["totals_repaired"] = len(wrong)
+    return counts
+
+
+def node_info(path, size, is_dir, modified):
+    """Node info as `fs.Worker.node_info` formats it"""
+    return OrderedDict([
+        ("path", path),
+        ("bytes", size),
+        ("size", utils.sizeof_fmt(size)),
+        ("modified", time.strftime(fs.Worker.MODIFIED_DATETIME_FORMAT, time.strptime(modified, DB_DATETIME_FORMAT))),
+        ("is_dir", is_dir),
+    ])
+
+
+def write(queue):
+    """
+    Write queued changes (see `db.WriteBehind._queue`) the same way as the server does.
+    Stored content hashes of changed files are dropped by `db.upsert_nodes`
+    """
+    if not queue:
+        return
+    with db.db.atomic():
+        for action, item in queue:
+            if action == db.WriteBehind.UPDATE:
+                db.upsert_nodes(item.values())
+            elif item['is_dir']:
+                db.del_node_tree(item)
+            else:
+                db.del_node(item)
+        db.log_changes(queue)
+
+
+def write_totals(totals):
+    db.db.cursor().executemany(
+        'UPDATE "{}" SET tree_bytes = ?, tree_files = ? WHERE path = ?'.format(db.File._meta.table_name),
+        [(tree_bytes, tree_files, path) for path, (tree_bytes, tree_files) in totals.items()])
+
+
+def main():
+    tornado.options.parse_command_line()
+    started = time.monotonic()
+    db.connect()
+    reindex = Reindex(options.workers)
+    counts = (full if options.full else diff)(reindex, options.batch)
+    log.warning("Reindexed in %.1f s: %s", time.monotonic() - started,
+                ", ".join("{} {}".format(value, name) for name, value in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
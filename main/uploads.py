@@ -0,0 +1,197 @@
+"""
+Resumable upload sessions. Session is a staged file plus json with its
+target path, declared length and offset of saved data. Both are kept in
+staging folder, so sessions survive server restart until they expire.
+Upload to a path is claimed by a file named by hash of the path holding id
+of the session, so worker processes (see `processes` option) see sessions
+of each other.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+from tornado.options import options
+
+import fs
+import utils
+
+log = logging.getLogger("tornado.general")
+
+
+def sessions_dir():
+    return os.path.join(fs.staging_dir(), "uploads")
+
+
+def claim_path(path):
+    """File holding id of the session uploading to `path` (db path)"""
+    return os.path.join(sessions_dir(), hashlib.sha1(path.encode()).hexdigest() + ".active")
+
+
+def claims_lock():
+    """Claims are created and removed by one process at a time"""
+    return utils.LockedOpen(os.path.join(sessions_dir(), ".lock"), "a")
+
+
+def read_claim(path):
+    try:
+        with open(claim_path(path)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class UploadSession:
+    def __init__(self, id, path, length, offset=0, expires=None):
+        self.id = id
+        self.path = path
+        self.length = length
+        self.offset = offset
+        self.expires = expires or time.time() + 3600 * options.upload_session_ttl
+
+    @property
+    def staged(self):
+        return os.path.join(sessions_dir(), self.id + ".part")
+
+    @property
+    def meta(self):
+        return os.path.join(sessions_dir(), self.id + ".json")
+
+    def expired(self):
+        return self.expires < time.time()
+
+    def save(self):
+        """Atomically rewrite session json and prolong session"""
+        self.expires = time.time() + 3600 * options.upload_session_ttl
+        temp = self.meta + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({
+                "id": self.id,
+                "path": self.path,
+                "length": self.length,
+                "offset": self.offset,
+                "expires": self.expires,
+            }, f)
+        os.rename(temp, self.meta)
+
+    def saved(self, offset):
+        """Remember that data up to `offset` is on disk (None if it is unknown)"""
+        if offset is not None and offset > self.offset:
+            self.offset = offset
+            self.save()
+
+    def discard(self):
+        """Forget session, remove staged file unless it has been published"""
+        with claims_lock():
+            if read_claim(self.path) == self.id:
+                os.remove(claim_path(self.path))
+        for path in (self.meta, self.staged):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def info(self):
+        return {
+            "upload_id": self.id,
+            "path": self.path,
+            "length": self.length,
+            "offset": self.offset,
+            "expires": time.strftime(fs.Worker.MODIFIED_DATETIME_FORMAT, time.localtime(self.expires)),
+        }
+
+
+def create(path, length):
+    """
+    Start resumable upload of `length` bytes to `path` (db path)
+    :raise FileExistsError: there is another active session for this path
+    :raise OSError: not enough space for staged file
+    """
+    os.makedirs(sessions_dir(), exist_ok=True)
+    session = UploadSession(uuid.uuid4().hex, path, length)
+    # saved before it is claimed, so a claim always names a session other processes can load
+    session.save()
+    with claims_lock():
+        claimed = not _live(read_claim(path))
+        if claimed:
+            temp = claim_path(path) + ".tmp"
+            with open(temp, "w") as f:
+                f.write(session.id)
+            os.rename(temp, claim_path(path))
+    if not claimed:
+        session.discard()
+        raise FileExistsError(path)
+    with open(session.staged, "wb") as f:
+        try:
+            fs.preallocate(f.fileno(), length)
+        except OSError:
+            f.close()
+            session.discard()
+            raise
+    return session
+
+
+def _load(session_id):
+    """:raise KeyError: session doesn't exist"""
+    if not session_id or not session_id.isalnum():
+        raise KeyError(session_id)
+    try:
+        with open(os.path.join(sessions_dir(), session_id + ".json")) as f:
+            return UploadSession(**json.load(f))
+    except (FileNotFoundError, ValueError, TypeError):
+        raise KeyError(session_id)
+
+
+def _live(session_id):
+    """Session exists and hasn't expired, doesn't discard it (so it may be called holding `claims_lock`)"""
+    try:
+        return not _load(session_id).expired()
+    except KeyError:
+        return False
+
+
+def get(session_id):
+    """:raise KeyError: session doesn't exist or expired"""
+    session = _load(session_id)
+    if session.expired():
+        session.discard()
+        raise KeyError(session_id)
+    return session
+
+
+def active(path):
+    """Id of unexpired session uploading to `path` (db path) or None"""
+    session_id = read_claim(path)
+    return session_id if _live(session_id) else None
+
+
+def sweep():
+    """Remove expired sessions, staged files and claims left by them"""
+    try:
+        names = os.listdir(sessions_dir())
+    except FileNotFoundError:
+        return
+    for name in names:
+        session_id, ext = os.path.splitext(name)
+        if ext == ".json":
+            try:
+                get(session_id)
+            except KeyError:
+                log.info("Upload session %s expired", session_id)
+        elif ext == ".part" and not os.path.exists(os.path.join(sessions_dir(), session_id + ".json")):
+            try:
+                os.remove(os.path.join(sessions_dir(), name))
+            except FileNotFoundError:
+                # removed with its expired session
+                pass
+        elif ext == ".active":
+            # claim of a session which is gone (e.g. server was killed while it was being discarded)
+            with claims_lock():
+                try:
+                    with open(os.path.join(sessions_dir(), name)) as f:
+                        if not _live(f.read()):
+                            os.remove(f.name)
+                except FileNotFoundError:
+                    pass
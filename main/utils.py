@@ -1,4 +1,5 @@
 import functools
+import json
 
 import fcntl
 import os
@@ -30,6 +31,54 @@ def sizeof_fmt(num, suffix='B'):
         num /= 1024.0
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
+def _chunked(parts, chunk_size):
+    buf, size = [], 0
+    for part in parts:
+        if not part:
+            continue
+        buf.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf)
+
+
+def tree_to_json(walk, chunk_size=64 * 1024):
+    """
+    Encode pre-order (level, node, expanded) walk as one nested json tree,
+    the same `json.dumps(fs.build_tree(walk))` would produce, but chunk by chunk
+    without holding the whole tree in memory
+    """
+    def parts():
+        levels = []  # levels of nodes with open "children" array
+        need_comma = False
+        for level, node, expanded in walk:
+            while levels and levels[-1] >= level:
+                levels.pop()
+                yield "]}"
+                need_comma = True
+            if need_comma:
+                yield ", "
+            encoded = json.dumps(node)
+            if expanded:
+                yield encoded[:-1] + (', "children": [' if node else '"children": [')
+                levels.append(level)
+                need_comma = False
+            else:
+                yield encoded
+                need_comma = True
+        yield "]}" * len(levels)
+
+    return _chunked(parts(), chunk_size)
+
+
+def tree_to_ndjson(walk, chunk_size=64 * 1024):
+    """Encode pre-order (level, node, expanded) walk as newline delimited json, one node per line"""
+    return _chunked((json.dumps(node) + "\n" for _, node, _ in walk), chunk_size)
+
+
 class LockedOpen(object):
 
     def __init__(self, filename, *args, **kwargs):
@@ -0,0 +1,334 @@
+"""
+Keep db index, cached listings and quotas in sync with changes made in storage bypassing
+the app (rsync jobs, admin scripts). Folders are watched with inotify(7), events only mark
+children of watched folders as dirty. `delay` ms after the first event of a burst dirty
+children are compared with the index and differences are queued the same way handlers
+queue them (`db.file_uploaded`, `db.file_or_folder_deleted`), so a burst of events on
+the same files is coalesced into one check. Folders which appear (created or moved in)
+are watched and compared with all their subfolders. When the kernel drops events
+(queue overflow) all watched folders modified since the last check are compared
+"""
+import concurrent.futures
+import errno
+import functools
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import tornado.gen
+import tornado.ioloop
+from tornado.options import options
+
+import db
+import fs
+from inotify import Inotify, IN_IGNORED, IN_ISDIR, IN_MOVED_FROM, IN_Q_OVERFLOW
+
+log = logging.getLogger("tornado.general")
+
+
+def scan(folder, names=None):
+    """
+    Runs on watcher thread: read the folder and its children from disk, see `db.children`
+    :param folder(str): absolute path
+    :param names: only children with these names, all of them if None
+    :return: (node info of the folder, dict of db path -> node info of children found on disk)
+             or None if the folder is gone
+    """
+    worker = fs.Worker("/")
+    hidden = fs.internal_dirs()
+    try:
+        node = worker.node_info(folder, os.stat(folder))
+        if names is None:
+            names = sorted(os.listdir(folder))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not node['is_dir']:
+        return None
+    children = OrderedDict()
+    for name in names:
+        path = os.path.join(folder, name)
+        if path in hidden:
+            continue
+        try:
+            child = worker.node_info(path, os.stat(path))
+        except FileNotFoundError:
+            continue
+        children[child['path']] = child
+    return node, children
+
+
+def modified_since(folders, since):
+    """Runs on watcher thread: folders whose entries were created, deleted or renamed since `since` timestamp"""
+    modified = []
+    for folder in folders:
+        try:
+            if os.stat(folder).st_mtime >= since:
+                modified.append(folder)
+        except FileNotFoundError:
+            pass  # deleted, its parent is modified
+    return modified
+
+
+def compare(on_disk, indexed):
+    """
+    Find differences between the same children of a folder on disk and in the index.
+    A node which became a folder or stopped being one is deleted and created again
+    :param on_disk(dict): db path -> node info of children found on disk
+    :param indexed(dict): db path -> node info of children found in the index
+    :return: (list of indexed nodes to delete, list of (node on disk, its indexed node or None) to create or update)
+    """
+    deleted, updated = [], []
+    for path, node in on_disk.items():
+        old = indexed.get(path)
+        if old is not None and old['is_dir'] != node['is_dir']:
+            deleted.append(old)
+            old = None
+        elif old is not None and (old['bytes'], old['modified']) == (node['bytes'], node['modified']):
+            continue
+        updated.append((node, old))
+    deleted.extend(old for path, old in indexed.items() if path not in on_disk)
+    return deleted, updated
+
+
+class Watcher:
+    """Watches all folders of storage, see the module docstring"""
+
+    def __init__(self, application, delay):
+        """:param delay(int): ms to wait for more events after the first one before checking changed nodes"""
+        self.application = application
+        self.delay = delay
+        self.root = options.storage_path.rstrip(os.path.sep)
+        self.hidden = fs.internal_dirs()
+        self.inotify = None
+        self._paths = {}  # watch descriptor -> absolute path of the watched folder
+        self._wds = {}  # absolute path of the watched folder -> watch descriptor
+        self._dirty = {}  # absolute path of folder -> set of names of changed children or None for all children
+        self._overflowed = False
+        self._synced = None  # time when the last sync started, everything changed before is compared
+        self._timeout = None
+        self._syncing = False
+        self._limit_reached = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="watcher")
+        self.events = 0
+        self.coalesced = 0
+        self.syncs = 0
+        self.folders = 0
+        self.changes = 0
+        self.overflows = 0
+
+    @tornado.gen.coroutine
+    def start(self):
+        """Watch all folders of storage and start reading events"""
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            log.error("File watcher is not started: %s", e.strerror)
+            return
+        started = time.monotonic()
+        self._synced = time.time()
+        yield self._executor.submit(self._watch_tree, self.root)
+        tornado.ioloop.IOLoop.current().add_handler(self.inotify.fd, self._read, tornado.ioloop.IOLoop.READ)
+        log.info("Watching %d folders for changes in %.1f s", len(self._wds), time.monotonic() - started)
+
+    def watch(self, folder):
+        """Start watching the folder, return False if it can't be watched"""
+        try:
+            wd = self.inotify.add_watch(folder)
+        except OSError as e:
+            if e.errno == errno.ENOSPC and not self._limit_reached:
+                self._limit_reached = True
+                log.error("Limit of inotify watches is reached, changes in %s and further new folders are not "
+                          "tracked. Raise fs.inotify.max_user_watches", folder)
+            return False
+        moved = self._paths.get(wd)
+        if moved is not None and moved != folder:
+            self._wds.pop(moved, None)
+        self._paths[wd] = folder
+        self._wds[folder] = wd
+        return True
+
+    def unwatch(self, folder):
+        """Stop watching the folder and all folders inside of it, e.g. when it is moved away"""
+        prefix = folder + os.path.sep
+        for path in [path for path in self._wds if path == folder or path.startswith(prefix)]:
+            wd = self._wds.pop(path)
+            self._paths.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def mark(self, folder, name=None):
+        """Mark child of the folder as changed, all children if `name` is None"""
+        names = self._dirty.get(folder, set())
+        if names is None or name in names:
+            self.coalesced += 1
+        if name is None:
+            self._dirty[folder] = None
+        elif names is not None:
+            names.add(name)
+            self._dirty[folder] = names
+        self._schedule()
+
+    def overflow(self):
+        """
+        Kernel dropped events: compare all children of watched folders modified since the last sync.
+        Folders created or moved in change modification time of their parent, but changes
+        of existing files inside of unchanged folders are missed
+        """
+        self.overflows += 1
+        log.warning("File watcher dropped events. Folders changed since the last sync are compared with the index")
+        self._overflowed = True
+        self._schedule()
+
+    @tornado.gen.coroutine
+    def sync(self):
+        """Compare all dirty nodes with the index and queue the differences"""
+        self._timeout = None
+        self._syncing = True
+        self.syncs += 1
+        started = time.time()
+        try:
+            if self._overflowed:
+                self._overflowed = False
+                # timestamps of some filesystems have one second resolution
+                changed = yield self._executor.submit(modified_since, list(self._wds), self._synced - 1)
+                for folder in changed:
+                    self.mark(folder)
+            dirty, self._dirty = self._dirty, {}
+            for top in sorted(dirty):
+                stack = [(top, dirty[top], False)]
+                while stack:
+                    folder, names, new = stack.pop()
+                    subfolders = yield self.sync_folder(folder, names, new)
+                    stack.extend((subfolder, None, new) for subfolder, new in reversed(subfolders))
+            self._synced = started
+        except Exception:
+            log.exception("Failed to sync changes made bypassing the app")
+        finally:
+            self._syncing = False
+            if self._dirty or self._overflowed:
+                self._schedule()
+
+    @tornado.gen.coroutine
+    def sync_folder(self, folder, names=None, new=False):
+        """
+        Compare children of the folder on disk with the index and queue the differences
+        :param names(set): names of changed children, None to compare all of them
+        :param new: folder was just created in the index, so none of its children are indexed
+        :return(list): (absolute path, whether it is new) of subfolders which are not watched yet
+                       (created, moved in or missed), they are compared with all their children
+        """
+        if names is None:
+            # watched before it is read, so nothing created meanwhile is missed
+            self.watch(folder)
+        scanned = yield self._executor.submit(scan, folder, names)
+        if scanned is None:
+            return []  # folder is gone, it is deleted from the index when its parent is compared
+        node, on_disk = scanned
+        self.folders += 1
+        if new:
+            indexed_folder, indexed = None, {}
+        else:
+            indexed_folder, indexed = yield db.read_fresh(
+                node['path'], db.children, None if names is None else list(names))
+        deleted, updated = compare(on_disk, indexed)
+
+        quotas = self.application.quotas
+        for old in deleted:
+            yield self.removed_from_quotas(old)
+            self.changed(db.file_or_folder_deleted, OrderedDict(node, children=old), old['path'])
+        created = set()
+        for child, old in updated:
+            if not child['is_dir'] and self.busy(child['path']):
+                # being published by a request in progress, which indexes it itself. Checked again later
+                self.mark(folder, os.path.basename(child['path']))
+                continue
+            if old is None:
+                created.add(child['path'])
+            if not child['is_dir']:
+                quotas.add(child['path'], child['bytes'] - (old['bytes'] if old else 0), 0 if old else 1)
+            self.changed(db.folder_created if child['is_dir'] else db.file_uploaded,
+                         OrderedDict(node, children=child), child['path'])
+        self.changes += len(deleted) + len(updated)
+        if not deleted and not updated and not new and (
+                indexed_folder is None or (indexed_folder['bytes'], indexed_folder['modified']) !=
+                (node['bytes'], node['modified'])):
+            self.changes += 1
+            self.changed(db.folder_created, node, node['path'])
+        return [(self.root + child['path'], child['path'] in created) for child in on_disk.values()
+                if child['is_dir'] and self.root + child['path'] not in self._wds]
+
+    @tornado.gen.coroutine
+    def removed_from_quotas(self, node):
+        """Subtract indexed node which is about to be deleted from usage of limited folders"""
+        quotas = self.application.quotas
+        if not node['is_dir']:
+            quotas.removed(node['path'], node['bytes'], 1)
+            return
+        if not quotas.covering(node['path']) and not quotas.inside(node['path']):
+            return
+        try:
+            usage = yield db.read_fresh(node['path'], db.usage)
+        except db.DoesNotExist:
+            return
+        quotas.removed(node['path'], usage['bytes'], usage['files'])
+
+    def changed(self, db_callback, updates, path):
+        """Queue change to db and drop cached listings which include it, as `handlers.BaseHandler.changed` does"""
+        cache = self.application.cache
+        cache.invalidate(path)
+        db_callback(updates, functools.partial(cache.invalidate, path))
+
+    def busy(self, path):
+        """Is the path locked by a request in progress"""
+        return self.application.locks.locked(path)
+
+    def stats(self):
+        return OrderedDict([
+            ("watches", len(self._wds)),
+            ("events", self.events),
+            ("coalesced", self.coalesced),
+            ("syncs", self.syncs),
+            ("folders", self.folders),
+            ("changes", self.changes),
+            ("overflows", self.overflows),
+        ])
+
+    def _watch_tree(self, root):
+        """Runs on watcher thread before events are read: watch the folder and all folders inside of it"""
+        folders = [root]
+        while folders:
+            folder = folders.pop()
+            if not self.watch(folder):
+                continue
+            try:
+                with os.scandir(folder) as it:
+                    folders.extend(entry.path for entry in it
+                                   if entry.is_dir(follow_symlinks=False) and entry.path not in self.hidden)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def _read(self, fd, events):
+        for wd, mask, cookie, name in self.inotify.read():
+            self.events += 1
+            if mask & IN_Q_OVERFLOW:
+                self.overflow()
+                continue
+            folder = self._paths.get(wd)
+            if folder is None:
+                continue  # watch was removed already
+            if mask & IN_IGNORED:
+                # watched folder was deleted
+                del self._paths[wd]
+                if self._wds.get(folder) == wd:
+                    del self._wds[folder]
+                continue
+            path = os.path.join(folder, name)
+            if not name or path in self.hidden:
+                continue  # events of a watched folder itself are reported to its parent too
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self.unwatch(path)
+            self.mark(folder, name)
+
+    def _schedule(self):
+        if self._timeout is None and not self._syncing:
+            self._timeout = tornado.ioloop.IOLoop.current().call_later(self.delay / 1000, self.sync)
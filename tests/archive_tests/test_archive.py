@@ -0,0 +1,63 @@
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from tornado.options import define, options
+
+from archive import chunks
+from fs import Worker
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+if "upload_staging_dir" not in options:
+    define("upload_staging_dir", "")
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+        os.makedirs(os.path.join(self.tmp.name, "a", "b", "empty"))
+        self.contents = os.urandom(10000)
+        with open(os.path.join(self.tmp.name, "a", "b", "file"), "wb") as f:
+            f.write(self.contents)
+        os.makedirs(os.path.join(self.tmp.name, ".staging"))
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        self.tmp.cleanup()
+
+    def archive(self, uri, archive_format, compress=False, chunk_size=1024):
+        archived = list(chunks(Worker(uri), archive_format, compress, chunk_size))
+        return archived, b"".join(archived)
+
+    def test_tar_of_the_folder(self):
+        archived, data = self.archive("/a/", 'tar')
+        # the last one is padded to whole tar records
+        self.assertTrue(all(len(chunk) <= 2048 for chunk in archived[:-1]))
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            self.assertListEqual(sorted(tar.getnames()), ["a", "a/b", "a/b/empty", "a/b/file"])
+            self.assertTrue(tar.getmember("a/b/empty").isdir())
+            self.assertEqual(tar.extractfile("a/b/file").read(), self.contents)
+
+    def test_compressed_tar(self):
+        _, data = self.archive("/a/b/", 'tar', compress=True)
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+            self.assertEqual(tar.extractfile("b/file").read(), self.contents)
+
+    def test_zip_of_the_root_skips_service_folders(self):
+        _, data = self.archive("/", 'zip', compress=True)
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertListEqual(sorted(archive.namelist()), ["a/", "a/b/", "a/b/empty/", "a/b/file"])
+            self.assertEqual(archive.getinfo("a/b/file").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.read("a/b/file"), self.contents)
+
+
+if __name__ == "__main__":
+    unittest.main()
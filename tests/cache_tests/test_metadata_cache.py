@@ -0,0 +1,74 @@
+import unittest
+
+from cache import MetadataCache
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MetadataCache(max_memory=1024 * 1024)
+        for path in ("/", "/a", "/a/b", "/a/b/c", "/ab", "/x"):
+            self.cache.put(path, (), {"path": path})
+
+    def cached(self):
+        return sorted(path for path in ("/", "/a", "/a/b", "/a/b/c", "/ab", "/x") if self.cache.get(path))
+
+    def test_hits_and_misses_are_counted(self):
+        self.cache.get("/a")
+        self.cache.get("/nope")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_invalidate_drops_ancestors_and_descendants(self):
+        self.cache.invalidate("/a/b")
+        self.assertListEqual(self.cached(), ["/ab", "/x"])
+
+    def test_invalidate_ignores_trailing_slash(self):
+        self.cache.invalidate("/x/")
+        self.assertListEqual(self.cached(), ["/a", "/a/b", "/a/b/c", "/ab"])
+
+    def test_invalidate_drops_every_key_of_path(self):
+        self.cache.put("/x", (("depth", 1),), {"path": "/x"})
+        self.cache.invalidate("/x")
+        self.assertIsNone(self.cache.get("/x", (("depth", 1),)))
+
+    def test_least_recently_used_is_evicted_first(self):
+        small = MetadataCache(max_memory=10 ** 6)
+        small.put("/a", (), "a" * 100)
+        size = small.memory
+        cache = MetadataCache(max_memory=2 * size)
+        cache.put("/a", (), "a" * 100)
+        cache.put("/b", (), "b" * 100)
+        cache.get("/a")
+        cache.put("/c", (), "c" * 100)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNotNone(cache.get("/a"))
+        self.assertIsNone(cache.get("/b"))
+        self.assertLessEqual(cache.memory, cache.max_memory)
+
+    def test_disabled_cache_stores_nothing(self):
+        cache = MetadataCache(max_memory=0)
+        cache.put("/a", (), {"path": "/a"})
+        self.assertIsNone(cache.get("/a"))
+
+    def test_listing_read_while_it_was_changed_is_not_cached(self):
+        generation = self.cache.generation
+        # change of /a/b/new was written while listings were read
+        self.cache.invalidate("/a/b/new")
+        self.cache.put("/a", (("depth", 2),), {"path": "/a"}, generation)
+        self.cache.put("/x", (("depth", 2),), {"path": "/x"}, generation)
+        self.assertIsNone(self.cache.get("/a", (("depth", 2),)))
+        self.assertIsNotNone(self.cache.get("/x", (("depth", 2),)))
+
+    def test_listing_is_not_cached_if_invalidations_since_its_read_are_forgotten(self):
+        cache = MetadataCache(max_memory=1024 * 1024, recent=2)
+        generation = cache.generation
+        for path in ("/y/1", "/y/2", "/y/3"):
+            cache.invalidate(path)
+        cache.put("/x", (), {"path": "/x"}, generation)
+        self.assertIsNone(cache.get("/x"))
+        cache.put("/x", (), {"path": "/x"}, cache.generation)
+        self.assertIsNotNone(cache.get("/x"))
+
+
+if __name__ == "__main__":
+    unittest.main()
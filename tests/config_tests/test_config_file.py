@@ -0,0 +1,52 @@
+import configparser
+import os
+import re
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+CONFIG_FILE = os.path.join(ROOT, "config.ini")
+CONFIG_MODULE = os.path.join(ROOT, "main", "config.py")
+
+
+class TestShippedConfig(unittest.TestCase):
+    """config.py parses config.ini at import, so a broken file stops the server and reindex.py"""
+
+    def setUp(self):
+        self.config = configparser.ConfigParser()
+        with open(CONFIG_FILE) as f:
+            self.config.read_file(f)
+        with open(CONFIG_MODULE) as f:
+            # (int/float wrapping the value or "", get/getboolean, section, key)
+            self.read = re.findall(r"(int|float)?\(?config\.get(\w*)\('(\w+)', '(\w+)'", f.read())
+
+    def test_options_are_in_their_sections(self):
+        self.assertTrue(self.read)
+        for _, _, section, key in self.read:
+            self.assertIn(section, self.config, key)
+            if key in self.config[section]:
+                continue
+            # options kept commented out in the file fall back to their defaults
+            with open(CONFIG_FILE) as f:
+                self.assertRegex(f.read(), r"(?m)^[#;]\s*{}\s*=".format(key),
+                                 "{} is missing in [{}]".format(key, section))
+
+    def test_values_have_types_of_options(self):
+        for convert, getter, section, key in self.read:
+            if key not in self.config[section]:
+                continue
+            if getter == 'boolean':
+                self.config.getboolean(section, key)
+            elif convert:
+                {'int': int, 'float': float}[convert](self.config.get(section, key))
+
+    def test_no_unknown_options_in_sections(self):
+        known = {(section, key) for _, _, section, key in self.read}
+        for section in self.config.sections():
+            if section == 'Logging':
+                continue
+            for key in self.config[section]:
+                self.assertIn((section, key), known, "[{}] {} is not read by config.py".format(section, key))
+
+
+if __name__ == "__main__":
+    unittest.main()
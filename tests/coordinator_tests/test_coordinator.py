@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+import tornado.concurrent
+import tornado.gen
+import tornado.netutil
+from tornado.testing import AsyncTestCase, gen_test
+
+from coordinator import Client, Coordinator, RemoteError
+from locks import Conflict, LockManager, S, X
+
+
+class TestCoordinator(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "coordinator.sock")
+        self.written = []
+        self.server = Coordinator(LockManager(), self.write, lambda: {"pid": os.getpid()})
+        self.server.add_socket(tornado.netutil.bind_unix_socket(self.path))
+        self.changed = []
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def write(self, queue):
+        future = tornado.concurrent.Future()
+        if queue == "fail":
+            future.set_exception(ValueError("invalid queue"))
+        else:
+            self.written.append(queue)
+            future.set_result([path for _, item in queue for path in item])
+        return future
+
+    @tornado.gen.coroutine
+    def client(self):
+        client = Client(self.path, self.changed.extend, lambda: None)
+        yield client.connect()
+        return client
+
+    @gen_test
+    def test_locks_of_workers_conflict(self):
+        first, second = yield [self.client(), self.client()]
+        upload = yield first.lock("/a/file", X).acquire()
+        with self.assertRaises(Conflict) as raised:
+            yield second.lock("/a/file", S).acquire()
+        self.assertEqual(raised.exception.path, "/a/file")
+        waiting = second.lock("/a/file", S).acquire(timeout=5)
+        upload.release()
+        lock = yield waiting
+        self.assertTrue(lock.acquired)
+
+    @gen_test
+    def test_locks_of_disconnected_worker_are_released(self):
+        first, second = yield [self.client(), self.client()]
+        yield first.lock("/a", X).acquire()
+        first.stream.close()
+        lock = yield second.lock("/a", X).acquire(timeout=5)
+        self.assertTrue(lock.acquired)
+
+    @gen_test
+    def test_written_changes_are_announced_to_other_workers(self):
+        first, second = yield [self.client(), self.client()]
+        yield first.write([["update", {"/a": {}, "/a/file": {}}]])
+        self.assertListEqual(self.written, [[["update", {"/a": {}, "/a/file": {}}]]])
+        yield second.request("stats")  # reply comes after the announcement
+        self.assertListEqual(self.changed, ["/a", "/a/file"])
+
+    @gen_test
+    def test_failed_write(self):
+        client = yield self.client()
+        with self.assertRaises(RemoteError) as raised:
+            yield client.write("fail")
+        self.assertEqual(raised.exception.name, "ValueError")
+
+
+if __name__ == "__main__":
+    unittest.main()
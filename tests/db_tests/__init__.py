@@ -0,0 +1,104 @@
+"""
+db connects to `db_file` and loads the closure table extension when it is imported, and reindex
+imports config, which defines all options. So tests of them run functions in a process of their
+own, set up from the shipped config.ini with storage and db in a temporary folder. They are skipped
+if the extension can't be loaded: set SQLITE_CLOSURE_TABLE_SO environment variable to its path
+"""
+import concurrent.futures
+import configparser
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+MODIFIED = "Wed, 29 Jun 2016 10:37:12"
+
+
+def closure_table_so():
+    if os.environ.get("SQLITE_CLOSURE_TABLE_SO"):
+        return os.environ["SQLITE_CLOSURE_TABLE_SO"]
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, "config.ini"))
+    return config.get('Database', 'sqlite_closure_table_so', fallback='')
+
+
+def _setup(tmp, closure_so):
+    """Runs in the db process before db is imported"""
+    # processes of reindex are forked as when it is run from command line, not spawned with default options
+    multiprocessing.set_start_method("fork", force=True)
+    import config  # noqa: defines options from config.ini
+    from tornado.options import options
+    options.storage_path = os.path.join(tmp, "storage")
+    options.db_file = os.path.join(tmp, "filesystem.db")
+    options.sqlite_closure_table_so = closure_so
+    options.upload_deduplicate = False
+    options.watch_enabled = False
+    os.makedirs(options.storage_path)
+    import db  # noqa: creates tables
+
+
+def reset():
+    """Empty index, change log and storage"""
+    import db
+    from tornado.options import options
+    db.connect()
+    with db.db.atomic():
+        db.File.delete().execute()
+        db.Change.delete().execute()
+    for name in os.listdir(options.storage_path):
+        path = os.path.join(options.storage_path, name)
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+
+def node(path, bytes=0, is_dir=False):
+    """Node info as `fs.Worker` passes it to db"""
+    return OrderedDict([("path", path), ("bytes", bytes), ("size", "{}.0B".format(bytes)),
+                        ("modified", MODIFIED), ("is_dir", is_dir)])
+
+
+def updates(path, bytes=0, is_dir=False):
+    """Queued update of the node and its ancestors, see `db.WriteBehind.update`"""
+    names = path.strip("/").split("/")
+    ancestors = ["/" + "/".join(names[:level]) for level in range(len(names))]
+    return "update", OrderedDict([(ancestor, node(ancestor, is_dir=True)) for ancestor in ancestors] +
+                                 [(path, node(path, bytes, is_dir))])
+
+
+def write(queue):
+    """Write queue of changes (see `db.WriteBehind._queue`) the way the writer thread does"""
+    import db
+    db.writer._write(queue)
+
+
+class DbTestCase(unittest.TestCase):
+    """Functions passed to `in_db` (module level ones, they are pickled by name) run in the db process"""
+
+    @classmethod
+    def setUpClass(cls):
+        closure_so = closure_table_so()
+        try:
+            database = SqliteExtDatabase(":memory:")
+            database.load_extension(closure_so)
+            database.connect()
+            database.close()
+        except Exception as e:
+            raise unittest.SkipTest("Closure table extension {!r} can't be loaded: {}".format(closure_so, e))
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.process = concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn"), initializer=_setup, initargs=(cls.tmp.name, closure_so))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.shutdown()
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        self.in_db(reset)
+
+    def in_db(self, func, *a, **kw):
+        return self.process.submit(func, *a, **kw).result(timeout=60)
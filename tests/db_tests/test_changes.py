@@ -0,0 +1,109 @@
+import unittest
+
+from db_tests import DbTestCase, node, write
+
+TREE = ["/", "/a", "/a/f1", "/a/f2", "/b"]
+
+
+def create_tree():
+    import db
+    write([(db.WriteBehind.UPDATE, {path: node(path, 10 if "/f" in path else 0, "/f" not in path)
+                                    for path in TREE})])
+
+
+def current_cursor():
+    import db
+    return db.changes()['cursor']
+
+
+def pages(cursor, limit, path=None):
+    """All changes after cursor read by pages: [(cursor of the page, [(action, path)])]"""
+    import db
+    result = []
+    while True:
+        page = db.changes(cursor, limit, path)
+        if not page['changes']:
+            return result
+        cursor = page['cursor']
+        result.append((cursor, [(change['action'], change['path']) for change in page['changes']]))
+
+
+def changes_after(cursor):
+    """(action, path) of changes after cursor or "gone" if they are not kept anymore"""
+    import db
+    try:
+        return [(change['action'], change['path']) for change in db.changes(cursor)['changes']]
+    except LookupError:
+        return "gone"
+
+
+def keep(changes):
+    """Keep last `changes` in the log, write one more change and return cursor of the oldest kept one"""
+    import db
+    from tornado.options import options
+    kept, options.changes_keep = options.changes_keep, changes
+    try:
+        write([(db.WriteBehind.UPDATE, {"/b/f3": node("/b/f3", 1)})])
+    finally:
+        options.changes_keep = kept
+    return db.Change.select(db.fn.MIN(db.Change.id)).scalar()
+
+
+def reindex_full():
+    import reindex
+    reindex.full(reindex.Reindex(1), 1000)
+
+
+def move_and_copy():
+    import db
+    cursor = current_cursor()
+    write([(db.WriteBehind.MOVE, dict(node("/c", is_dir=True), source="/a"))])
+    moved = changes_after(cursor)
+    cursor = current_cursor()
+    write([(db.WriteBehind.COPY, dict(node("/d", is_dir=True), source="/c"))])
+    return moved, changes_after(cursor)
+
+
+class TestChanges(DbTestCase):
+
+    def test_cursor_of_empty_log(self):
+        self.assertEqual(self.in_db(changes_after, self.in_db(current_cursor)), [])
+
+    def test_changes_are_read_by_pages_in_order(self):
+        cursor = self.in_db(current_cursor)
+        self.in_db(create_tree)
+        read = self.in_db(pages, cursor, 2)
+        self.assertListEqual([len(changes) for _, changes in read], [2, 2, 1])
+        self.assertListEqual([path for _, changes in read for _, path in changes], TREE)
+        # the last page ends at the current cursor, nothing is after it
+        self.assertEqual(read[-1][0], self.in_db(current_cursor))
+        self.assertListEqual(self.in_db(changes_after, read[-1][0]), [])
+
+    def test_changes_inside_of_folder(self):
+        cursor = self.in_db(current_cursor)
+        self.in_db(create_tree)
+        read = self.in_db(pages, cursor, 2, "/a")
+        self.assertListEqual([path for _, changes in read for _, path in changes], ["/a", "/a/f1", "/a/f2"])
+
+    def test_cursor_before_dropped_changes_is_gone(self):
+        cursor = self.in_db(current_cursor)
+        self.in_db(create_tree)
+        oldest = self.in_db(keep, 3)
+        self.assertEqual(self.in_db(changes_after, cursor), "gone")
+        self.assertEqual(len(self.in_db(changes_after, oldest - 1)), 3)
+
+    def test_log_is_truncated_by_full_reindex(self):
+        cursor = self.in_db(current_cursor)
+        self.in_db(create_tree)
+        self.in_db(reindex_full)
+        self.assertEqual(self.in_db(changes_after, cursor), "gone")
+
+    def test_move_is_deletion_of_source_and_copy_is_update_of_target_subtree(self):
+        self.in_db(create_tree)
+        moved, copied = self.in_db(move_and_copy)
+        self.assertListEqual(moved, [("delete", "/a"), ("update", "/c"), ("update", "/c/f1"), ("update", "/c/f2")])
+        self.assertListEqual(copied, [("update", "/d"), ("update", "/d/f1"), ("update", "/d/f2")])
+
+
+if __name__ == "__main__":
+    unittest.main()
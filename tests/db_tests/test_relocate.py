@@ -0,0 +1,76 @@
+import os
+import unittest
+
+from db_tests import DbTestCase, node, updates, write
+
+
+def create_tree():
+    """/a-b sorts between /a and its descendants, it must not be moved with them"""
+    for path, bytes in (("/a/f1", 10), ("/a/b/f2", 20), ("/a/b/c/f3", 30), ("/a-b/f4", 1)):
+        write([updates(path, bytes)])
+    write([updates("/d", is_dir=True)])
+
+
+def relocate(action, source, target):
+    write([updates(os.path.dirname(target), is_dir=True), (action, dict(node(target, is_dir=True), source=source))])
+
+
+def rows():
+    """db path -> (id, parent path, depth, path of parent by parent_id, tree bytes, tree files)"""
+    import db
+    from peewee import JOIN
+    parent = db.File.alias()
+    return {path: tuple(info) for path, *info in
+            db.File.select(db.File.path, db.File.id, db.File.parent_path, db.File.depth, parent.path,
+                           db.File.tree_bytes, db.File.tree_files)
+            .join(parent, join_type=JOIN.LEFT_OUTER, on=(db.File.parent == parent.id)).tuples()}
+
+
+def descendants(path):
+    """Paths of descendants of the node found by the closure table"""
+    import db
+    node_id = db.File.get(db.File.path == path).id
+    return sorted(descendant.path for descendant in db.FileClosure.descendants(node_id))
+
+
+class TestRelocate(DbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_db(create_tree)
+        self.before = self.in_db(rows)
+
+    def assertRows(self, indexed):
+        """Rows of moved or copied /a/b at /d/x"""
+        self.assertDictEqual({path: info[1:] for path, info in indexed.items() if path.startswith("/d/x")}, {
+            "/d/x": ("/d", 2, "/d", 50, 2),
+            "/d/x/f2": ("/d/x", 3, "/d/x", 20, 1),
+            "/d/x/c": ("/d/x", 3, "/d/x", 30, 1),
+            "/d/x/c/f3": ("/d/x/c", 4, "/d/x/c", 30, 1),
+        })
+        self.assertEqual(indexed["/d"][4:], (50, 2))
+        self.assertEqual(indexed["/a-b/f4"], self.before["/a-b/f4"])
+        self.assertListEqual(self.in_db(descendants, "/d"), ["/d/x", "/d/x/c", "/d/x/c/f3", "/d/x/f2"])
+
+    def test_move_rewrites_subtree(self):
+        self.in_db(relocate, "move", "/a/b", "/d/x")
+        indexed = self.in_db(rows)
+        self.assertRows(indexed)
+        self.assertFalse([path for path in indexed if path.startswith("/a/b")])
+        self.assertEqual(indexed["/a"][4:], (10, 1))
+        self.assertEqual(indexed["/"][4:], (61, 4))
+        # rows are updated in place
+        self.assertEqual(indexed["/d/x/c/f3"][0], self.before["/a/b/c/f3"][0])
+        self.assertListEqual(self.in_db(descendants, "/a"), ["/a/f1"])
+
+    def test_copy_rewrites_copied_subtree(self):
+        self.in_db(relocate, "copy", "/a/b", "/d/x")
+        indexed = self.in_db(rows)
+        self.assertRows(indexed)
+        self.assertDictEqual({path: info for path, info in indexed.items() if path.startswith("/a")},
+                             {path: info for path, info in self.before.items() if path.startswith("/a")})
+        self.assertEqual(indexed["/"][4:], (111, 6))
+
+
+if __name__ == "__main__":
+    unittest.main()
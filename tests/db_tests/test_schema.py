@@ -0,0 +1,167 @@
+import os
+import unittest
+
+from db_tests import MODIFIED, DbTestCase, node, write
+
+# File table as it was created before the schema was versioned: "/a" is there twice, left by
+# get_or_create without unique index, and children reference the older duplicate
+BASELINE_ROWS = [
+    (1, "/", 4096, True, None),
+    (2, "/a", 4096, True, 1),
+    (3, "/a/f1", 10, False, 2),
+    (4, "/a/b", 4096, True, 2),
+    (5, "/a/b/f2", 20, False, 4),
+    (6, "/a", 4096, True, 1),
+    (7, "/c", 5, False, 1),
+]
+
+
+def in_other_db(func):
+    """Run `func` with models bound to db file "other.db" next to the main one"""
+    import db
+    from tornado.options import options
+    other = os.path.join(os.path.dirname(options.db_file), "other.db")
+    db.db.close()
+    db.db.init(other)
+    try:
+        return func()
+    finally:
+        db.db.close()
+        db.db.init(options.db_file)
+        os.remove(other)
+
+
+def migrated():
+    """Schema, rows and change log of db after it was upgraded by `db.migrate_schema`"""
+    import db
+    table = db.File._meta.table_name
+    indexes = [sorted(index.columns) for index in db.db.get_indexes(table)]
+    parent = db.File.alias()
+    parents = dict(db.File.select(db.File.path, parent.path).join(parent, on=(db.File.parent == parent.id)).tuples())
+    return {
+        "version": db.db.pragma('user_version'),
+        "columns": {column.name for column in db.db.get_columns(table)},
+        "unique": [index.columns for index in db.db.get_indexes(table) if index.unique],
+        "indexed": all(columns in indexes for columns in (["bytes"], ["modified"], ["parent_path"])),
+        "rows": {path: (parent_path, depth, tree_bytes, tree_files, parents.get(path)) for
+                 path, parent_path, depth, tree_bytes, tree_files in
+                 db.File.select(db.File.path, db.File.parent_path, db.File.depth, db.File.tree_bytes,
+                                db.File.tree_files).tuples()},
+        "changes": db.changes(0)['changes'],
+    }
+
+
+def migrate_baseline():
+    import db
+    db.db.execute_sql('CREATE TABLE "file" ("id" INTEGER NOT NULL PRIMARY KEY, "path" VARCHAR(255) NOT NULL, '
+                      '"bytes" INTEGER NOT NULL, "is_dir" INTEGER NOT NULL, "modified" DATETIME NOT NULL, '
+                      '"size" VARCHAR(255) NOT NULL, "parent_id" INTEGER, '
+                      'FOREIGN KEY ("parent_id") REFERENCES "file" ("id"))')
+    for row in BASELINE_ROWS:
+        db.db.execute_sql('INSERT INTO "file" (id, path, bytes, is_dir, modified, size, parent_id) '
+                          'VALUES (?, ?, ?, ?, \'2016-06-29 10:37:12\', \'\', ?)', row)
+    db.migrate_schema()
+    return migrated()
+
+
+def migrate_version_4():
+    """Current schema but the change log, which came with version 5"""
+    import db
+    db.migrate_schema()
+    write([(db.WriteBehind.UPDATE, {path: node(path, 10 if path == "/a/f1" else 0, path != "/a/f1")
+                                    for path in ("/", "/a", "/a/f1")})])
+    db.Change.drop_table()
+    db.db.pragma('user_version', 4)
+    db.migrate_schema()
+    return migrated()
+
+
+def upsert(*nodes):
+    import db
+    with db.db.atomic():
+        db.upsert_nodes(nodes)
+
+
+def insert_unversioned(path, bytes):
+    """Row written before parent path, depth and totals were stored"""
+    import db
+    db.File.insert(path=path, bytes=bytes, is_dir=False, modified="2016-06-29 10:37:12", size="").execute()
+
+
+def rows():
+    """db path -> (bytes, content hash, parent path, depth, tree bytes, tree files, path of parent by parent_id)"""
+    import db
+    from peewee import JOIN
+    parent = db.File.alias()
+    return {path: tuple(info) for path, *info in
+            db.File.select(db.File.path, db.File.bytes, db.File.content_hash, db.File.parent_path, db.File.depth,
+                           db.File.tree_bytes, db.File.tree_files, parent.path)
+            .join(parent, join_type=JOIN.LEFT_OUTER, on=(db.File.parent == parent.id)).tuples()}
+
+
+def hashed(path, bytes, content_hash, modified=MODIFIED):
+    return dict(node(path, bytes), content_hash=content_hash, modified=modified)
+
+
+class TestMigrateSchema(DbTestCase):
+
+    def test_baseline_is_upgraded_to_current_version(self):
+        schema = self.in_db(in_other_db, migrate_baseline)
+        self.assertEqual(schema["version"], 5)
+        self.assertTrue({"content_hash", "parent_path", "depth", "tree_bytes", "tree_files"} <= schema["columns"])
+        self.assertIn(["path"], schema["unique"])
+        self.assertTrue(schema["indexed"])
+        # the latest of duplicates is kept, children are moved to it
+        self.assertDictEqual(schema["rows"], {
+            "/": (None, 0, 35, 3, None),
+            "/a": ("/", 1, 30, 2, "/"),
+            "/a/f1": ("/a", 2, 10, 1, "/a"),
+            "/a/b": ("/a", 2, 20, 1, "/a"),
+            "/a/b/f2": ("/a/b", 3, 20, 1, "/a/b"),
+            "/c": ("/", 1, 5, 1, "/"),
+        })
+        self.assertListEqual(schema["changes"], [])
+
+    def test_change_log_is_created_in_version_4(self):
+        schema = self.in_db(in_other_db, migrate_version_4)
+        self.assertEqual(schema["version"], 5)
+        self.assertEqual(schema["rows"]["/"], (None, 0, 10, 1, None))
+        self.assertListEqual(schema["changes"], [])
+
+
+class TestUpsertNodes(DbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_db(upsert, node("/", is_dir=True), node("/a", is_dir=True), hashed("/a/f", 10, "h1"))
+
+    def test_content_hash_of_unchanged_file_is_kept(self):
+        self.in_db(upsert, node("/a/f", 10))
+        self.assertEqual(self.in_db(rows)["/a/f"][1], "h1")
+        self.in_db(upsert, hashed("/a/f", 10, "h2"))
+        self.assertEqual(self.in_db(rows)["/a/f"][1], "h2")
+
+    def test_content_hash_of_changed_file_is_dropped(self):
+        self.in_db(upsert, node("/a/f", 12))
+        self.assertEqual(self.in_db(rows)["/a/f"][:2], (12, None))
+        self.in_db(upsert, hashed("/a/f", 12, "h2"))
+        self.in_db(upsert, hashed("/a/f", 12, None, "Thu, 30 Jun 2016 10:37:12"))
+        self.assertIsNone(self.in_db(rows)["/a/f"][1])
+
+    def test_totals_of_folders_are_kept(self):
+        self.in_db(upsert, node("/a/f", 12))
+        self.in_db(upsert, node("/", is_dir=True), dict(node("/a", is_dir=True), modified="Thu, 30 Jun 2016 10:37:12"))
+        indexed = self.in_db(rows)
+        self.assertEqual(indexed["/"][4:6], (12, 1))
+        self.assertEqual(indexed["/a"][4:6], (12, 1))
+        self.assertEqual(indexed["/a/f"][4:6], (12, 1))
+
+    def test_parent_path_and_depth_are_filled_in(self):
+        self.in_db(insert_unversioned, "/a/g", 5)
+        self.assertEqual(self.in_db(rows)["/a/g"][2:], (None, 0, 0, 0, None))
+        self.in_db(upsert, node("/a/g", 5))
+        self.assertEqual(self.in_db(rows)["/a/g"][2:], ("/a", 2, 5, 1, "/a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
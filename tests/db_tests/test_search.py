@@ -0,0 +1,77 @@
+import datetime
+import os
+import unittest
+
+from db_tests import DbTestCase
+
+QUERIES = [
+    {"name": "*.pdf"},
+    {"contains": "EPO"},
+    {"prefix": "report", "is_dir": False},
+    {"contains": "%"},
+    {"min_bytes": 50, "max_bytes": 100, "is_dir": False},
+    {"modified_before": datetime.datetime(2017, 1, 1)},
+    {"name": "*.pdf", "limit": 1},
+    {"name": "*.pdf", "limit": 1, "cursor": "/docs/Reports/q1.pdf"},
+]
+
+
+def make_tree():
+    """Files of fs_tests/test_search.py indexed from disk"""
+    import reindex
+    from tornado.options import options
+    os.makedirs(os.path.join(options.storage_path, "docs", "Reports"))
+    os.makedirs(os.path.join(options.storage_path, "docs-old"))
+    for name, size in (("docs/Reports/q1.pdf", 300), ("docs/notes.txt", 10), ("docs/100%.txt", 1),
+                       ("docs/report.pdf", 100), ("docs-old/report.pdf", 50)):
+        with open(os.path.join(options.storage_path, name), "wb") as f:
+            f.write(b"x" * size)
+    old = datetime.datetime(2016, 6, 29).timestamp()
+    os.utime(os.path.join(options.storage_path, "docs/notes.txt"), (old, old))
+    reindex.full(reindex.Reindex(1), 1000)
+
+
+def search(path, use_name_index, **arguments):
+    """Found by db (with or without name index) and by walking the disk"""
+    import db
+    import fs
+    indexed, db.name_index = db.name_index, use_name_index and db.name_index
+    try:
+        return db.search(path, **arguments), fs.Worker(path).search(**arguments)
+    finally:
+        db.name_index = indexed
+
+
+def name_index():
+    import db
+    return db.name_index
+
+
+class TestSearch(DbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_db(make_tree)
+
+    def test_name_index_is_used(self):
+        if not self.in_db(name_index):
+            self.skipTest("sqlite is built without FTS5 trigram tokenizer")
+        found, _ = self.in_db(search, "/docs", True, name="*.pdf")
+        self.assertListEqual([node['path'] for node in found['results']], ["/docs/Reports/q1.pdf", "/docs/report.pdf"])
+
+    def test_same_results_as_walking_the_disk(self):
+        for use_name_index in (True, False):
+            for path in ("/", "/docs"):
+                for arguments in QUERIES:
+                    with self.subTest(path=path, name_index=use_name_index, **arguments):
+                        found, walked = self.in_db(search, path, use_name_index, **arguments)
+                        self.assertDictEqual(found, walked)
+
+    def test_cursor_of_results_without_path(self):
+        found, walked = self.in_db(search, "/", True, is_dir=False, limit=2, fields=('bytes',))
+        self.assertDictEqual(found, walked)
+        self.assertEqual(found["next_cursor"], "/docs/100%.txt")
+
+
+if __name__ == "__main__":
+    unittest.main()
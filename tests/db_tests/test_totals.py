@@ -0,0 +1,68 @@
+import os
+import unittest
+
+from db_tests import DbTestCase, node, updates, write
+
+
+def upload(path, bytes):
+    write([updates(path, bytes)])
+
+
+def delete(path, is_dir=False):
+    write([updates(os.path.dirname(path), is_dir=True), ("delete", node(path, is_dir=is_dir))])
+
+
+def move(source, target):
+    write([updates(os.path.dirname(target), is_dir=True), ("move", dict(node(target, is_dir=True), source=source))])
+
+
+def totals():
+    """db path -> (tree bytes, tree files) of every node"""
+    import db
+    return {path: (tree_bytes, tree_files) for path, tree_bytes, tree_files in
+            db.File.select(db.File.path, db.File.tree_bytes, db.File.tree_files).tuples()}
+
+
+class TestTotals(DbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_db(upload, "/a/b/f1", 10)
+        self.in_db(upload, "/a/f2", 5)
+        self.in_db(upload, "/c/f3", 1)
+
+    def test_upload_is_added_to_every_ancestor(self):
+        self.assertDictEqual(self.in_db(totals), {
+            "/": (16, 3), "/a": (15, 2), "/a/b": (10, 1), "/a/b/f1": (10, 1), "/a/f2": (5, 1),
+            "/c": (1, 1), "/c/f3": (1, 1),
+        })
+
+    def test_overwrite_adds_difference_of_sizes(self):
+        self.in_db(upload, "/a/b/f1", 4)
+        indexed = self.in_db(totals)
+        self.assertEqual(indexed["/a/b/f1"], (4, 1))
+        self.assertEqual(indexed["/a/b"], (4, 1))
+        self.assertEqual(indexed["/a"], (9, 2))
+        self.assertEqual(indexed["/"], (10, 3))
+
+    def test_deleted_file_is_subtracted(self):
+        self.in_db(delete, "/a/b/f1")
+        indexed = self.in_db(totals)
+        self.assertEqual(indexed["/a/b"], (0, 0))
+        self.assertEqual(indexed["/a"], (5, 1))
+        self.assertEqual(indexed["/"], (6, 2))
+
+    def test_deleted_folder_is_subtracted(self):
+        self.in_db(delete, "/a", is_dir=True)
+        self.assertDictEqual(self.in_db(totals), {"/": (1, 1), "/c": (1, 1), "/c/f3": (1, 1)})
+
+    def test_moved_folder_is_moved_between_ancestors(self):
+        self.in_db(move, "/a/b", "/c/d/b")
+        self.assertDictEqual(self.in_db(totals), {
+            "/": (16, 3), "/a": (5, 1), "/a/f2": (5, 1),
+            "/c": (11, 2), "/c/f3": (1, 1), "/c/d": (10, 1), "/c/d/b": (10, 1), "/c/d/b/f1": (10, 1),
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
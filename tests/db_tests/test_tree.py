@@ -0,0 +1,104 @@
+import os
+import unittest
+
+from db_tests import DbTestCase
+
+ARGUMENTS = [
+    {},
+    {"depth": 0},
+    {"depth": 1},
+    {"depth": 2},
+    {"limit": 2},
+    {"limit": 2, "depth": 1},
+    {"limit": 1, "cursor": "a-b"},
+    {"cursor": "zzz"},
+    {"fields": ("path",)},
+    {"fields": ("bytes", "is_dir"), "depth": 2},
+    # handlers pass fields in the order of `fs.Worker.NODE_FIELDS`
+    {"fields": ("size", "modified"), "limit": 2},
+]
+
+
+def make_tree():
+    """Files indexed from disk. "a-b" sorts between "a" and its children ("-" < "/")"""
+    import reindex
+    from tornado.options import options
+    for name, size in (("a/f1", 10), ("a/b/f2", 20), ("a/b/c/f3", 30), ("a-b/f", 1), ("d/f4", 5), ("g", 7)):
+        path = os.path.join(options.storage_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+    os.makedirs(os.path.join(options.storage_path, "e"))
+    reindex.full(reindex.Reindex(1), 1000)
+
+
+def trees(path, **arguments):
+    """Built from index and by walking the disk"""
+    import db
+    import fs
+    return db.get_tree(path, **arguments), fs.Worker(path).get_tree(**arguments)
+
+
+def walks(path, **arguments):
+    import db
+    import fs
+    return list(db.walk(path, **arguments)), list(fs.Worker(path).walk(**arguments))
+
+
+def pages(get, path, limit, **arguments):
+    """Direct children of all pages of the folder and cursors of the pages"""
+    children, cursors, cursor = [], [], None
+    while True:
+        tree = get(path, limit=limit, cursor=cursor, **arguments)
+        children.extend(child['path'] for child in tree['children'])
+        cursor = tree.get('next_cursor')
+        if cursor is None:
+            return children, cursors
+        cursors.append(cursor)
+
+
+def indexed_pages(path, limit):
+    import db
+    return pages(db.get_tree, path, limit, depth=1)
+
+
+def walked_pages(path, limit):
+    import fs
+    return pages(lambda path, **arguments: fs.Worker(path).get_tree(**arguments), path, limit, depth=1)
+
+
+class TestTree(DbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_db(make_tree)
+
+    def test_same_tree_as_walking_the_disk(self):
+        for path in ("/", "/a"):
+            for arguments in ARGUMENTS:
+                with self.subTest(path=path, **arguments):
+                    indexed, walked = self.in_db(trees, path, **arguments)
+                    self.assertDictEqual(indexed, walked)
+
+    def test_same_walk_as_walking_the_disk(self):
+        for path in ("/", "/a", "/a/f1"):
+            for arguments in ARGUMENTS:
+                with self.subTest(path=path, **arguments):
+                    indexed, walked = self.in_db(walks, path, **arguments)
+                    self.assertListEqual(indexed, walked)
+
+    def test_pages_cover_all_children_once(self):
+        for limit in (1, 2, 3, 6):
+            with self.subTest(limit=limit):
+                children, cursors = self.in_db(indexed_pages, "/", limit)
+                self.assertListEqual(children, ["/a", "/a-b", "/d", "/e", "/g"])
+                self.assertTupleEqual((children, cursors), self.in_db(walked_pages, "/", limit))
+
+    def test_file_has_no_children(self):
+        indexed, walked = self.in_db(trees, "/g", depth=1)
+        self.assertDictEqual(indexed, walked)
+        self.assertNotIn("children", indexed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+import concurrent.futures
+import unittest
+
+from db_tests import DbTestCase, node, write
+
+
+def chain(path, bytes=0, is_dir=False):
+    """Node with the chain of its ancestors from the root, see `fs.Worker.get_updated_info`"""
+    names = path.strip("/").split("/")
+    top = current = node("/", is_dir=True)
+    for level in range(1, len(names)):
+        current['children'] = node("/" + "/".join(names[:level]), is_dir=True)
+        current = current['children']
+    current['children'] = node(path, bytes, is_dir)
+    return top
+
+
+def create_tree():
+    import db
+    write([(db.WriteBehind.UPDATE, {path: node(path, 10 if "/f" in path else 0, "/f" not in path)
+                                    for path in ("/", "/a", "/a/f1", "/a/f2", "/b")})])
+
+
+def indexed():
+    """db path -> (bytes, tree bytes, tree files)"""
+    import db
+    return {path: (bytes, tree_bytes, tree_files) for path, bytes, tree_bytes, tree_files in
+            db.File.select(db.File.path, db.File.bytes, db.File.tree_bytes, db.File.tree_files).tuples()}
+
+
+def write_behind(changes, errors=()):
+    """
+    Queue `changes` [(method of `db.WriteBehind`, *arguments)] to a new writer and wait until they are written
+    on an IOLoop. The first writes fail with `errors`, one each, then the writer is flushed again as when
+    the retry is due
+    :return: (written rows, writer stats, number of callbacks called after each write)
+    """
+    import db
+    import tornado.gen
+    import tornado.ioloop
+    writer = db.WriteBehind(delay=60000, batch=1000)
+    failing = list(errors)
+    called = []
+
+    def sink(queue):
+        if not failing:
+            return db.writer_executor.submit(writer._write, queue)
+        future = concurrent.futures.Future()
+        future.set_exception(failing.pop(0))
+        return future
+
+    @tornado.gen.coroutine
+    def run():
+        writer.sink = sink
+        for method, *arguments in changes:
+            getattr(writer, method)(*arguments, callback=lambda: called.append(None))
+        callbacks = []
+        for _ in range(len(errors) + 1):
+            try:
+                yield writer.flush()
+            except Exception:
+                pass
+            while writer._writing:
+                yield tornado.gen.moment
+            callbacks.append(len(called))
+        return callbacks
+
+    io_loop = tornado.ioloop.IOLoop()
+    try:
+        callbacks = io_loop.run_sync(run)
+    finally:
+        io_loop.close()
+    stats = writer.stats()
+    return indexed(), {name: stats[name] for name in ("pending", "coalesced", "transactions", "failures")}, callbacks
+
+
+def update(path, bytes=0, is_dir=False):
+    return "update", chain(path, bytes, is_dir)
+
+
+def delete(path, is_dir=False):
+    return "delete", chain(path, is_dir=is_dir)
+
+
+def read_fresh(path):
+    """
+    Listing of `path` read by `db.read_fresh` while an upload into /a waits in the queue of the writer
+    :return: (names of children, bytes of /a/f1, is the upload still queued after the read)
+    """
+    import db
+    import tornado.gen
+    import tornado.ioloop
+
+    @tornado.gen.coroutine
+    def run():
+        delay, db.writer.delay = db.writer.delay, 60000
+        try:
+            db.writer.update(chain("/a/f1", 11))
+            db.writer.update(chain("/a/f3", 5))
+            tree = yield db.read_fresh(path, db.get_tree, depth=1)
+            pending = db.writer.pending("/a")
+            yield db.writer.flush()
+        finally:
+            db.writer.delay = delay
+        children = {child['path']: child['bytes'] for child in tree['children']}
+        return sorted(children), children.get("/a/f1"), pending
+
+    io_loop = tornado.ioloop.IOLoop()
+    try:
+        return io_loop.run_sync(run)
+    finally:
+        io_loop.close()
+
+
+class TestWriteBehind(DbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_db(create_tree)
+
+    def test_updates_of_the_same_path_are_written_once(self):
+        rows, stats, callbacks = self.in_db(write_behind, [update("/a/f1", 11), update("/a/f3", 5),
+                                                           update("/a/f1", 12)])
+        # ancestors of every change and the second update of /a/f1
+        self.assertEqual(stats["coalesced"], 5)
+        self.assertEqual(stats["transactions"], 1)
+        self.assertListEqual(callbacks, [3])
+        self.assertEqual(rows["/a/f1"], (12, 12, 1))
+        self.assertEqual(rows["/a"], (0, 27, 3))
+        self.assertEqual(rows["/"], (0, 27, 3))
+
+    def test_the_last_of_update_and_delete_of_the_same_path_wins(self):
+        rows, _, _ = self.in_db(write_behind, [update("/a/f1", 11), delete("/a/f1"),
+                                               delete("/a/f2"), update("/a/f2", 7)])
+        self.assertNotIn("/a/f1", rows)
+        self.assertEqual(rows["/a/f2"], (7, 7, 1))
+        self.assertEqual(rows["/"], (0, 7, 1))
+        rows, _, _ = self.in_db(write_behind, [update("/a/g", 1), delete("/a", is_dir=True)])
+        self.assertListEqual(sorted(rows), ["/", "/b"])
+        self.assertEqual(rows["/"], (0, 0, 0))
+
+    def test_changes_are_retried_after_operational_error(self):
+        import peewee
+        rows, stats, callbacks = self.in_db(write_behind, [update("/a/f1", 11), delete("/a/f2")],
+                                            [peewee.OperationalError("database is locked")])
+        self.assertEqual((stats["failures"], stats["transactions"], stats["pending"]), (1, 1, 0))
+        # callbacks are called when changes are written, not when the first write fails
+        self.assertListEqual(callbacks, [0, 2])
+        self.assertEqual(rows["/a/f1"], (11, 11, 1))
+        self.assertNotIn("/a/f2", rows)
+        self.assertEqual(rows["/"], (0, 11, 1))
+
+    def test_callbacks_are_called_when_changes_are_dropped(self):
+        rows, stats, callbacks = self.in_db(write_behind, [update("/a/f1", 11), delete("/a/f2")],
+                                            [ValueError("not a db error")])
+        self.assertEqual((stats["failures"], stats["transactions"], stats["pending"]), (1, 0, 0))
+        self.assertListEqual(callbacks, [2, 2])
+        self.assertEqual(rows["/a/f1"], (10, 10, 1))
+        self.assertIn("/a/f2", rows)
+
+
+class TestReadFresh(DbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.in_db(create_tree)
+
+    def test_queued_changes_inside_of_folder_are_written_before_reading_it(self):
+        children, bytes, pending = self.in_db(read_fresh, "/a")
+        self.assertListEqual(children, ["/a/f1", "/a/f2", "/a/f3"])
+        self.assertEqual(bytes, 11)
+        self.assertFalse(pending)
+
+    def test_queued_changes_elsewhere_are_not_written(self):
+        children, _, pending = self.in_db(read_fresh, "/b")
+        self.assertListEqual(children, [])
+        self.assertTrue(pending)
+
+
+if __name__ == "__main__":
+    unittest.main()
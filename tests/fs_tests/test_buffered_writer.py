@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from tornado.options import define, options
+
+from fs import BufferedWriter
+
+if "upload_writer_threads" not in options:
+    define("upload_writer_threads", 2)
+
+
+class TestBufferedWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.fo = tempfile.TemporaryFile()
+        self.writer = BufferedWriter(self.fo.fileno(), buffer_size=4, max_pending=100)
+
+    def tearDown(self):
+        self.fo.close()
+
+    def content(self):
+        self.fo.seek(0)
+        return self.fo.read()
+
+    def test_chunks_are_written_in_order(self):
+        for chunk in (b"ab", b"cdefg", b"h", b"ijklmnopq"):
+            self.writer.write(chunk)
+        self.writer.flush().result()
+        self.assertEqual(self.content(), b"abcdefghijklmnopq")
+
+    def test_only_full_blocks_are_written_before_flush(self):
+        self.writer.write(b"abcdef")
+        self.writer.when_idle(lambda pending: None).result()
+        self.assertEqual(self.content(), b"abcd")
+        self.assertEqual(self.writer.written, 6)
+
+    def test_future_returned_when_too_many_blocks_pending(self):
+        writer = BufferedWriter(self.fo.fileno(), buffer_size=1, max_pending=2)
+        waits = [writer.write(b"xx") for _ in range(3)]
+        self.assertTrue(any(wait is not None for wait in waits))
+        writer.flush().result()
+        self.assertEqual(self.content(), b"xxxxxx")
+
+    def test_write_error_is_raised_on_flush(self):
+        fd = os.open(os.devnull, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        writer = BufferedWriter(fd, buffer_size=1, max_pending=100)
+        writer.write(b"x")
+        with self.assertRaises(OSError):
+            writer.flush().result()
+
+    def test_abort_reports_saved_offset(self):
+        writer = BufferedWriter(self.fo.fileno(), buffer_size=4, max_pending=100, offset=2)
+        writer.write(b"abcdefghij")
+        self.assertEqual(writer.abort(lambda saved: saved).result(), 10)
+
+    def test_abort_can_keep_buffered_data(self):
+        writer = BufferedWriter(self.fo.fileno(), buffer_size=4, max_pending=100, offset=2)
+        writer.write(b"abcdefghij")
+        self.assertEqual(writer.abort(lambda saved: saved, keep_buffered=True).result(), 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from tornado.options import define, options
+
+from fs import Worker, copy_executor, copy_range, copy_tree
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+if "upload_staging_dir" not in options:
+    define("upload_staging_dir", "")
+if "upload_deduplicate" not in options:
+    define("upload_deduplicate", False, type=bool)
+if "upload_writer_threads" not in options:
+    define("upload_writer_threads", 2)
+if "copy_threads" not in options:
+    define("copy_threads", 2)
+
+
+class TestCopy(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self._deduplicate = options.upload_deduplicate
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+        self.make_tree()
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        options.upload_deduplicate = self._deduplicate
+        self.tmp.cleanup()
+
+    def abspath(self, path):
+        return os.path.join(self.tmp.name, path)
+
+    def make_tree(self):
+        os.makedirs(self.abspath("a/b"))
+        for name in ("a/file", "a/b/file"):
+            with open(self.abspath(name), "w") as f:
+                f.write(name)
+        os.symlink("file", self.abspath("a/link"))
+        for name in ("a/b/file", "a/b", "a"):
+            os.utime(self.abspath(name), (1000000000, 1000000000))
+
+    def test_tree_is_copied_with_modification_times(self):
+        copy_tree(self.abspath("a"), self.abspath("c"))
+        with open(self.abspath("c/b/file")) as f:
+            self.assertEqual(f.read(), "a/b/file")
+        self.assertEqual(os.readlink(self.abspath("c/link")), "file")
+        for name in ("c/b/file", "c/b", "c"):
+            self.assertEqual(os.stat(self.abspath(name)).st_mtime, 1000000000)
+        self.assertFalse(os.path.samefile(self.abspath("a/file"), self.abspath("c/file")))
+
+    def test_deduplicated_file_is_copied_as_hard_link(self):
+        options.upload_deduplicate = True
+        with open(self.abspath("staged"), "w") as f:
+            f.write("contents")
+        Worker.publish_deduplicated(self.abspath("staged"), self.abspath("a/dedup"), "ab" * 32)
+        Worker("/a/").copy_to(Worker("/c/"), {"/a/dedup": "ab" * 32, "/a/file": "cd" * 32}).result()
+        self.assertTrue(os.path.samefile(self.abspath("a/dedup"), self.abspath("c/dedup")))
+        # file which is not linked to its blob may be changed in place, so it's not shared by copies
+        self.assertFalse(os.path.samefile(self.abspath("a/file"), self.abspath("c/file")))
+
+    def test_files_are_copied_by_their_own_threads(self):
+        copied_by = copy_executor().submit(lambda: threading.current_thread().name).result()
+        self.assertTrue(copied_by.startswith("copy"))
+
+    def test_range_is_copied(self):
+        with open(self.abspath("big"), "wb") as f:
+            f.write(os.urandom(3 * 1024 + 5))
+        with open(self.abspath("big"), "rb") as src, open(self.abspath("copy"), "wb") as dst:
+            copy_range(src.fileno(), dst.fileno(), 2 * 1024 + 3, block_size=1024)
+        with open(self.abspath("big"), "rb") as src, open(self.abspath("copy"), "rb") as dst:
+            self.assertEqual(dst.read(), src.read(2 * 1024 + 3))
+
+    def test_worker_copies_folder_to_free_path_only(self):
+        Worker("/a/").copy_to(Worker("/c/")).result()
+        self.assertTrue(os.path.isfile(self.abspath("c/b/file")))
+        with self.assertRaises(FileExistsError):
+            Worker("/a/b/").copy_to(Worker("/c/"))
+
+    def test_failed_copy_leaves_nothing_behind(self):
+        with self.assertRaises(FileNotFoundError):
+            Worker("/a/").copy_to(Worker("/missing/c/")).result()
+        self.assertListEqual(os.listdir(self.abspath(".staging")), [])
+
+    def test_worker_moves_folder(self):
+        source, target = Worker("/a/b/"), Worker("/c/")
+        source.move_to(target)
+        self.assertTrue(os.path.isfile(self.abspath("c/file")))
+        self.assertFalse(os.path.exists(self.abspath("a/b")))
+        self.assertEqual(source.updates['path'], "/a")
+        self.assertEqual(source.updates['children']['path'], "/a/b")
+        self.assertEqual(target.updates['children']['path'], "/c")
+        with self.assertRaises(FileExistsError):
+            Worker("/a/file").move_to(Worker("/c/file"))
+
+
+if __name__ == "__main__":
+    unittest.main()
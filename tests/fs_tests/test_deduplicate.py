@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from tornado.options import define, options
+
+from fs import Worker, blob_path, release_blobs
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+
+
+class TestDeduplicate(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        self.tmp.cleanup()
+
+    def upload(self, name, content_hash="ab" * 32):
+        staged = os.path.join(self.tmp.name, "staged")
+        with open(staged, "w") as f:
+            f.write("contents")
+        target = os.path.join(self.tmp.name, name)
+        Worker.publish_deduplicated(staged, target, content_hash)
+        self.assertFalse(os.path.exists(staged))
+        return target
+
+    def test_files_with_the_same_contents_share_blob(self):
+        first, second = self.upload("first"), self.upload("second")
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertEqual(os.stat(blob_path("ab" * 32)).st_nlink, 3)
+
+    def test_blob_is_released_with_the_last_file(self):
+        first, second = self.upload("first"), self.upload("second")
+        os.remove(first)
+        release_blobs(["ab" * 32])
+        self.assertTrue(os.path.exists(blob_path("ab" * 32)))
+        os.remove(second)
+        release_blobs(["ab" * 32, "cd" * 32])
+        self.assertFalse(os.path.exists(blob_path("ab" * 32)))
+
+    def test_existing_target_is_not_replaced(self):
+        with open(os.path.join(self.tmp.name, "first"), "w"):
+            pass
+        with self.assertRaises(FileExistsError):
+            self.upload("first")
+
+    def test_blob_released_during_upload_is_stored_again(self):
+        first = self.upload("first")
+        link = os.link
+
+        def delete_first(source, destination):
+            # the only file with these contents is deleted after staged one is found to be stored already
+            if source == blob_path("ab" * 32) and os.path.exists(first):
+                os.remove(first)
+                release_blobs(["ab" * 32])
+            link(source, destination)
+
+        with unittest.mock.patch("os.link", side_effect=delete_first):
+            second = self.upload("second")
+        self.assertTrue(os.path.samefile(second, blob_path("ab" * 32)))
+        self.assertEqual(os.stat(second).st_nlink, 2)
+
+    def test_missing_target_folder_is_not_retried(self):
+        with self.assertRaises(FileNotFoundError):
+            self.upload("missing/first")
+        self.assertTrue(os.path.exists(blob_path("ab" * 32)))
+
+
+if __name__ == "__main__":
+    unittest.main()
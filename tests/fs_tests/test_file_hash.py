@@ -0,0 +1,23 @@
+import hashlib
+import tempfile
+import unittest
+
+from fs import file_hash
+
+
+class TestFileHash(unittest.TestCase):
+
+    def test_hash_of_file_prefix_read_by_blocks(self):
+        with tempfile.TemporaryFile() as fo:
+            fo.write(b"0123456789" + b"\0" * 10)
+            fo.flush()
+            self.assertEqual(file_hash(fo.fileno(), 10, block_size=3).hexdigest(),
+                             hashlib.sha256(b"0123456789").hexdigest())
+
+    def test_empty_file(self):
+        with tempfile.TemporaryFile() as fo:
+            self.assertEqual(file_hash(fo.fileno(), 0).hexdigest(), hashlib.sha256().hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
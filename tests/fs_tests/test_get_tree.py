@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+
+from tornado.options import define, options
+
+from fs import Worker, page
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+if "upload_staging_dir" not in options:
+    define("upload_staging_dir", "")
+
+
+class TestPage(unittest.TestCase):
+
+    def test_names_are_sorted_and_no_cursor_returned_for_last_page(self):
+        self.assertEqual(page(["b", "c", "a"]), (["a", "b", "c"], None))
+
+    def test_limit_returns_cursor_of_last_name_on_page(self):
+        self.assertEqual(page(["b", "c", "a"], limit=2), (["a", "b"], "b"))
+
+    def test_cursor_skips_names_up_to_cursor_inclusive(self):
+        self.assertEqual(page(["b", "c", "a"], limit=2, cursor="b"), (["c"], None))
+
+    def test_cursor_does_not_have_to_exist(self):
+        self.assertEqual(page(["b", "d", "a"], cursor="c"), (["d"], None))
+
+
+class TestWorkerGetTree(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+        os.makedirs(os.path.join(self.tmp.name, "a", "b"))
+        for name in ("a/b/file", "a/file", "c"):
+            open(os.path.join(self.tmp.name, name), "w").close()
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        self.tmp.cleanup()
+
+    def paths(self, node):
+        return [node['path']] + [path for child in node.get('children', []) for path in self.paths(child)]
+
+    def test_whole_tree_by_default(self):
+        tree = Worker("/").get_tree()
+        self.assertListEqual(self.paths(tree), ["/", "/a", "/a/b", "/a/b/file", "/a/file", "/c"])
+
+    def test_depth_limits_levels_of_children(self):
+        tree = Worker("/").get_tree(depth=1)
+        self.assertListEqual(self.paths(tree), ["/", "/a", "/c"])
+        self.assertNotIn('children', tree['children'][0])
+
+    def test_depth_zero_returns_folder_itself(self):
+        self.assertNotIn('children', Worker("/a/").get_tree(depth=0))
+
+    def test_pagination_over_direct_children(self):
+        first = Worker("/").get_tree(depth=1, limit=1)
+        self.assertListEqual(self.paths(first), ["/", "/a"])
+        self.assertEqual(first['next_cursor'], "a")
+
+        second = Worker("/").get_tree(depth=1, limit=1, cursor=first['next_cursor'])
+        self.assertListEqual(self.paths(second), ["/", "/c"])
+        self.assertNotIn('next_cursor', second)
+
+    def test_staging_folder_is_hidden(self):
+        os.makedirs(os.path.join(self.tmp.name, ".staging"))
+        self.assertListEqual(self.paths(Worker("/").get_tree(depth=1)), ["/", "/a", "/c"])
+
+    def test_fields_selects_node_keys(self):
+        tree = Worker("/a/").get_tree(depth=1, fields=('path', 'is_dir'))
+        self.assertListEqual(list(tree.keys()), ['path', 'is_dir', 'children'])
+        self.assertListEqual(list(tree['children'][1].keys()), ['path', 'is_dir'])
+
+
+class TestWorkerUsage(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+        os.makedirs(os.path.join(self.tmp.name, "a", "b"))
+        os.makedirs(os.path.join(self.tmp.name, ".staging"))
+        for name, size in (("a/b/file", 3), ("a/file", 5), ("c", 7), (".staging/part", 11)):
+            with open(os.path.join(self.tmp.name, name), "wb") as f:
+                f.write(b"x" * size)
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        self.tmp.cleanup()
+
+    def test_files_of_whole_subtree_are_counted(self):
+        usage = Worker("/a/").usage()
+        self.assertEqual((usage['path'], usage['bytes'], usage['files']), ("/a", 8, 2))
+
+    def test_service_folders_are_not_counted(self):
+        usage = Worker("/").usage()
+        self.assertEqual((usage['bytes'], usage['files']), (15, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
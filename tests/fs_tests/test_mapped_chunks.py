@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+
+from fs import mapped_chunks
+
+
+class TestMappedChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.fo = tempfile.NamedTemporaryFile(delete=False)
+        self.fo.write(b"0123456789")
+        self.fo.close()
+
+    def tearDown(self):
+        os.remove(self.fo.name)
+
+    def read(self, *a, **kw):
+        return [bytes(chunk) for chunk in mapped_chunks(self.fo.name, *a, **kw)]
+
+    def test_whole_file_is_split_into_chunks(self):
+        self.assertEqual(self.read(chunk_size=4), [b"0123", b"4567", b"89"])
+
+    def test_range(self):
+        self.assertEqual(self.read(3, 8, chunk_size=4), [b"3456", b"7"])
+        self.assertEqual(self.read(7), [b"789"])
+
+    def test_empty_range_and_empty_file(self):
+        self.assertEqual(self.read(5, 5), [])
+        open(self.fo.name, "w").close()
+        self.assertEqual(self.read(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from tornado.options import define, options
+
+from fs import Path
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+if "upload_staging_dir" not in options:
+    define("upload_staging_dir", "")
+
+
+class TestPathDbPath(unittest.TestCase):
+
+    def test_root_folder_is_slash(self):
+        self.assertEqual(Path("/").db_path, "/")
+
+    def test_trailing_slash_is_stripped(self):
+        self.assertEqual(Path("/nested/dir/").db_path, "/nested/dir")
+
+    def test_file_path_is_unchanged(self):
+        self.assertEqual(Path("/nested/file").db_path, "/nested/file")
+
+    def test_uri_is_unquoted(self):
+        self.assertEqual(Path("/with%20space/").db_path, "/with space")
+
+
+
+class TestPathIsPublic(unittest.TestCase):
+
+    def test_path_inside_storage_is_public(self):
+        self.assertTrue(Path("/nested/file").is_public())
+        self.assertTrue(Path("/").is_public())
+
+    def test_path_outside_storage_is_not_public(self):
+        self.assertFalse(Path("/../etc/passwd").is_public())
+
+    def test_staging_folder_is_not_public(self):
+        self.assertFalse(Path("/.staging/").is_public())
+        self.assertFalse(Path("/.staging/tmpfile").is_public())
+        self.assertTrue(Path("/.staging-not-really").is_public())
+
+
+if __name__ == "__main__":
+    unittest.main()
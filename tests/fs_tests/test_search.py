@@ -0,0 +1,67 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from tornado.options import define, options
+
+from fs import Worker
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+if "upload_staging_dir" not in options:
+    define("upload_staging_dir", "")
+
+
+class TestWorkerSearch(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+        os.makedirs(os.path.join(self.tmp.name, "docs", "Reports"))
+        os.makedirs(os.path.join(self.tmp.name, "docs-old"))
+        for name, size in (("docs/Reports/q1.pdf", 300), ("docs/notes.txt", 10),
+                           ("docs/report.pdf", 100), ("docs-old/report.pdf", 50)):
+            with open(os.path.join(self.tmp.name, name), "wb") as f:
+                f.write(b"x" * size)
+        old = datetime.datetime(2016, 6, 29).timestamp()
+        os.utime(os.path.join(self.tmp.name, "docs/notes.txt"), (old, old))
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        self.tmp.cleanup()
+
+    def paths(self, found):
+        return [node['path'] for node in found['results']]
+
+    def test_glob_is_matched_against_whole_name(self):
+        self.assertListEqual(self.paths(Worker("/docs/").search(name="*.pdf")),
+                             ["/docs/Reports/q1.pdf", "/docs/report.pdf"])
+
+    def test_substring_and_prefix_are_case_insensitive(self):
+        self.assertListEqual(self.paths(Worker("/docs/").search(contains="EPO")),
+                             ["/docs/Reports", "/docs/report.pdf"])
+        self.assertListEqual(self.paths(Worker("/").search(prefix="report", is_dir=False)),
+                             ["/docs-old/report.pdf", "/docs/report.pdf"])
+
+    def test_size_and_modification_time_ranges(self):
+        self.assertListEqual(self.paths(Worker("/").search(min_bytes=50, max_bytes=100, is_dir=False)),
+                             ["/docs-old/report.pdf", "/docs/report.pdf"])
+        self.assertListEqual(self.paths(Worker("/docs/").search(modified_before=datetime.datetime(2017, 1, 1))),
+                             ["/docs/notes.txt"])
+
+    def test_results_are_paginated_by_path(self):
+        first = Worker("/").search(name="*.pdf", limit=2)
+        self.assertListEqual(self.paths(first), ["/docs-old/report.pdf", "/docs/Reports/q1.pdf"])
+        second = Worker("/").search(name="*.pdf", limit=2, cursor=first['next_cursor'])
+        self.assertListEqual(self.paths(second), ["/docs/report.pdf"])
+        self.assertNotIn('next_cursor', second)
+
+    def test_fields_select_node_keys(self):
+        found = Worker("/docs/").search(name="notes.txt", fields=('path', 'bytes'))
+        self.assertListEqual(found['results'], [{"path": "/docs/notes.txt", "bytes": 10}])
+
+
+if __name__ == "__main__":
+    unittest.main()
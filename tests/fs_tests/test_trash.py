@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+from tornado.options import define, options
+
+from fs import Path, Reaper, Worker, blob_path, move_to_trash, trash_dir
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+if "upload_deduplicate" not in options:
+    define("upload_deduplicate", False, type=bool)
+
+
+class TestTrash(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self._deduplicate = options.upload_deduplicate
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+        self.reaper = Reaper(0)
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        options.upload_deduplicate = self._deduplicate
+        self.tmp.cleanup()
+
+    def make_tree(self, top, files=3, depth=2):
+        folder = os.path.join(self.tmp.name, top)
+        for level in range(depth):
+            folder = os.path.join(folder, "level{}".format(level))
+            os.makedirs(folder)
+            for i in range(files):
+                with open(os.path.join(folder, "file{}".format(i)), "w") as f:
+                    f.write("contents")
+        return os.path.join(self.tmp.name, top)
+
+    def test_deleted_folder_is_moved_to_trash_and_emptied(self):
+        folder = self.make_tree("a")
+        trashed = move_to_trash(folder)
+        self.assertFalse(os.path.exists(folder))
+        self.assertEqual(os.path.dirname(trashed), trash_dir())
+        self.reaper.empty(trashed).result()
+        self.assertListEqual(os.listdir(trash_dir()), [])
+        self.assertEqual(self.reaper.removed, 9)  # 6 files and 3 folders
+        self.assertEqual(self.reaper.stats()['pending'], 0)
+
+    def test_trash_left_by_stopped_server_is_emptied(self):
+        move_to_trash(self.make_tree("a"))
+        move_to_trash(self.make_tree("b"))
+        self.reaper.sweep()
+        self.reaper._executor.shutdown()
+        self.assertListEqual(os.listdir(trash_dir()), [])
+        self.assertEqual(self.reaper.emptied, 2)
+
+    def test_worker_moves_folder_to_trash(self):
+        self.make_tree("a")
+        worker = Worker("/a/")
+        worker.remove_file_or_folder()
+        self.assertTrue(worker.trashed.startswith(trash_dir()))
+        self.assertTrue(os.path.isdir(worker.trashed))
+
+    def test_trash_is_not_accessible_by_uri(self):
+        self.assertFalse(Path("/.trash/").is_public())
+
+    def test_blobs_of_reaped_files_are_released(self):
+        options.upload_deduplicate = True
+        os.makedirs(os.path.join(self.tmp.name, "a"))
+        staged = os.path.join(self.tmp.name, "staged")
+        with open(staged, "w") as f:
+            f.write("contents")
+        Worker.publish_deduplicated(staged, os.path.join(self.tmp.name, "a", "file"), "ab" * 32)
+        self.reaper.empty(move_to_trash(os.path.join(self.tmp.name, "a"))).result()
+        self.assertFalse(os.path.exists(blob_path("ab" * 32)))
+
+
+if __name__ == "__main__":
+    unittest.main()
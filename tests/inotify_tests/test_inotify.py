@@ -0,0 +1,59 @@
+import errno
+import os
+import struct
+import tempfile
+import unittest
+
+from inotify import Inotify, parse_events, IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO
+
+
+class TestParseEvents(unittest.TestCase):
+
+    def test_names_are_padded_with_zeros(self):
+        buffer = (struct.pack("iIII", 1, IN_CREATE, 0, 16) + b"file\0" + b"\0" * 11 +
+                  struct.pack("iIII", 2, IN_CREATE | IN_ISDIR, 0, 0))
+        self.assertListEqual(list(parse_events(buffer)), [(1, IN_CREATE, 0, "file"), (2, IN_CREATE | IN_ISDIR, 0, "")])
+
+
+class TestInotify(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            self.skipTest(e.strerror)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.inotify.close()
+        self.tmp.cleanup()
+
+    def test_events_of_watched_folder(self):
+        wd = self.inotify.add_watch(self.tmp.name)
+        self.assertListEqual(self.inotify.read(), [])
+        with open(os.path.join(self.tmp.name, "file"), "w") as f:
+            f.write("contents")
+        os.mkdir(os.path.join(self.tmp.name, "folder"))
+        os.rename(os.path.join(self.tmp.name, "file"), os.path.join(self.tmp.name, "renamed"))
+        events = [(event_wd, mask, name) for event_wd, mask, _, name in self.inotify.read()]
+        self.assertListEqual(events, [
+            (wd, IN_CREATE, "file"),
+            (wd, IN_CLOSE_WRITE, "file"),
+            (wd, IN_CREATE | IN_ISDIR, "folder"),
+            (wd, IN_MOVED_FROM, "file"),
+            (wd, IN_MOVED_TO, "renamed"),
+        ])
+
+    def test_the_same_folder_has_one_watch(self):
+        self.assertEqual(self.inotify.add_watch(self.tmp.name), self.inotify.add_watch(self.tmp.name))
+
+    def test_only_folders_are_watched(self):
+        path = os.path.join(self.tmp.name, "file")
+        open(path, "w").close()
+        with self.assertRaises(OSError) as raised:
+            self.inotify.add_watch(path)
+        self.assertEqual(raised.exception.errno, errno.ENOTDIR)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from locks import Conflict, LockManager, IS, IX, S, X, ancestors
+
+
+class TestAncestors(unittest.TestCase):
+
+    def test_ancestors_from_root(self):
+        self.assertListEqual(ancestors("/a/b/c"), ["/", "/a", "/a/b"])
+        self.assertListEqual(ancestors("/a"), ["/"])
+        self.assertListEqual(ancestors("/"), [])
+
+
+class TestLockManager(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.locks = LockManager()
+
+    def acquire(self, path, mode, timeout=0):
+        lock = self.locks.lock(path, mode)
+        future = lock.acquire(timeout)
+        return lock, future
+
+    def assertConflict(self, path, mode, on):
+        _, future = self.acquire(path, mode)
+        with self.assertRaises(Conflict) as raised:
+            future.result()
+        self.assertEqual(raised.exception.path, on)
+
+    def test_downloads_share_the_file_and_folder(self):
+        self.acquire("/a/file", S)
+        self.acquire("/a/file", S)[1].result()
+        self.acquire("/a/other", S)[1].result()
+        self.acquire("/a", IS)[1].result()
+
+    def test_listing_and_downloads_during_upload(self):
+        self.acquire("/a/b/upload", X)
+        self.acquire("/a/b", IS)[1].result()
+        self.acquire("/a/b/file", S)[1].result()
+        self.acquire("/a/b/other", X)[1].result()
+        self.assertTrue(self.locks.locked("/a/b/upload"))
+        self.assertFalse(self.locks.locked("/a/b"))
+
+    def test_writes_conflict_with_the_same_path_and_paths_inside(self):
+        self.acquire("/a/b/upload", X)
+        self.assertConflict("/a/b/upload", S, on="/a/b/upload")
+        self.assertConflict("/a/b", X, on="/a/b")
+        self.assertConflict("/a/b/upload/file", X, on="/a/b/upload")
+        self.assertEqual(self.locks.conflicts, 3)
+
+    def test_released_lock_frees_its_paths(self):
+        lock, _ = self.acquire("/a/b", X)
+        lock.release()
+        lock.release()
+        self.acquire("/a", X)[1].result()
+        self.assertEqual(self.locks.stats()['locked_paths'], 2)  # "/" and "/a"
+
+    @gen_test
+    def test_waiting_lock_is_acquired_when_conflicting_one_is_released(self):
+        upload, _ = self.acquire("/a/file", X)
+        _, waiting = self.acquire("/a/file", S, timeout=5)
+        self.assertFalse(waiting.done())
+        upload.release()
+        lock = yield waiting
+        self.assertTrue(lock.acquired)
+
+    @gen_test
+    def test_waiting_lock_times_out(self):
+        self.acquire("/a", X)
+        with self.assertRaises(Conflict):
+            yield self.acquire("/a/file", S, timeout=0.01)[1]
+        self.assertEqual(self.locks.timeouts, 1)
+        self.assertEqual(self.locks.stats()['waiting'], 0)
+
+    def test_new_lock_does_not_jump_ahead_of_conflicting_waiting_one(self):
+        download, _ = self.acquire("/a/file", S)
+        _, delete = self.acquire("/a/file", X, timeout=5)
+        _, second = self.acquire("/a/file", S, timeout=5)
+        self.assertFalse(second.done())
+        download.release()
+        self.assertTrue(delete.done())
+        self.assertFalse(second.done())
+
+    def test_waiting_is_stopped_by_release(self):
+        self.acquire("/a", X)
+        lock, waiting = self.acquire("/a", IX, timeout=5)
+        lock.release()
+        self.assertIsInstance(waiting.exception(), Conflict)
+        self.assertEqual(self.locks.stats()['waiting'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import errno
+import multiprocessing
+import unittest
+
+from quota import Quotas, parse_limits, parse_size
+
+
+class TestParseLimits(unittest.TestCase):
+
+    def test_sizes_with_suffixes(self):
+        self.assertEqual(parse_size("512"), 512)
+        self.assertEqual(parse_size("10k"), 10 * 1024)
+        self.assertEqual(parse_size("2G"), 2 * 1024 ** 3)
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            parse_size("10GB")
+
+    def test_lines_of_folder_bytes_and_files(self):
+        self.assertDictEqual(parse_limits("\n/users/alice/ 1M 100\n/shared - 5\n/tmp 1K"), {
+            "/users/alice": (1024 ** 2, 100),
+            "/shared": (None, 5),
+            "/tmp": (1024, None),
+        })
+
+    def test_folder_must_be_absolute(self):
+        with self.assertRaises(ValueError):
+            parse_limits("users 1M")
+
+
+class TestQuotas(unittest.TestCase):
+
+    def setUp(self):
+        self.quotas = Quotas({"/a": (100, 3), "/a/b": (50, None)})
+        self.quotas.load(lambda folder: {"/a": (40, 2), "/a/b": (10, 1)}[folder])
+
+    def assertExceeded(self, *a, **kw):
+        with self.assertRaises(OSError) as raised:
+            self.quotas.admit(*a, **kw)
+        self.assertEqual(raised.exception.errno, errno.EDQUOT)
+
+    def test_covering_folders(self):
+        self.assertListEqual(sorted(self.quotas.covering("/a/b/file")), ["/a", "/a/b"])
+        self.assertListEqual(self.quotas.covering("/a-b/file"), [])
+
+    def test_unlimited_path_is_admitted_without_reservation(self):
+        self.assertIsNone(self.quotas.admit("/c/file", 10 ** 12))
+
+    def test_upload_exceeding_bytes_of_any_covering_folder_is_rejected(self):
+        self.assertExceeded("/a/b/file", 41)
+        self.assertExceeded("/a/file", 61)
+        self.assertIsNotNone(self.quotas.admit("/a/file", 60))
+        self.assertEqual(self.quotas.rejected, 2)
+
+    def test_upload_exceeding_files_is_rejected(self):
+        self.quotas.admit("/a/file1", 1)
+        self.assertExceeded("/a/file2", 1)
+        # continuation of resumable upload doesn't add a file
+        self.assertIsNotNone(self.quotas.admit("/a/file2", 1, files=0))
+
+    def test_reservations_of_concurrent_uploads_add_up_until_released(self):
+        first = self.quotas.admit("/a/b/file1", 30)
+        self.assertExceeded("/a/b/file2", 30)
+        first.release()
+        self.assertIsNotNone(self.quotas.admit("/a/b/file2", 30))
+
+    def test_reservation_grows_with_body_of_unknown_length(self):
+        reservation = self.quotas.admit("/a/b/file", 0)
+        reservation.grow(40)
+        with self.assertRaises(OSError):
+            reservation.grow(41)
+        self.assertEqual(self.quotas.reserved["/a"][0], 40)
+        reservation.release()
+        self.assertListEqual(self.quotas.reserved["/a"], [0, 0])
+
+    def test_completed_resumable_upload_reserves_its_file(self):
+        self.quotas.add("/a/file1", 1, 1)
+        # the session was admitted while there was room for the file, then another one took it
+        reservation = self.quotas.admit("/a/file2", 1, files=0)
+        with self.assertRaises(OSError):
+            reservation.grow(1, files=1)
+        self.quotas.removed("/a/file1", 1, 1)
+        reservation.grow(1, files=1)
+        reservation.grow(1, files=1)
+        self.assertListEqual(self.quotas.reserved["/a"], [1, 1])
+        reservation.release()
+        self.assertListEqual(self.quotas.reserved["/a"], [0, 0])
+
+    def test_moved_node_is_checked_by_folders_not_containing_it_yet(self):
+        self.assertExceeded("/a/folder", 61, 1, source="/c/folder")
+        self.assertIsNone(self.quotas.admit("/a/folder", 61, 1, source="/a/b/folder"))
+
+    def test_uploaded_and_deleted_files_change_usage(self):
+        self.quotas.add("/a/b/file", 20, 1)
+        self.assertListEqual(self.quotas.used["/a"], [60, 3])
+        self.assertListEqual(self.quotas.used["/a/b"], [30, 2])
+        self.quotas.removed("/a/file", 5, 1)
+        self.assertListEqual(self.quotas.used["/a"], [55, 2])
+        self.assertListEqual(self.quotas.used["/a/b"], [30, 2])
+
+    def test_deleted_folder_resets_limited_folders_inside_of_it(self):
+        self.quotas.removed("/a", 40, 2)
+        self.assertListEqual(self.quotas.used["/a"], [0, 0])
+        self.assertListEqual(self.quotas.used["/a/b"], [0, 0])
+
+
+class TestSharedQuotas(unittest.TestCase):
+
+    def test_forked_processes_share_usage_and_reservations(self):
+        quotas = Quotas({"/a": (100, None)}, shared=True)
+        quotas.set("/a", 40, 2)
+        child = multiprocessing.get_context("fork").Process(target=lambda: quotas.admit("/a/file", 50))
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+        self.assertListEqual(list(quotas.reserved["/a"]), [50, 1])
+        with self.assertRaises(OSError):
+            quotas.admit("/a/other", 11)
+        quotas.add("/a/file", 50, 1)
+        self.assertListEqual(list(quotas.used["/a"]), [90, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
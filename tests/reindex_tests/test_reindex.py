@@ -0,0 +1,150 @@
+import os
+import unittest
+
+from db_tests import DbTestCase
+
+
+def storage(path=""):
+    from tornado.options import options
+    return os.path.join(options.storage_path, path.lstrip("/"))
+
+
+def write_file(path, bytes):
+    os.makedirs(os.path.dirname(storage(path)), exist_ok=True)
+    with open(storage(path), "wb") as f:
+        f.write(b"x" * bytes)
+
+
+def make_tree():
+    for path, bytes in (("/a/f1", 10), ("/a/b/f2", 20), ("/a/b/c/f3", 30), ("/d/f4", 5)):
+        write_file(path, bytes)
+    os.makedirs(storage("/e"))
+
+
+def change_tree():
+    """Change files bypassing the app"""
+    import shutil
+    write_file("/a/new", 7)
+    write_file("/a/f1", 15)
+    shutil.rmtree(storage("/d"))
+    # folder replaced with a file
+    shutil.rmtree(storage("/a/b"))
+    write_file("/a/b", 3)
+
+
+def on_disk():
+    """db path -> (bytes, is_dir, tree_bytes, tree_files) counted from disk"""
+    nodes = {}
+    for folder, folders, files in os.walk(storage(), topdown=False):
+        path = folder[len(storage().rstrip("/")):] or "/"
+        prefix = path.rstrip("/") + "/"
+        tree_bytes = tree_files = 0
+        for name in files:
+            bytes = os.stat(os.path.join(folder, name)).st_size
+            nodes[prefix + name] = (bytes, False, bytes, 1)
+            tree_bytes, tree_files = tree_bytes + bytes, tree_files + 1
+        for name in folders:
+            tree_bytes, tree_files = tree_bytes + nodes[prefix + name][2], tree_files + nodes[prefix + name][3]
+        nodes[path] = (os.stat(folder).st_size, True, tree_bytes, tree_files)
+    return nodes
+
+
+def indexed():
+    import db
+    db.connect()
+    return {path: (bytes, bool(is_dir), tree_bytes, tree_files) for path, bytes, is_dir, tree_bytes, tree_files in
+            db.File.select(db.File.path, db.File.bytes, db.File.is_dir, db.File.tree_bytes, db.File.tree_files)
+            .tuples()}
+
+
+def parents():
+    """db path -> db path of the parent found by parent_id"""
+    import db
+    parent = db.File.alias()
+    return dict(db.File.select(db.File.path, parent.path).join(parent, on=(db.File.parent == parent.id)).tuples())
+
+
+def reindex(mode):
+    import reindex
+    return dict((reindex.full if mode == "full" else reindex.diff)(reindex.Reindex(2), 1000))
+
+
+def corrupt_totals(path):
+    import db
+    db.File.update(tree_bytes=db.File.tree_bytes + 1).where(db.File.path == path).execute()
+
+
+def changes_after(cursor):
+    import db
+    try:
+        return [(change['action'], change['path']) for change in db.changes(cursor)['changes']]
+    except LookupError:
+        return "gone"
+
+
+def current_cursor():
+    import db
+    return db.changes()['cursor']
+
+
+class TestReindex(DbTestCase):
+
+    def assertIndexed(self):
+        disk = self.in_db(on_disk)
+        self.assertDictEqual(self.in_db(indexed), disk)
+        self.assertDictEqual(self.in_db(parents), {path: os.path.dirname(path) for path in disk if path != "/"})
+
+    def test_full_builds_index_of_the_tree(self):
+        self.in_db(make_tree)
+        self.assertDictEqual(self.in_db(reindex, "full"), {"folders": 6, "nodes": 9})
+        self.assertIndexed()
+
+    def test_full_replaces_index_of_changed_tree(self):
+        self.in_db(make_tree)
+        self.in_db(reindex, "full")
+        self.in_db(change_tree)
+        self.in_db(reindex, "full")
+        self.assertIndexed()
+
+    def test_diff_writes_differences_and_logs_them(self):
+        self.in_db(make_tree)
+        self.in_db(reindex, "full")
+        self.in_db(change_tree)
+        cursor = self.in_db(current_cursor)
+        counts = self.in_db(reindex, "diff")
+        self.assertIndexed()
+        # /a/b folder is deleted and created as a file
+        self.assertEqual((counts["created"], counts["deleted"]), (2, 2))
+        changes = self.in_db(changes_after, cursor)
+        for change in (("delete", "/d"), ("delete", "/a/b"), ("update", "/a/b"), ("update", "/a/new"),
+                       ("update", "/a/f1")):
+            self.assertIn(change, changes)
+
+    def test_diff_of_unchanged_tree_writes_nothing(self):
+        self.in_db(make_tree)
+        self.in_db(reindex, "full")
+        cursor = self.in_db(current_cursor)
+        counts = self.in_db(reindex, "diff")
+        self.assertEqual((counts["created"], counts["changed"], counts["deleted"]), (0, 0, 0))
+        self.assertListEqual(self.in_db(changes_after, cursor), [])
+
+    def test_diff_repairs_totals(self):
+        self.in_db(make_tree)
+        self.in_db(reindex, "full")
+        self.in_db(corrupt_totals, "/a/b")
+        self.assertEqual(self.in_db(reindex, "diff")["totals_repaired"], 1)
+        self.assertIndexed()
+
+    def test_clients_sync_whole_tree_after_full(self):
+        self.in_db(make_tree)
+        self.in_db(reindex, "diff")
+        cursor = self.in_db(current_cursor)
+        self.in_db(change_tree)
+        self.in_db(reindex, "full")
+        # what has changed is unknown, even for a client which has seen all changes
+        self.assertEqual(self.in_db(changes_after, cursor), "gone")
+        self.assertListEqual(self.in_db(changes_after, self.in_db(current_cursor)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from tornado.options import define, options
+
+import uploads
+
+if "storage_path" not in options:
+    define("storage-path", "/why/do/you/need/me")
+for name, default in (("upload_staging_dir", ""), ("upload_preallocate", True), ("upload_session_ttl", 24)):
+    if name not in options:
+        define(name, default)
+
+
+class TestUploadSession(unittest.TestCase):
+
+    def setUp(self):
+        self._storage_path = options.storage_path
+        self.tmp = tempfile.TemporaryDirectory()
+        options.storage_path = self.tmp.name
+
+    def tearDown(self):
+        options.storage_path = self._storage_path
+        self.tmp.cleanup()
+
+    def test_create_preallocates_staged_file(self):
+        session = uploads.create("/a/file", 1000)
+        self.assertEqual(os.path.getsize(session.staged), 1000)
+        self.assertEqual(uploads.active("/a/file"), session.id)
+
+    def test_saved_offset_is_persisted(self):
+        session = uploads.create("/file", 1000)
+        session.saved(300)
+        session.saved(None)
+        loaded = uploads.get(session.id)
+        self.assertEqual((loaded.path, loaded.length, loaded.offset), ("/file", 1000, 300))
+
+    def test_second_session_on_the_same_path_conflicts(self):
+        uploads.create("/file", 10)
+        with self.assertRaises(FileExistsError):
+            uploads.create("/file", 10)
+
+    def test_processes_see_sessions_of_each_other(self):
+        context = multiprocessing.get_context("fork")
+        start = context.Barrier(4)
+        created = context.Queue()
+
+        def create():
+            start.wait()
+            try:
+                created.put(uploads.create("/file", 10).id)
+            except FileExistsError:
+                created.put(None)
+
+        processes = [context.Process(target=create) for _ in range(4)]
+        for process in processes:
+            process.start()
+        ids = [created.get(timeout=10) for _ in processes]
+        for process in processes:
+            process.join()
+        self.assertEqual(len(list(filter(None, ids))), 1)
+        self.assertIn(uploads.active("/file"), ids)
+
+    def test_discarded_session_releases_the_path(self):
+        uploads.create("/file", 10).discard()
+        self.assertIsNone(uploads.active("/file"))
+        uploads.create("/file", 10)
+
+    def test_sweep_removes_claims_of_lost_sessions(self):
+        session = uploads.create("/file", 10)
+        os.remove(session.meta)
+        uploads.sweep()
+        self.assertFalse(os.path.exists(uploads.claim_path("/file")))
+
+    def test_sessions_survive_restart(self):
+        session = uploads.create("/file", 10)
+        uploads.sweep()
+        self.assertEqual(uploads.active("/file"), session.id)
+
+    def test_sweep_removes_expired_sessions(self):
+        session = uploads.create("/file", 10)
+        # last chunk was received an hour ago
+        options.upload_session_ttl = -1
+        try:
+            session.save()
+        finally:
+            options.upload_session_ttl = 24
+        uploads.sweep()
+        self.assertIsNone(uploads.active("/file"))
+        self.assertEqual(os.listdir(uploads.sessions_dir()), [".lock"])
+
+    def test_unknown_or_malformed_id_is_not_found(self):
+        for session_id in ("0" * 32, "../../etc/passwd", ""):
+            with self.assertRaises(KeyError):
+                uploads.get(session_id)
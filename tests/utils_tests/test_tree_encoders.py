@@ -0,0 +1,40 @@
+import json
+import unittest
+
+from fs import build_tree
+from utils import tree_to_json, tree_to_ndjson
+
+WALK = [
+    (0, {"path": "/"}, True),
+    (1, {"path": "/a"}, True),
+    (2, {"path": "/a/b"}, False),
+    (2, {"path": "/a/c"}, True),
+    (1, {"path": "/d"}, False),
+    (1, {"path": "/e"}, True),
+]
+
+
+class TestTreeToJson(unittest.TestCase):
+
+    def test_same_as_encoding_built_tree(self):
+        encoded = "".join(tree_to_json(iter(WALK)))
+        self.assertEqual(json.loads(encoded), build_tree(iter(WALK)))
+
+    def test_small_chunk_size_splits_output(self):
+        chunks = list(tree_to_json(iter(WALK), chunk_size=10))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads("".join(chunks)), build_tree(iter(WALK)))
+
+    def test_single_node(self):
+        self.assertEqual("".join(tree_to_json(iter([(0, {"path": "/f"}, False)]))), '{"path": "/f"}')
+
+
+class TestTreeToNdjson(unittest.TestCase):
+
+    def test_one_node_per_line(self):
+        lines = "".join(tree_to_ndjson(iter(WALK))).splitlines()
+        self.assertListEqual([json.loads(line)["path"] for line in lines], ["/", "/a", "/a/b", "/a/c", "/d", "/e"])
+
+
+if __name__ == "__main__":
+    unittest.main()